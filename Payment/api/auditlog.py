@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import json
+import time
+import atexit
+import logging
+import datetime
+import threading
+import collections
+from django.conf import settings
+from django.db import close_old_connections
+
+from api import metrics
+from api.models import PaymentTransactionLog
+
+
+log = logging.getLogger(__name__)
+
+__defaults__ = {
+    'MODE': 'sync',
+    'SPOOL_DIR': os.path.join(settings.PROJECT_ROOT, 'queue', 'transaction_log'),
+    'DURABILITY': 'flush',
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,
+    'MAX_BUFFER': 100000,
+    'RECOVERY_AGE': 60,
+}
+
+DURABILITY_LEVELS = ["memory", "flush", "fsync"]
+
+
+def getConfig():
+    """Merge the TRANSACTION_LOG settings with the default values"""
+    config = dict(__defaults__)
+    config.update(getattr(settings, 'TRANSACTION_LOG', {}))
+    return config
+
+
+@metrics.timed("db")
+def record(payment_id, transaction_type, request=None, response=None):
+    """Append an entry to the transaction log
+
+    In "sync" mode the entry is inserted at once; in "buffered" mode it is written to
+    the spool of the process and inserted in batches by a background thread.
+
+    Usage::
+        >>> from api import auditlog
+        >>> auditlog.record("PAY-xxx", "info", None, '{"id": "PAY-xxx"}')
+
+    :param payment_id: the Paypal payment id
+    :type payment_id: string
+    :param transaction_type: i.e. info, execute
+    :type transaction_type: string
+    :param request: the request sent to Paypal (JSON)
+    :type request: string
+    :param response: the response of Paypal (JSON)
+    :type response: string
+    """
+    now = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+    entry = {
+        "payment_id": payment_id,
+        "transaction_type": transaction_type,
+        "request_json": request,
+        "response_json": response,
+        "create_time": now,
+        "update_time": now,
+    }
+    config = getConfig()
+    if config['MODE'] == "buffered":
+        TransactionLogBuffer.get(config).append(entry)
+    else:
+        PaymentTransactionLog.objects.create(**entry)
+
+
+def buildEntries(entries):
+    """Build the unsaved log rows of the spooled entries"""
+    return [PaymentTransactionLog(**entry) for entry in entries]
+
+
+class TransactionLogBuffer(object):
+    """Write-behind buffer of the transaction log
+
+    The entries are kept in memory and inserted with bulk_create when BATCH_SIZE
+    entries are pending or every FLUSH_INTERVAL seconds. Depending on DURABILITY,
+    each entry is also appended to a spool file of the process before the call
+    returns:
+        - memory: no spool; the pending entries are lost if the process dies
+        - flush: written to the OS; survives a crash of the process
+        - fsync: synced to disk; survives a crash of the host
+
+    Each flush moves the spool to a new segment, which is removed once its entries
+    are in the database. The segments left behind by a dead process (or a failed
+    flush) are inserted by the next recovery pass (or "python manage.py flush_transaction_log"),
+    so an entry is stored at least once.
+    """
+
+    instances = dict()
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, config=None):
+        """Get the buffer of the current process (one instance per pid, since the
+        workers may be forked); the flusher thread is started on first use
+
+        :rtype: TransactionLogBuffer
+        """
+        with cls.instances_lock:
+            pid = os.getpid()
+            if pid not in cls.instances:
+                cls.instances[pid] = cls(config or getConfig())
+                cls.instances[pid].start()
+            return cls.instances[pid]
+
+    def __init__(self, config):
+        """Class constructor
+
+        :param config: the TRANSACTION_LOG settings
+        :type config: dictionary
+        """
+        if config['DURABILITY'] not in DURABILITY_LEVELS:
+            raise ValueError("Unknown transaction log durability %s" % config['DURABILITY'])
+        self.config = config
+        self.pid = os.getpid()
+        self.entries = collections.deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.sequence = 0
+        self.spool = None
+        self.spool_path = None
+        self.thread = None
+        if config['DURABILITY'] != "memory" and not os.path.isdir(config['SPOOL_DIR']):
+            os.makedirs(config['SPOOL_DIR'])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="transaction-log-flusher")
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Flush the pending entries and stop the flusher thread"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join(30)
+
+    def append(self, entry):
+        """Buffer an entry; it is spooled according to the durability level"""
+        with self.condition:
+            if len(self.entries) >= self.config['MAX_BUFFER']:
+                raise RuntimeError("The transaction log buffer is full")
+            if self.config['DURABILITY'] != "memory":
+                if self.spool is None:
+                    self.openSegment()
+                self.spool.write(json.dumps(entry) + "\n")
+                self.spool.flush()
+                if self.config['DURABILITY'] == "fsync":
+                    os.fsync(self.spool.fileno())
+            self.entries.append(entry)
+            if len(self.entries) >= self.config['BATCH_SIZE']:
+                self.condition.notify()
+
+    def openSegment(self):
+        self.sequence += 1
+        self.spool_path = os.path.join(self.config['SPOOL_DIR'], "%d-%d-%d.spool" % (self.pid, int(time.time()), self.sequence))
+        self.spool = open(self.spool_path, "a")
+
+    def run(self):
+        """Flush the buffer on size or time until the buffer is stopped"""
+        while True:
+            with self.condition:
+                if not self.stopped and len(self.entries) < self.config['BATCH_SIZE']:
+                    self.condition.wait(self.config['FLUSH_INTERVAL'])
+                stopped = self.stopped
+            self.flush()
+            if stopped:
+                return
+
+    def flush(self):
+        """Insert the pending entries and remove their spool segment
+
+        :returns: the number of the inserted entries
+        :rtype: integer
+        """
+        with self.condition:
+            (entries, self.entries) = (list(self.entries), collections.deque())
+            (spool, path) = (self.spool, self.spool_path)
+            (self.spool, self.spool_path) = (None, None)
+        if spool is not None:
+            spool.close()
+
+        inserted = 0
+        try:
+            if entries:
+                for offset in range(0, len(entries), self.config['BATCH_SIZE']):
+                    PaymentTransactionLog.objects.bulk_create(buildEntries(entries[offset:offset + self.config['BATCH_SIZE']]))
+                inserted = len(entries)
+            if path is not None:
+                os.remove(path)
+            if self.config['DURABILITY'] != "memory":
+                inserted += recover(self.config)
+        except Exception as ex:
+            log.error("Failed to flush %d transaction log entries: %s" % (len(entries), str(ex)))
+            if path is None:
+                # not spooled; keep them for the next attempt
+                with self.condition:
+                    self.entries.extendleft(reversed(entries[inserted:]))
+        finally:
+            close_old_connections()
+        return inserted
+
+
+def recover(config=None, age=None):
+    """Insert the entries of the spool segments that are older than RECOVERY_AGE seconds
+
+    A segment is claimed by renaming it, so concurrent recoveries do not insert it twice.
+
+    :returns: the number of the recovered entries
+    :rtype: integer
+    """
+    config = config or getConfig()
+    age = config['RECOVERY_AGE'] if age is None else age
+    recovered = 0
+    for path in sorted(glob.glob(os.path.join(config['SPOOL_DIR'], "*.spool"))):
+        try:
+            if time.time() - os.path.getmtime(path) < age:
+                continue
+            claimed = "%s.%d.recovering" % (path, os.getpid())
+            os.rename(path, claimed)
+        except OSError:
+            continue
+        with open(claimed) as spool:
+            # a partial last line is the write that the crash has interrupted
+            entries = [json.loads(line) for line in spool.read().splitlines() if line.endswith("}")]
+        for offset in range(0, len(entries), config['BATCH_SIZE']):
+            PaymentTransactionLog.objects.bulk_create(buildEntries(entries[offset:offset + config['BATCH_SIZE']]))
+        os.remove(claimed)
+        log.info("%d transaction log entries have been recovered from %s" % (len(entries), path))
+        recovered += len(entries)
+    return recovered
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.db.utils import OperationalError
+
+from api.resilience import Bulkhead
+
+
+__defaults__ = {
+    'LIMIT': 100,
+    'WAIT': 10,
+}
+
+# the bulkhead of the open connections (see /metrics)
+BULKHEAD = "database:connections"
+
+
+def getConfig():
+    """Merge the DATABASE_CONNECTIONS settings with the default values"""
+    config = dict(__defaults__)
+    config.update(getattr(settings, 'DATABASE_CONNECTIONS', {}))
+    return config
+
+
+class LimitedConnectionsMixin(object):
+    """Bound the open database connections of the process
+
+    The connections of Django are thread-local, i.e. greenlet-local in the gevent
+    serving mode (see wsgi.py), and a request keeps its connection until it finishes,
+    while it waits on OpenAM and Paypal. A new connection waits up to WAIT seconds
+    while LIMIT connections of the process are open and fails with an OperationalError
+    otherwise, so the workers never open more than LIMIT connections each.
+
+    Usage::
+        >>> from django.db.backends.mysql import base
+        >>> class DatabaseWrapper(LimitedConnectionsMixin, base.DatabaseWrapper):
+        ...     pass
+    """
+
+    connection_slot = False
+
+    def get_new_connection(self, conn_params):
+        config = getConfig()
+        if not self.connection_slot:
+            if not Bulkhead.get(BULKHEAD, config['LIMIT']).acquire(config['WAIT']):
+                raise OperationalError("The %d database connections of the process are in use" % config['LIMIT'])
+            self.connection_slot = True
+        try:
+            return super(LimitedConnectionsMixin, self).get_new_connection(conn_params)
+        except Exception:
+            self.releaseSlot()
+            raise
+
+    def _close(self):
+        try:
+            super(LimitedConnectionsMixin, self)._close()
+        finally:
+            self.releaseSlot()
+
+    def releaseSlot(self):
+        if self.connection_slot:
+            self.connection_slot = False
+            Bulkhead.get(BULKHEAD, getConfig()['LIMIT']).release()
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+from django.db.backends.mysql import base
+
+from api.backends.limited import LimitedConnectionsMixin
+
+
+class DatabaseWrapper(LimitedConnectionsMixin, base.DatabaseWrapper):
+    """The MySQL backend with a bound on the open connections of the process
+
+    Usage::
+        >>> DATABASES = {'default': {'ENGINE': 'api.backends.mysql'}}
+    """
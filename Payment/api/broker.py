@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import sqlite3
+import threading
+
+
+class EventQueue(object):
+    """Durable local queue of the webhook events, backed by a SQLite file
+
+    Each message is leased to a single consumer for a limited time; a message
+    that is not acknowledged (i.e. the worker has crashed) becomes available
+    again when its lease expires.
+
+    Usage::
+        >>> from api.broker import EventQueue
+        >>> queue = EventQueue.get("/tmp/webhooks.sqlite3")
+        >>> queue.put('{"id": "WH-xxx"}', "WH-xxx")
+        >>> (message_id, payload, attempts) = queue.claim(lease=300)
+        >>> queue.ack(message_id)
+    """
+
+    instances = dict()
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path):
+        """Get the queue stored in the given path (one instance per path)
+
+        :param path: the path of the SQLite file
+        :type path: string
+        :rtype: EventQueue
+        """
+        with cls.instances_lock:
+            if path not in cls.instances:
+                cls.instances[path] = cls(path)
+            return cls.instances[path]
+
+    def __init__(self, path):
+        """Class constructor
+
+        :param path: the path of the SQLite file; the directory is created if it is missing
+        :type path: string
+        """
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection().execute(
+            "CREATE TABLE IF NOT EXISTS webhook_queue ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " event_id TEXT,"
+            " payload TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " available_at REAL NOT NULL,"
+            " locked_until REAL,"
+            " last_error TEXT,"
+            " create_time REAL NOT NULL)"
+        )
+
+    def connection(self):
+        """Get the connection of the current thread (SQLite connections are not shared among threads)"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None or getattr(self.local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def put(self, payload, event_id=None):
+        """Append a message; it is on disk when the method returns
+
+        :param payload: the raw event
+        :type payload: string
+        :param event_id: the Paypal event id
+        :type event_id: string
+        """
+        now = time.time()
+        self.connection().execute(
+            "INSERT INTO webhook_queue (event_id, payload, available_at, create_time) VALUES (?, ?, ?, ?)",
+            (event_id, payload, now, now)
+        )
+
+    def claim(self, lease):
+        """Lease the oldest available message
+
+        :param lease: the seconds the message is reserved for the caller
+        :type lease: integer
+        :returns: the message id, the payload and the number of the previous attempts or None
+        :rtype: tuple(integer, string, integer)
+        """
+        now = time.time()
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT id, payload, attempts FROM webhook_queue"
+                " WHERE available_at <= ? AND (locked_until IS NULL OR locked_until < ?)"
+                " ORDER BY id LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is not None:
+                connection.execute("UPDATE webhook_queue SET locked_until = ? WHERE id = ?", (now + lease, row[0]))
+            connection.execute("COMMIT")
+            return row
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+    def ack(self, message_id):
+        """Remove a processed message"""
+        self.connection().execute("DELETE FROM webhook_queue WHERE id = ?", (message_id,))
+
+    def retry(self, message_id, delay, error=None):
+        """Release a failed message so that it is retried after delay seconds"""
+        self.connection().execute(
+            "UPDATE webhook_queue SET attempts = attempts + 1, available_at = ?, locked_until = NULL, last_error = ?"
+            " WHERE id = ?",
+            (time.time() + delay, error, message_id)
+        )
+
+    def size(self):
+        """Get the number of the pending messages"""
+        return self.connection().execute("SELECT COUNT(*) FROM webhook_queue").fetchone()[0]
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import time
+import hashlib
+import threading
+import collections
+from django.core.cache import caches
+
+
+def hashKey(prefix, value):
+    """Build a cache key that does not expose the (secret) value
+
+    :param prefix: the namespace of the key
+    :type prefix: string
+    :param value: the value to hash, i.e. an access token
+    :type value: string
+    :returns: the cache key
+    :rtype: string
+    """
+    return "%s:%s" % (prefix, hashlib.sha256(str(value)).hexdigest())
+
+
+class TTLCache(object):
+    """Bounded, thread-safe in-process cache with LRU eviction and per-entry expiry
+
+    Usage::
+        >>> from api.cache import TTLCache
+        >>> cache = TTLCache(max_entries=1000)
+        >>> cache.set("key", "value", 60)
+        >>> cache.get("key")
+        'value'
+    """
+
+    def __init__(self, max_entries=1000):
+        """Class constructor
+
+        :param max_entries: the maximum number of entries kept in memory
+        :type max_entries: integer
+        """
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Get a non-expired value or None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return None
+            # re-insert to mark the entry as the most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        """Store a value for ttl seconds, evicting the least recently used entries"""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove a value (if any)"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Remove all the values and reset the counters"""
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Get the hit/miss counters and the current size
+
+        :rtype: dictionary
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+class SharedTTLCache(TTLCache):
+    """TTLCache on top of a Django cache backend, so all the workers share the entries
+
+    The hit/miss counters are kept per process.
+    """
+
+    def __init__(self, alias):
+        """Class constructor
+
+        :param alias: the name of the cache in the CACHES setting
+        :type alias: string
+        """
+        super(SharedTTLCache, self).__init__(max_entries=None)
+        self.backend = caches[alias]
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, ttl):
+        self.backend.set(key, value, max(1, int(ttl)))
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": None}
+
+
+def createCache(config):
+    """Create either an in-process or a shared cache according to the configuration
+
+    :param config: the cache settings; the BACKEND key holds an alias of the CACHES setting
+    :type config: dictionary
+    :returns: the cache
+    :rtype: TTLCache
+    """
+    if config.get("BACKEND"):
+        return SharedTTLCache(config["BACKEND"])
+    return TTLCache(max_entries=config.get("MAX_ENTRIES", 1000))
+
+
+class SingleFlight(object):
+    """Deduplicate the concurrent calls for the same key
+
+    The first caller of a key executes the function; the callers that arrive
+    while it is still in flight wait for its outcome instead of repeating it.
+
+    Usage::
+        >>> from api.cache import SingleFlight
+        >>> flight = SingleFlight()
+        >>> result = flight.do("key", function, argument)
+    """
+
+    class Call(object):
+        """An in-flight call"""
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        """Class constructor"""
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.deduplicated = 0
+
+    def do(self, key, function, *args, **kwargs):
+        """Execute the function once for all the concurrent callers of the key
+
+        :returns: the outcome of the function
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlight.Call()
+            else:
+                self.deduplicated += 1
+
+        if not leader:
+            call.event.wait()
+        else:
+            try:
+                call.result = function(*args, **kwargs)
+            except Exception as ex:
+                call.error = ex
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.event.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import json
+import datetime
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from api.fields import decompress
+from api.models import Authorization, Capture, Payment, Refund, Sale
+from api.paypal.paypal import getDetailsCacheConfig
+from api.utilities import parseDateTime
+
+
+__defaults__ = {
+    'ENABLED': True,
+    'MAX_AGE': 30,
+    'TERMINAL_MAX_AGE': 86400,
+}
+
+# resource type: (model, Paypal id field)
+RELATED_RESOURCES = [
+    ("sale", Sale, "sale_id"),
+    ("authorization", Authorization, "authorization_id"),
+    ("capture", Capture, "capture_id"),
+    ("refund", Refund, "refund_id"),
+]
+
+
+def getConfig():
+    """Merge the PAYMENT_LOCAL_READS settings with the default values"""
+    config = dict(__defaults__)
+    config.update(getattr(settings, 'PAYMENT_LOCAL_READS', {}))
+    return config
+
+
+def getLocalRows(pay_id):
+    """Get the stored payment and the resources that refer to it with a single query
+
+    :param pay_id: the payment id in Paypal format (PAY-xxx)
+    :type pay_id: string
+    :returns: (resource type, Paypal id, stored json, sync time) tuples; the payment first
+    :rtype: list
+    """
+    quote = connection.ops.quote_name
+    statements = ["SELECT 'payment', %s, %s, %s FROM %s WHERE %s = %%s" % (
+        quote("pay_id"), quote("json"), quote("sync_time"), quote(Payment._meta.db_table), quote("pay_id"))]
+    for (resource_type, model, key) in RELATED_RESOURCES:
+        statements.append("SELECT '%s', %s, %s, NULL FROM %s WHERE %s = %%s" % (
+            resource_type, quote(key), quote("json"), quote(model._meta.db_table), quote("parent_payment")))
+    with connection.cursor() as cursor:
+        cursor.execute(" UNION ALL ".join(statements), [pay_id] * len(statements))
+        rows = cursor.fetchall()
+    return sorted(rows, key=lambda row: row[0] != "payment")
+
+
+def toDateTime(value):
+    """Convert a raw date-time column (a string on SQLite) to an aware datetime"""
+    if value is None:
+        return None
+    if not isinstance(value, datetime.datetime):
+        return parseDateTime(value)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def getLocalDetails(pay_id, config=None):
+    """Assemble the Paypal document of a payment from the stored rows
+
+    The document is the last copy of the payment that Paypal has returned (on creation,
+    execution or lookup), with its related resources replaced by the stored sales,
+    authorizations, captures and refunds, which the webhooks keep current.
+
+    Usage::
+        >>> from api.details import getLocalDetails
+        >>> document = getLocalDetails("PAY-xxx")
+
+    :param pay_id: the payment id in Paypal format (PAY-xxx)
+    :type pay_id: string
+    :returns: the payment document or None if the local copy is missing, incomplete or
+        older than MAX_AGE seconds (TERMINAL_MAX_AGE for the payments in a terminal state)
+    :rtype: dictionary
+    """
+    config = config or getConfig()
+    rows = getLocalRows(pay_id)
+    if not rows or rows[0][0] != "payment":
+        return None
+    sync_time = toDateTime(rows[0][3])
+    if sync_time is None:
+        return None
+    try:
+        document = json.loads(decompress(rows[0][2]))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(document, dict) or not isinstance(document.get("transactions"), list):
+        return None
+
+    terminal = str(document.get("state", "")).lower() in getDetailsCacheConfig()["TERMINAL_STATES"]
+    max_age = config["TERMINAL_MAX_AGE"] if terminal else config["MAX_AGE"]
+    if (timezone.now() - sync_time).total_seconds() > max_age:
+        return None
+
+    resources = dict(((resource_type, resource_id), stored) for (resource_type, resource_id, stored, _) in rows[1:])
+    for transaction in document["transactions"]:
+        for related in transaction.get("related_resources", []):
+            for (resource_type, resource) in related.items():
+                stored = resources.pop((resource_type, resource.get("id")), None)
+                if stored is not None:
+                    related[resource_type] = json.loads(decompress(stored))
+    if resources:
+        # a resource that the copy does not include can not be placed among many transactions
+        if len(document["transactions"]) != 1:
+            return None
+        document["transactions"][0].setdefault("related_resources", []).extend(
+            {resource_type: json.loads(decompress(stored))} for ((resource_type, resource_id), stored) in sorted(resources.items()))
+    return document
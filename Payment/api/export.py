@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+import datetime
+from decimal import Decimal
+from django.db.models import Q
+
+from api.fields import CompressedJSONField, decompress
+from api.models import BillingAgreement, Capture, Payment, PaymentTransaction, Refund, Sale
+
+
+def getClientPayments(client_id):
+    """Get the subquery of the Paypal payment ids (PAY-xxx) of a client"""
+    return Payment.objects.filter(client_id=client_id).values("pay_id")
+
+
+def getClientAgreements(client_id):
+    """Get the subquery of the Paypal billing agreement ids (I-xxx) of a client"""
+    return BillingAgreement.objects.filter(client_id=client_id).values("agreement_id")
+
+
+def getClientSales(client_id):
+    """Get the subquery of the Paypal sale ids of a client"""
+    return Sale.objects.filter(filterSales(client_id)).values("sale_id")
+
+
+def filterPayments(client_id):
+    return Q(client_id=client_id)
+
+
+def filterTransactions(client_id):
+    return Q(payment__client_id=client_id)
+
+
+def filterSales(client_id):
+    return Q(parent_payment__in=getClientPayments(client_id)) | Q(billing_agreement_id__in=getClientAgreements(client_id))
+
+
+def filterRefunds(client_id):
+    return Q(parent_payment__in=getClientPayments(client_id)) | Q(sale_id__in=getClientSales(client_id))
+
+
+def filterCaptures(client_id):
+    return Q(parent_payment__in=getClientPayments(client_id))
+
+
+# resource: (model, time field, client filter)
+EXPORT_RESOURCES = {
+    "payments": (Payment, "create_time", filterPayments),
+    "payment-transactions": (PaymentTransaction, "payment__create_time", filterTransactions),
+    "sales": (Sale, "create_time", filterSales),
+    "refunds": (Refund, "create_time", filterRefunds),
+    "captures": (Capture, "create_time", filterCaptures),
+}
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def getExportQueryset(resource, client_id, start=None, end=None):
+    """Get the rows of a resource that belong to a client, optionally within [start, end)
+
+    :param resource: one of EXPORT_RESOURCES
+    :type resource: string
+    :param client_id: the client id of the application in OpenAM
+    :type client_id: string
+    :param start: the lower bound (inclusive) of the creation time
+    :type start: datetime
+    :param end: the upper bound (exclusive) of the creation time
+    :type end: datetime
+    :rtype: QuerySet
+    """
+    (model, time_field, client_filter) = EXPORT_RESOURCES[resource]
+    queryset = model.objects.filter(client_filter(client_id))
+    if start is not None:
+        queryset = queryset.filter(**{time_field + "__gte": start})
+    if end is not None:
+        queryset = queryset.filter(**{time_field + "__lt": end})
+    return queryset
+
+
+def getExportColumns(model):
+    """Get the column names of a model (the foreign keys are exported by id)"""
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def iterateRows(queryset, columns, chunk_size=2000):
+    """Iterate over the rows of a queryset as tuples with constant memory
+
+    The rows are fetched in chunks of chunk_size using the last primary key of the
+    previous chunk (WHERE id > last ORDER BY id LIMIT chunk_size), since the MySQL
+    driver buffers the complete result set of a query, even with iterator().
+
+    :param queryset: the rows
+    :type queryset: QuerySet
+    :param columns: the column names; the first one must be the primary key
+    :type columns: list
+    :param chunk_size: rows per query
+    :type chunk_size: integer
+    :returns: generator of tuples
+    """
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        rows = list(chunk.order_by("pk").values_list(*columns)[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][0]
+
+
+def decompressRows(rows, indexes):
+    """Decompress the stored JSON documents of the given columns (see api.fields)"""
+    for row in rows:
+        row = list(row)
+        for index in indexes:
+            row[index] = decompress(row[index])
+        yield row
+
+
+def encodeValue(value):
+    """Convert a column value to a JSON serializable one"""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def ndjsonLines(rows, columns):
+    """Generate one JSON document per row
+
+    The "json" column holds the Paypal resource as JSON text; it is embedded as is
+    instead of being parsed and serialized again.
+    """
+    raw = columns.index("json") if "json" in columns else None
+    for row in rows:
+        document = json.dumps(dict((column, encodeValue(value)) for (index, (column, value)) in enumerate(zip(columns, row)) if index != raw))
+        if raw is not None:
+            document = '%s, "json": %s}' % (document[:-1], row[raw] or "null")
+        yield document + "\n"
+
+
+class Echo(object):
+    """File-like object that returns the written value instead of keeping it"""
+
+    def write(self, value):
+        return value
+
+
+def csvLines(rows, columns):
+    """Generate the CSV header and one CSV line per row"""
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([unicode(encodeValue(value)).encode("utf-8") if value is not None else "" for value in row])
+
+
+def exportRows(resource, client_id, start=None, end=None, output="ndjson", chunk_size=2000):
+    """Stream the rows of a resource of a client in NDJSON or CSV
+
+    Usage::
+        >>> from api.export import exportRows
+        >>> for line in exportRows("sales", "my-app", output="csv"):
+        ...     sys.stdout.write(line)
+
+    :returns: generator of lines
+    """
+    model = EXPORT_RESOURCES[resource][0]
+    columns = getExportColumns(model)
+    rows = iterateRows(getExportQueryset(resource, client_id, start, end), columns, chunk_size)
+    compressed = [index for (index, field) in enumerate(model._meta.concrete_fields) if isinstance(field, CompressedJSONField)]
+    if compressed:
+        rows = decompressRows(rows, compressed)
+    if output == "csv":
+        return csvLines(rows, columns)
+    return ndjsonLines(rows, columns)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+import base64
+import threading
+from django.conf import settings
+from django.db import models
+
+
+__defaults__ = {
+    'ENABLED': True,
+    'LEVEL': 6,
+    # values shorter than MIN_SIZE characters are stored as they are
+    'MIN_SIZE': 128,
+}
+
+# Preset dictionaries of the compressed values; the fragments that recur in the Paypal
+# documents, the most frequent last. A stored value refers to its dictionary by version,
+# so a new dictionary gets a new version and the existing rows remain readable.
+DICTIONARIES = {
+    "1": (
+        '"reason_code": "NONE", "protection_eligibility": "ELIGIBLE", "protection_eligibility_type": '
+        '"ITEM_NOT_RECEIVED_ELIGIBLE,UNAUTHORIZED_PAYMENT_ELIGIBLE", "payment_mode": "INSTANT_TRANSFER", '
+        '"soft_descriptor": "PAYPAL *", "receivable_amount": {"value": "", "currency": "EUR"}, '
+        '"exchange_rate": "", "clearing_time": "", "valid_until": "", "is_final_capture": true, '
+        '"billing_agreement_id": "I-", "payment_definitions": [{"id": "PD-", "name": "", "type": "REGULAR", '
+        '"frequency": "MONTH", "frequency_interval": "1", "cycles": "12", "charge_models": [{"id": "CHM-", '
+        '"type": "SHIPPING", "amount": {"currency": "EUR", "value": ""}}], "merchant_preferences": '
+        '{"setup_fee": {"currency": "EUR", "value": ""}, "max_fail_attempts": "0", "auto_bill_amount": "YES", '
+        '"initial_fail_amount_action": "CONTINUE", "cancel_url": "", "return_url": ""}, '
+        '"agreement_details": {"outstanding_balance": {"value": "0.00"}, "cycles_remaining": "", '
+        '"cycles_completed": "0", "next_billing_date": "", "last_payment_date": "", "last_payment_amount": '
+        '{"value": ""}, "final_payment_date": "", "failed_payment_count": "0"}, "plan": {"id": "P-", '
+        '"state": "ACTIVE", "type": "INFINITE", "payer": {"payment_method": "paypal", "status": "VERIFIED", '
+        '"payer_info": {"email": "", "first_name": "", "last_name": "", "payer_id": "", "shipping_address": '
+        '{"recipient_name": "", "line1": "", "city": "", "state": "", "postal_code": "", "country_code": ""}, '
+        '"country_code": ""}}, "transactions": [{"amount": {"total": "", "currency": "EUR", "details": '
+        '{"subtotal": "", "tax": "0.00", "shipping": "0.00"}}, "payee": {"merchant_id": "", "email": ""}, '
+        '"description": "", "invoice_number": "", "custom": "", "item_list": {"items": [{"name": "", '
+        '"sku": "", "price": "", "currency": "EUR", "quantity": 1, "description": ""}]}, '
+        '"related_resources": [{"sale": {"id": "", "state": "completed", "amount": {"total": "", '
+        '"currency": "EUR", "details": {"subtotal": ""}}, "transaction_fee": {"value": "", "currency": "EUR"}, '
+        '"parent_payment": "PAY-", "create_time": "", "update_time": "", "intent": "sale", "state": '
+        '"approved", "cart": "", "note_to_payer": "", "links": [{"href": '
+        '"https://api.sandbox.paypal.com/v1/payments/payment/PAY-", "rel": "self", "method": "GET"}, '
+        '{"href": "https://api.paypal.com/v1/payments/sale/", "rel": "refund", "method": "POST"}, '
+        '{"href": "https://www.sandbox.paypal.com/cgi-bin/webscr?cmd=_express-checkout&token=EC-", '
+        '"rel": "approval_url", "method": "REDIRECT"}, {"href": '
+        '"https://api.sandbox.paypal.com/v1/payments/payment/PAY-", "rel": "execute", "method": "POST"}, '
+        '{"href": "https://api.sandbox.paypal.com/v1/payments/sale/", "rel": "self", "method": "GET"}, '
+        '{"href": "https://api.sandbox.paypal.com/v1/payments/payment/", "rel": "parent_payment", '
+        '"method": "GET"}], "id": "", "create_time": "", "update_time": "", "state": "completed", '
+        '"amount": {"total": "", "currency": "EUR"}, "links": [{"href": "https://api.sandbox.paypal.com/v1/'
+    ),
+}
+
+# the dictionary of the new values
+DICTIONARY_VERSION = "1"
+
+PREFIX = "zd%s:"
+
+
+def getConfig():
+    """Merge the JSON_COMPRESSION settings with the default values"""
+    config = dict(__defaults__)
+    config.update(getattr(settings, 'JSON_COMPRESSION', {}))
+    return config
+
+
+class Codec(object):
+    """Raw deflate with a preset dictionary
+
+    The zlib module of python 2 does not accept a preset dictionary (zdict), so the
+    (de)compressor is primed once with the dictionary and copied for every value: the
+    stored stream starts right after the dictionary and its back references reach it.
+    """
+
+    instances = dict()
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, version, level):
+        """Get the codec of a dictionary version and compression level"""
+        with cls.instances_lock:
+            if (version, level) not in cls.instances:
+                cls.instances[(version, level)] = cls(DICTIONARIES[version], level)
+            return cls.instances[(version, level)]
+
+    def __init__(self, dictionary, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        primer = self.compressor.compress(dictionary) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.decompressor.decompress(primer)
+
+    def compress(self, data):
+        compressor = self.compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = self.decompressor.copy()
+        return decompressor.decompress(data) + decompressor.flush()
+
+
+def isCompressed(value):
+    """Check if a stored value is compressed"""
+    if not isinstance(value, basestring) or not value.startswith("zd"):
+        return False
+    end = value.find(":", 2, 8)
+    return end > 2 and value[2:end] in DICTIONARIES
+
+
+def compress(value, config=None):
+    """Compress a JSON document to the stored text ("zd<version>:" + base64)
+
+    The value is returned as it is if it is already compressed, if it is short or
+    if the compression does not save space.
+
+    :param value: the JSON document
+    :type value: string
+    :rtype: string
+    """
+    config = config or getConfig()
+    if not isinstance(value, basestring) or isCompressed(value) or len(value) < config['MIN_SIZE']:
+        return value
+    data = value.encode("utf-8") if isinstance(value, unicode) else value
+    codec = Codec.get(DICTIONARY_VERSION, config['LEVEL'])
+    compressed = PREFIX % DICTIONARY_VERSION + base64.b64encode(codec.compress(data))
+    return compressed if len(compressed) < len(data) else value
+
+
+def decompress(value):
+    """Get the JSON document of a stored value (compressed or not)
+
+    :rtype: unicode
+    """
+    if not isCompressed(value):
+        return value
+    (prefix, data) = str(value).split(":", 1)
+    codec = Codec.get(prefix[2:], __defaults__['LEVEL'])
+    return codec.decompress(base64.b64decode(data)).decode("utf-8")
+
+
+class CompressedJSONDescriptor(object):
+    """Keep the stored value and decompress it on the first access"""
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__.get(self.field.attname)
+        if isCompressed(value):
+            value = instance.__dict__[self.field.attname] = decompress(value)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedJSONField(models.TextField):
+    """Text column that keeps a JSON document compressed with zlib
+
+    The column type is unchanged (TEXT), so the existing rows remain readable and
+    they are converted by the compress_json_columns command. The loaded value is
+    decompressed only when the attribute is accessed; querysets that read the
+    column with values()/values_list() get the stored text (see decompress).
+
+    Usage::
+        >>> class Sale(models.Model):
+        ...     json = CompressedJSONField()
+    """
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(CompressedJSONField, self).contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.attname, CompressedJSONDescriptor(self))
+
+    def pre_save(self, model_instance, add):
+        # an untouched value is saved as it is loaded, without decompression
+        return model_instance.__dict__.get(self.attname)
+
+    def get_prep_value(self, value):
+        value = super(CompressedJSONField, self).get_prep_value(value)
+        config = getConfig()
+        if config['ENABLED']:
+            return compress(value, config)
+        return value
+
+    def value_from_object(self, obj):
+        return getattr(obj, self.attname)
+
+    def deconstruct(self):
+        (name, path, args, kwargs) = super(CompressedJSONField, self).deconstruct()
+        return name, "api.fields.CompressedJSONField", args, kwargs
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import json
+import hashlib
+import logging
+import datetime
+import functools
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from api.models import IdempotencyKey
+from api.utilities import encodeDefault
+
+
+log = logging.getLogger(__name__)
+
+__defaults__ = {
+    'ENABLED': True,
+    'TTL': 86400,
+    'LEASE': 120,
+    'RETRY_AFTER': 1,
+    'MAX_KEY_LENGTH': 255,
+}
+
+# claims of a key before a request is answered as a duplicate in flight; a claim fails
+# only when another request takes the key or the stored entry vanishes meanwhile
+CLAIM_ATTEMPTS = 3
+
+
+def getConfig():
+    """Merge the IDEMPOTENCY settings with the default values"""
+    config = dict(__defaults__)
+    config.update(getattr(settings, 'IDEMPOTENCY', {}))
+    return config
+
+
+def getRequestId(request):
+    """Get the PayPal-Request-Id of a request that carries an Idempotency-Key
+
+    The id is the key of the request in the store: the hash of the endpoint, the
+    client and the user of the validated OpenAM token and the Idempotency-Key. All the retries
+    of a request send the same id to Paypal, even with a renewed Paypal token, and
+    Paypal creates the resource once.
+
+    :returns: the id or None if the request has no Idempotency-Key
+    :rtype: string
+    """
+    return getattr(request, "idempotency_request_id", None)
+
+
+def hashParts(*parts):
+    return hashlib.sha1("\0".join(unicode(part or "").encode("utf-8") for part in parts)).hexdigest()
+
+
+def claim(key, fingerprint, config):
+    """Claim a key for a request
+
+    An expired entry (a response older than TTL seconds or a claim older than LEASE
+    seconds, i.e. of a crashed process) is removed and claimed again. The claim does
+    not wait for a duplicate request in flight.
+
+    :param key: the hash of the endpoint, the client, the user and the Idempotency-Key
+    :type key: string
+    :param fingerprint: the hash of the request body
+    :type fingerprint: string
+    :returns: None if the key has been claimed, else the stored entry; its status is
+        None if the duplicate request is still in flight
+    :rtype: IdempotencyKey
+    """
+    for attempt in range(CLAIM_ATTEMPTS):
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                IdempotencyKey.objects.create(key=key, fingerprint=fingerprint, status=None, create_time=now,
+                                              expire_time=now + datetime.timedelta(seconds=config['LEASE']))
+            return None
+        except IntegrityError:
+            pass
+
+        stored = IdempotencyKey.objects.with_json().filter(key=key).first()
+        if stored is None:
+            continue
+        if stored.expire_time <= now:
+            IdempotencyKey.objects.filter(pk=stored.pk, expire_time=stored.expire_time).delete()
+            continue
+        return stored
+    return IdempotencyKey(key=key, fingerprint=fingerprint, status=None)
+
+
+def idempotent(endpoint, validate):
+    """Decorate the post method of a create view so that the requests with an
+    Idempotency-Key header are processed once
+
+    The headers are validated before the key is looked up, so only an authenticated
+    user gets a stored response. The keys are scoped to the endpoint and to the client
+    and the user of the validated OpenAM token; a token without them can not use an
+    Idempotency-Key (HTTP 400), since its requests would share a single key space.
+
+    The first request claims the key and its response is stored for TTL seconds; a
+    repeat gets the stored response (with an Idempotent-Replayed header) without a new
+    Paypal call or insertion. A duplicate that arrives while the first request is in
+    flight gets an HTTP 409 with a Retry-After header of RETRY_AFTER seconds.
+
+    Only the successful responses are stored; after an error the key is released and a
+    retry runs again, with the same PayPal-Request-Id (see getRequestId), so Paypal
+    does not create a second resource even if the first one was created.
+
+    Usage::
+        >>> class PaymentCreateApiView(APIView):
+        ...     @idempotent("payments/payment", validate=lambda request: validateHeaders(request))
+        ...     def post(self, request):
+        ...         pass
+
+    :param endpoint: the name of the endpoint in the key scope
+    :type endpoint: string
+    :param validate: the validation of the request headers; it returns the HTTP status
+        and the identity of the OpenAM token (see api.views.validateHeaders)
+    :type validate: function
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            config = getConfig()
+            idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY', None)
+            if not config['ENABLED'] or not idempotency_key:
+                return method(view, request, *args, **kwargs)
+            (headers_status, identity) = validate(request)
+            if int(headers_status) != 200:
+                return Response(data=identity, status=headers_status)
+            if len(idempotency_key) > config['MAX_KEY_LENGTH']:
+                return Response(data={"error": "Idempotency-Key is longer than %d characters" % config['MAX_KEY_LENGTH']},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            (client, user) = (identity.get("client_id"), identity.get("user"))
+            if not client or not user:
+                log.warn("An Idempotency-Key has been sent to %s with a token of no client or user" % endpoint)
+                return Response(data={"error": "Idempotency-Key requires an OPENAM_CLIENT_TOKEN of a user"},
+                                status=status.HTTP_400_BAD_REQUEST)
+            key = hashParts(endpoint, client, user, idempotency_key)
+            fingerprint = hashlib.sha1(json.dumps(request.data, sort_keys=True, default=encodeDefault)).hexdigest()
+            stored = claim(key, fingerprint, config)
+            if stored is not None:
+                if stored.fingerprint != fingerprint:
+                    return Response(data={"error": "Idempotency-Key has been used with a different payload"},
+                                    status=422)
+                if stored.status is None:
+                    response = Response(data={"error": "A request with the same Idempotency-Key is in progress"},
+                                        status=status.HTTP_409_CONFLICT)
+                    response["Retry-After"] = str(config['RETRY_AFTER'])
+                    return response
+                log.info("OpenAM client %s has repeated a request to %s; the stored response is returned" % (client, endpoint))
+                response = Response(data=json.loads(stored.response_json), status=stored.status)
+                response["Idempotent-Replayed"] = "true"
+                return response
+
+            request.idempotency_request_id = key
+            try:
+                response = method(view, request, *args, **kwargs)
+            except Exception:
+                IdempotencyKey.objects.filter(key=key).delete()
+                raise
+            if 200 <= int(response.status_code) < 300:
+                IdempotencyKey.objects.filter(key=key).update(
+                    status=response.status_code,
+                    response_json=json.dumps(response.data, default=encodeDefault),
+                    expire_time=timezone.now() + datetime.timedelta(seconds=config['TTL']))
+            else:
+                IdempotencyKey.objects.filter(key=key).delete()
+            return response
+        return wrapper
+    return decorator
+
+
+def purge():
+    """Remove the expired entries
+
+    :returns: the number of removed entries
+    :rtype: integer
+    """
+    expired = IdempotencyKey.objects.filter(expire_time__lte=timezone.now())
+    removed = expired.count()
+    expired.delete()
+    return removed
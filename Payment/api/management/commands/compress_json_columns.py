@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from django.apps import apps
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+
+from api import fields
+
+
+class Command(BaseCommand):
+    """Compress (or decompress) in place the JSON columns declared as CompressedJSONField
+
+    The rows are converted in chunks, one transaction per chunk, so the command can be
+    stopped and run again; converted rows are skipped.
+
+    Usage::
+        $ python manage.py compress_json_columns --chunk-size 1000
+        $ python manage.py compress_json_columns --decompress
+    """
+
+    help = "Compress the stored Paypal JSON documents in chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help="rows per transaction")
+        parser.add_argument('--decompress', action='store_true', default=False,
+                            help="restore the plain JSON documents (i.e. before disabling JSON_COMPRESSION)")
+
+    def handle(self, *args, **options):
+        config = fields.getConfig()
+        convert = fields.decompress if options['decompress'] else (lambda value: fields.compress(value, config))
+        for model in apps.get_app_config("api").get_models():
+            for field in model._meta.concrete_fields:
+                if isinstance(field, fields.CompressedJSONField):
+                    (rows, converted) = self.convert(model, field, convert, options['chunk_size'])
+                    self.stdout.write("%s.%s: %d of %d rows converted" % (model._meta.db_table, field.column, converted, rows))
+
+    def convert(self, model, field, convert, chunk_size):
+        """Convert the values of a column
+
+        :returns: the number of the rows and of the converted rows
+        :rtype: tuple(integer, integer)
+        """
+        statement = "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+            connection.ops.quote_name(model._meta.db_table),
+            connection.ops.quote_name(field.column),
+            connection.ops.quote_name(model._meta.pk.column)
+        )
+        (rows, converted, last) = (0, 0, None)
+        while True:
+            queryset = model.objects.order_by("pk")
+            if last is not None:
+                queryset = queryset.filter(pk__gt=last)
+            chunk = list(queryset.values_list("pk", field.attname)[:chunk_size])
+            if not chunk:
+                break
+            updates = []
+            for (pk, value) in chunk:
+                stored = convert(value)
+                if stored != value:
+                    updates.append((stored, pk))
+            if updates:
+                # written with SQL, since the field would compress the restored values again
+                with transaction.atomic():
+                    with connection.cursor() as cursor:
+                        cursor.executemany(statement, updates)
+            rows += len(chunk)
+            converted += len(updates)
+            last = chunk[-1][0]
+        return rows, converted
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+
+from api.models import Event
+
+
+class Command(BaseCommand):
+    """Collapse the duplicate webhook events, keeping the first stored copy of each event
+
+    Run it before the migration that adds the unique index on webhook_event.event_id.
+
+    Usage::
+        $ python manage.py dedupe_events --chunk-size 1000
+    """
+
+    help = "Remove the duplicate webhook events (same event_id)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help="event ids handled per transaction")
+
+    def handle(self, *args, **options):
+        duplicates = Event.objects.values('event_id').annotate(copies=Count('id'), first=Min('id')).filter(copies__gt=1)
+        duplicates = list(duplicates.values_list('event_id', 'first', 'copies'))
+
+        removed = 0
+        chunk_size = options['chunk_size']
+        for offset in range(0, len(duplicates), chunk_size):
+            chunk = duplicates[offset:offset + chunk_size]
+            with transaction.atomic():
+                for (event_id, first, copies) in chunk:
+                    Event.objects.filter(event_id=event_id).exclude(pk=first).delete()
+                    removed += copies - 1
+        self.stdout.write("%d duplicate events have been removed (%d event ids)" % (removed, len(duplicates)))
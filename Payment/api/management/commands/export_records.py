@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import export
+from api import utilities
+
+
+class Command(BaseCommand):
+    """Stream the payments, payment transactions, sales, refunds or captures of a client in NDJSON or CSV
+
+    Usage::
+        $ python manage.py export_records sales my-app --from 2017-09-01 --to 2017-10-01 --output csv > sales.csv
+    """
+
+    help = "Export the rows of a resource of a client in NDJSON or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('resource', choices=sorted(export.EXPORT_RESOURCES))
+        parser.add_argument('client_id', help="the client id of the application in OpenAM")
+        parser.add_argument('--from', dest='start', default=None, help="lower bound (inclusive) of the creation time")
+        parser.add_argument('--to', dest='end', default=None, help="upper bound (exclusive) of the creation time")
+        parser.add_argument('--output', choices=sorted(export.EXPORT_FORMATS), default="ndjson")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="rows per query")
+
+    def handle(self, *args, **options):
+        try:
+            start = utilities.parseDateTime(options['start']) if options['start'] else None
+            end = utilities.parseDateTime(options['end']) if options['end'] else None
+        except ValueError as ex:
+            raise CommandError(str(ex))
+
+        for line in export.exportRows(options['resource'], options['client_id'], start, end,
+                                      options['output'], options['chunk_size']):
+            self.stdout.write(line, ending='')
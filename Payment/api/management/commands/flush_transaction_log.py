@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from api import auditlog
+
+
+class Command(BaseCommand):
+    """Insert the transaction log entries left in the spool by stopped or crashed processes
+    (TRANSACTION_LOG['MODE'] = "buffered")
+
+    Only the segments older than --age seconds are inserted, so the segments that the
+    running processes still write to are not touched.
+
+    Usage::
+        $ python manage.py flush_transaction_log --age 60
+    """
+
+    help = "Insert the spooled transaction log entries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--age', type=int, default=None,
+                            help="seconds since the last write of a segment (default: RECOVERY_AGE)")
+
+    def handle(self, *args, **options):
+        recovered = auditlog.recover(age=options['age'])
+        self.stdout.write("%d transaction log entries have been inserted" % recovered)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import threading
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api import views
+from api.models import EventDeadLetter
+
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """Apply the webhook events queued by the WebHook view (WEBHOOK_INGEST['MODE'] = "queue")
+
+    Usage::
+        $ python manage.py process_webhook_events --workers 4
+        $ python manage.py process_webhook_events --once
+        $ python manage.py process_webhook_events --requeue-dead-letters
+    """
+
+    help = "Apply the queued Paypal webhook events"
+
+    poll_interval = 1
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help="number of worker threads")
+        parser.add_argument('--once', action='store_true', default=False, help="drain the available messages in a single thread and exit")
+        parser.add_argument('--requeue-dead-letters', action='store_true', default=False,
+                            help="move the dead letter events back to the queue and exit")
+
+    def handle(self, *args, **options):
+        config = views.getWebhookConfig()
+        queue = views.getEventQueue()
+
+        if options['requeue_dead_letters']:
+            count = self.requeueDeadLetters(queue)
+            self.stdout.write("%d dead letter events have been queued" % count)
+            return
+
+        stop = threading.Event()
+        if options['once']:
+            # drain the available messages in the current thread, i.e. from a cron job
+            self.work(queue, config, stop, True)
+            return
+
+        threads = []
+        for i in range(options['workers'] or config['WORKERS']):
+            thread = threading.Thread(target=self.work, args=(queue, config, stop, False))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(self.poll_interval)
+        except KeyboardInterrupt:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def work(self, queue, config, stop, once):
+        """Consume the queue until stop is set (or the queue is drained in once mode)"""
+        while not stop.is_set():
+            message = queue.claim(config['LEASE'])
+            if message is None:
+                if once:
+                    return
+                stop.wait(self.poll_interval)
+                continue
+            self.process(queue, config, *message)
+
+    def process(self, queue, config, message_id, raw, attempts):
+        """Apply a queued event; on failure retry it with exponential backoff or move it to the dead letters"""
+        payload = None
+        try:
+            payload = json.loads(raw)
+            (http_status, data) = views.ingestEvent(payload)
+            error = None if int(http_status) < 400 else json.dumps(data)
+        except Exception as ex:
+            log.error("Error in the webhook event of message %d: %s" % (message_id, str(ex)))
+            error = str(ex)
+        finally:
+            close_old_connections()
+
+        if error is None:
+            queue.ack(message_id)
+        elif attempts + 1 >= config['MAX_ATTEMPTS']:
+            self.deadLetter(raw, payload, attempts + 1, error)
+            queue.ack(message_id)
+        else:
+            queue.retry(message_id, config['RETRY_DELAY'] * 2 ** attempts, error)
+
+    def deadLetter(self, raw, payload, attempts, error):
+        """Keep an event that has exhausted its retries"""
+        payload = payload if isinstance(payload, dict) else {}
+        log.error("The webhook event with id=%s has been moved to the dead letters after %d attempts" % (payload.get("id"), attempts))
+        EventDeadLetter.objects.create(
+            event_id=payload.get("id"),
+            resource_type=payload.get("resource_type"),
+            event_type=payload.get("event_type"),
+            json=raw,
+            attempts=attempts,
+            error=error
+        )
+        close_old_connections()
+
+    def requeueDeadLetters(self, queue):
+        """Move the dead letter events back to the queue
+
+        :returns: the number of the queued events
+        :rtype: integer
+        """
+        count = 0
+        for letter in EventDeadLetter.objects.with_json().order_by("id"):
+            queue.put(letter.json, letter.event_id)
+            letter.delete()
+            count += 1
+        return count
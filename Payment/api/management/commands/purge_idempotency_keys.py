@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from api import idempotency
+
+
+class Command(BaseCommand):
+    """Remove the stored responses of the Idempotency-Key requests that have expired
+    (IDEMPOTENCY['TTL'])
+
+    Usage::
+        $ python manage.py purge_idempotency_keys
+    """
+
+    help = "Remove the expired idempotency keys"
+
+    def handle(self, *args, **options):
+        removed = idempotency.purge()
+        self.stdout.write("%d idempotency keys have been removed" % removed)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import json
+from django.core.management.base import BaseCommand, CommandError
+
+from api import views
+
+
+class Command(BaseCommand):
+    """Apply a backlog of Paypal webhook events from a file (JSON list or one event per line)
+
+    Usage::
+        $ python manage.py replay_webhook_events events.json --batch-size 500
+    """
+
+    help = "Apply a backlog of Paypal webhook events in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="JSON list of events or newline delimited JSON events")
+        parser.add_argument('--batch-size', type=int, default=None, help="events per transaction")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size'] or views.getWebhookConfig()['BATCH_SIZE']
+        with open(options['path']) as source:
+            content = source.read().strip()
+        try:
+            if content.startswith("["):
+                events = json.loads(content)
+            else:
+                events = [json.loads(line) for line in content.splitlines() if line.strip()]
+        except ValueError as ex:
+            raise CommandError("Invalid events file: %s" % str(ex))
+
+        failures = 0
+        for offset in range(0, len(events), batch_size):
+            for result in views.applyWebhookEvents(events[offset:offset + batch_size]):
+                if int(result["status"]) >= 400:
+                    failures += 1
+                    self.stderr.write("Event %s: HTTP status %d %s" % (result["id"], result["status"], result.get("error", "")))
+        self.stdout.write("%d events have been applied (%d failures)" % (len(events), failures))
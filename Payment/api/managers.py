@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+from django.db import connections, models, router, transaction, IntegrityError
+
+
+def getBlobFields(model):
+    """Get the names of the Paypal document columns of a model (see api.fields.CompressedJSONField)"""
+    from api.fields import CompressedJSONField
+    return [field.name for field in model._meta.concrete_fields if isinstance(field, CompressedJSONField)]
+
+
+class BlobDeferringQuerySet(models.QuerySet):
+    """QuerySet that loads the Paypal documents only on request"""
+
+    def with_json(self):
+        """Load the deferred document columns along with the rest of the row
+
+        Usage::
+            >>> Payment.objects.with_json().filter(client_id=client_id)
+        """
+        return self.defer(None)
+
+
+class BlobDeferringManager(models.Manager.from_queryset(BlobDeferringQuerySet)):
+    """Default manager that defers the Paypal document columns
+
+    Lookups and existence checks (i.e. in the webhook listener) read a few columns of a
+    row and never its document, which is the bulk of the row. A deferred column is
+    loaded with an extra query on first access, so the code that reads the documents
+    of many rows (reports, serializers) asks for them with with_json().
+
+    Usage::
+        >>> class Sale(models.Model):
+        ...     objects = BlobDeferringManager()
+    """
+
+    use_for_related_fields = True
+
+    def get_queryset(self):
+        queryset = super(BlobDeferringManager, self).get_queryset()
+        fields = getBlobFields(self.model)
+        return queryset.defer(*fields) if fields else queryset
+
+
+class PaypalResourceQuerySet(BlobDeferringQuerySet):
+    """QuerySet of the Paypal resources that are kept up to date by the webhook events"""
+
+    def upsert(self, instance, key):
+        """Insert a row or update the row having the same unique key, with a lookup and a write on MySQL
+
+        MySQL looks the stored row up and runs INSERT ... ON DUPLICATE KEY UPDATE if it
+        exists; a missing row is inserted with a plain INSERT in a savepoint, which fails
+        on the unique key if a concurrent insert wins and falls back to the update. So
+        the unique key alone tells an insert from an update, even for a rewrite of the
+        current values, which MySQL counts as one affected row like an insert
+        (CLIENT_FOUND_ROWS). The other backends update the row and insert it if it is
+        missing, retrying the update if a concurrent insert wins.
+
+        Usage::
+            >>> created = Sale.objects.upsert(buildSale(paypal_sale), "sale_id")
+
+        :param instance: the unsaved row
+        :type instance: django.db.models.Model
+        :param key: the name of the unique field
+        :type key: string
+        :returns: True if the row has been created; False if it has been updated
+        :rtype: bool
+        """
+        db = router.db_for_write(self.model, instance=instance)
+        fields = [field for field in self.model._meta.concrete_fields if not field.primary_key]
+        if connections[db].vendor == "mysql":
+            if not self.filter(**{key: getattr(instance, key)}).exists():
+                try:
+                    with transaction.atomic(using=db):
+                        instance.save(using=db, force_insert=True)
+                    return True
+                except IntegrityError:
+                    pass
+            self.upsertMysql(instance, key, fields, connections[db])
+            return False
+
+        values = dict((field.attname, getattr(instance, field.attname)) for field in fields if field.name != key)
+        with transaction.atomic(using=db):
+            if self.filter(**{key: getattr(instance, key)}).update(**values):
+                return False
+            try:
+                with transaction.atomic(using=db):
+                    instance.save(using=db, force_insert=True)
+                return True
+            except IntegrityError:
+                if self.filter(**{key: getattr(instance, key)}).update(**values):
+                    return False
+                raise
+
+    def upsertMysql(self, instance, key, fields, connection):
+        """Write the row with a single INSERT ... ON DUPLICATE KEY UPDATE statement"""
+        quote = connection.ops.quote_name
+        pk = quote(self.model._meta.pk.column)
+        columns = [quote(field.column) for field in fields]
+        statement = "INSERT INTO %s (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s = LAST_INSERT_ID(%s), %s" % (
+            quote(self.model._meta.db_table),
+            ", ".join(columns),
+            ", ".join(["%s"] * len(columns)),
+            pk, pk,
+            ", ".join("%s = VALUES(%s)" % (column, column) for (field, column) in zip(fields, columns) if field.name != key)
+        )
+        values = [field.get_db_prep_save(field.pre_save(instance, True), connection) for field in fields]
+        with connection.cursor() as cursor:
+            cursor.execute(statement, values)
+            # LAST_INSERT_ID(id) returns the id of the updated row too
+            instance.pk = cursor.lastrowid
+
+
+class PaypalResourceManager(BlobDeferringManager.from_queryset(PaypalResourceQuerySet)):
+    """Default manager of the sales, authorizations, captures and refunds (see upsert)"""
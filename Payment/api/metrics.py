@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import functools
+import contextlib
+from django.conf import settings
+
+from api import resilience
+
+
+__defaults__ = {
+    'ENABLED': True,
+    'BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'ALLOWED_ADDRESSES': ('127.0.0.1', '::1'),
+}
+
+# the total duration of a request and the components of its breakdown; the validation
+# span includes the OpenAM and the Paypal calls of the headers validation
+TOTAL = "total"
+COMPONENTS = ["validation", "openam", "paypal", "db", "serialization"]
+
+REQUEST_DURATION = "payment_api_request_duration_seconds"
+
+BREAKER_STATES = [resilience.CLOSED, resilience.HALF_OPEN, resilience.OPEN]
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+__local__ = threading.local()
+
+
+def getConfig():
+    """Merge the METRICS settings with the default values"""
+    config = dict(__defaults__)
+    config.update(getattr(settings, 'METRICS', {}))
+    return config
+
+
+class RequestContext(object):
+    """The timings of the request that the current thread serves"""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.endpoint = None
+        self.started = time.time()
+        self.timings = dict()
+        self.lock = threading.Lock()
+
+    def add(self, component, seconds):
+        with self.lock:
+            self.timings[component] = self.timings.get(component, 0.0) + seconds
+
+
+def getContext():
+    """Get the context of the request that the current thread serves (or None)
+
+    :rtype: RequestContext
+    """
+    return getattr(__local__, "context", None)
+
+
+def start(request_id):
+    """Start the timings of a request in the current thread
+
+    :param request_id: the id of the request; it is kept as the exemplar of its observations
+    :type request_id: string
+    :rtype: RequestContext
+    """
+    (__local__.context, __local__.active) = (RequestContext(request_id), set())
+    return __local__.context
+
+
+def stop():
+    """Stop the timings of the request of the current thread
+
+    :returns: the context of the request or None
+    :rtype: RequestContext
+    """
+    context = getContext()
+    (__local__.context, __local__.active) = (None, set())
+    return context
+
+
+@contextlib.contextmanager
+def span(component):
+    """Add the duration of a block to a component of the current request
+
+    A span nested in a span of the same component is not counted twice; outside of a
+    request the block runs without timing.
+
+    Usage::
+        >>> from api import metrics
+        >>> with metrics.span("db"):
+        ...     pass
+    """
+    context = getContext()
+    active = getattr(__local__, "active", set())
+    if context is None or component in active:
+        yield
+        return
+    active.add(component)
+    started = time.time()
+    try:
+        yield
+    finally:
+        context.add(component, time.time() - started)
+        active.discard(component)
+
+
+def timed(component):
+    """Decorate a function so that its calls are spans of a component
+
+    Usage::
+        >>> @timed("db")
+        ... def insertPayment(client_id, payload, approval_url, paypal_payment):
+        ...     pass
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(component):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(function):
+    """Bind a function to the request of the current thread, so that the spans of a
+    pool thread that runs it count on the request
+
+    :rtype: function
+    """
+    context = getContext()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        (previous, previous_active) = (getContext(), getattr(__local__, "active", set()))
+        (__local__.context, __local__.active) = (context, set())
+        try:
+            return function(*args, **kwargs)
+        finally:
+            (__local__.context, __local__.active) = (previous, previous_active)
+    return wrapper
+
+
+class Histogram(object):
+    """Histogram of the observations of a metric per label values, with the last
+    observation of every bucket kept as its exemplar
+
+    Usage::
+        >>> from api.metrics import Histogram
+        >>> histogram = Histogram.get("payment_api_request_duration_seconds", "Duration", ("endpoint", "component"))
+        >>> histogram.observe(("create_payment", "paypal"), 0.42, "b9e2c1d0")
+    """
+
+    instances = dict()
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, name, documentation, label_names, buckets=None):
+        """Get the histogram of a metric (one instance per name)
+
+        :rtype: Histogram
+        """
+        with cls.instances_lock:
+            if name not in cls.instances:
+                cls.instances[name] = cls(name, documentation, label_names, buckets or getConfig()['BUCKETS'])
+            return cls.instances[name]
+
+    def __init__(self, name, documentation, label_names, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = sorted(float(bucket) for bucket in buckets) + [float("inf")]
+        self.lock = threading.Lock()
+        # label values: [bucket counts, sum, bucket exemplars]
+        self.series = dict()
+
+    def observe(self, label_values, value, exemplar=None):
+        """Add an observation
+
+        :param label_values: the values of the labels, in the order of the label names
+        :type label_values: tuple
+        :param value: i.e. a duration in seconds
+        :type value: float
+        :param exemplar: the id of the request of the observation
+        :type exemplar: string
+        """
+        with self.lock:
+            if label_values not in self.series:
+                self.series[label_values] = [[0] * len(self.buckets), 0.0, [None] * len(self.buckets)]
+            (counts, _, exemplars) = series = self.series[label_values]
+            series[1] += value
+            index = next(i for (i, bound) in enumerate(self.buckets) if value <= bound)
+            counts[index] += 1
+            if exemplar is not None:
+                exemplars[index] = (exemplar, value, time.time())
+
+    def expose(self, openmetrics=False):
+        """Get the lines of the histogram in the Prometheus text format, or in the
+        OpenMetrics format along with the exemplars
+
+        :rtype: list
+        """
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            series = sorted((label_values, list(counts), total, list(exemplars))
+                            for (label_values, (counts, total, exemplars)) in self.series.items())
+        for (label_values, counts, total, exemplars) in series:
+            labels = ",".join('%s="%s"' % (name, escape(value)) for (name, value) in zip(self.label_names, label_values))
+            cumulative = 0
+            for (bound, count, exemplar) in zip(self.buckets, counts, exemplars):
+                cumulative += count
+                line = '%s_bucket{%s,le="%s"} %d' % (self.name, labels, formatBound(bound), cumulative)
+                if openmetrics and exemplar is not None:
+                    line += ' # {request_id="%s"} %s %.3f' % (escape(exemplar[0]), repr(exemplar[1]), exemplar[2])
+                lines.append(line)
+            lines.append("%s_sum{%s} %s" % (self.name, labels, repr(total)))
+            lines.append("%s_count{%s} %d" % (self.name, labels, cumulative))
+        return lines
+
+
+def escape(value):
+    return unicode(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def formatBound(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def getRequestDuration():
+    """Get the histogram of the request durations per endpoint and component
+
+    :rtype: Histogram
+    """
+    return Histogram.get(REQUEST_DURATION, "Duration of the API requests and of their OpenAM, Paypal, database "
+                         "and serialization parts", ("endpoint", "component"))
+
+
+def observe(context):
+    """Add the total duration and the breakdown of a finished request to the histogram"""
+    histogram = getRequestDuration()
+    histogram.observe((context.endpoint, TOTAL), time.time() - context.started, context.request_id)
+    for component in COMPONENTS:
+        if component in context.timings:
+            histogram.observe((context.endpoint, component), context.timings[component], context.request_id)
+
+
+def exposeFamily(name, metric_type, documentation, samples, openmetrics=False):
+    """Get the lines of a gauge or a counter
+
+    :param name: the name of the metric; a counter's samples get the _total suffix
+    :type name: string
+    :param metric_type: gauge or counter
+    :type metric_type: string
+    :param samples: (labels, value) pairs, with the labels as (name, value) pairs
+    :type samples: list
+    :rtype: list
+    """
+    suffix = "_total" if metric_type == "counter" else ""
+    family = name if openmetrics else name + suffix
+    lines = ["# HELP %s %s" % (family, documentation), "# TYPE %s %s" % (family, metric_type)]
+    for (labels, value) in samples:
+        labels = ",".join('%s="%s"' % (label, escape(label_value)) for (label, label_value) in labels)
+        lines.append("%s%s{%s} %s" % (name, suffix, labels, repr(value)))
+    return lines
+
+
+def exposeUpstreams(openmetrics=False):
+    """Get the lines of the state of the circuit breakers and the bulkheads of the
+    process (see api.resilience)
+
+    :rtype: list
+    """
+    state = resilience.stats()
+    breakers = sorted(state["breakers"].items())
+    bulkheads = sorted(state["bulkheads"].items())
+    families = [
+        ("payment_api_circuit_breaker_state", "gauge", "State of the circuit breaker of an upstream",
+         [((("upstream", name), ("state", breaker_state)), int(stats["state"] == breaker_state))
+          for (name, stats) in breakers for breaker_state in BREAKER_STATES]),
+        ("payment_api_circuit_breaker_failure_rate", "gauge", "Failed share of the calls of the breaker window",
+         [((("upstream", name),), stats["failure_rate"]) for (name, stats) in breakers]),
+        ("payment_api_circuit_breaker_rejected", "counter", "Calls rejected by the circuit breaker",
+         [((("upstream", name),), stats["rejected"]) for (name, stats) in breakers]),
+        ("payment_api_circuit_breaker_opened", "counter", "Times the circuit breaker has opened",
+         [((("upstream", name),), stats["opened"]) for (name, stats) in breakers]),
+        ("payment_api_bulkhead_active", "gauge", "Calls in flight through the bulkhead of an upstream endpoint class",
+         [((("bulkhead", name),), stats["active"]) for (name, stats) in bulkheads]),
+        ("payment_api_bulkhead_limit", "gauge", "Concurrent calls admitted by the bulkhead",
+         [((("bulkhead", name),), stats["limit"]) for (name, stats) in bulkheads]),
+        ("payment_api_bulkhead_rejected", "counter", "Calls rejected by the full bulkhead",
+         [((("bulkhead", name),), stats["rejected"]) for (name, stats) in bulkheads]),
+    ]
+    lines = []
+    for (name, metric_type, documentation, samples) in families:
+        if samples:
+            lines.extend(exposeFamily(name, metric_type, documentation, samples, openmetrics))
+    return lines
+
+
+def expose(openmetrics=False):
+    """Get the metrics of the process in the Prometheus text or the OpenMetrics format
+
+    :returns: the body and its content type
+    :rtype: tuple(string, string)
+    """
+    with Histogram.instances_lock:
+        histograms = sorted(Histogram.instances.items())
+    lines = []
+    for (_, histogram) in histograms:
+        lines.extend(histogram.expose(openmetrics))
+    lines.extend(exposeUpstreams(openmetrics))
+    if openmetrics:
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n", OPENMETRICS_CONTENT_TYPE
+    return "\n".join(lines) + "\n", PROMETHEUS_CONTENT_TYPE
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import re
+import uuid
+
+from api import metrics
+
+
+REQUEST_ID = re.compile(r"^[A-Za-z0-9\-_.:]{1,64}$")
+
+
+class TimingMiddleware(object):
+    """Time every request and its OpenAM, Paypal, database and serialization spans
+    (see api.metrics)
+
+    The request id is the X-Request-Id header of the client, or a new one; it is
+    returned in the X-Request-Id header of the response and it is kept as the exemplar
+    of the observations. The breakdown of the request is also returned in a
+    Server-Timing header. The requests that match no URL are not observed.
+
+    Usage::
+        >>> MIDDLEWARE_CLASSES = (
+        ...     'api.middleware.TimingMiddleware',
+        ... )
+    """
+
+    def process_request(self, request):
+        if not metrics.getConfig()['ENABLED']:
+            return None
+        request_id = request.META.get('HTTP_X_REQUEST_ID', "")
+        if not REQUEST_ID.match(request_id):
+            request_id = uuid.uuid4().hex
+        request.request_id = request_id
+        metrics.start(request_id)
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        context = metrics.getContext()
+        if context is not None and request.resolver_match is not None:
+            context.endpoint = request.resolver_match.url_name
+        return None
+
+    def process_response(self, request, response):
+        context = metrics.stop()
+        if context is None:
+            return response
+        if context.endpoint is not None:
+            metrics.observe(context)
+        response['X-Request-Id'] = context.request_id
+        response['Server-Timing'] = ", ".join("%s;dur=%.1f" % (component, context.timings[component] * 1000)
+                                              for component in metrics.COMPONENTS if component in context.timings)
+        return response
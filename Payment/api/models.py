@@ -3,6 +3,9 @@
 from django.db import models
 from django.utils.translation import ugettext as _
 
+from api.fields import CompressedJSONField
+from api.managers import BlobDeferringManager, PaypalResourceManager
+
 
 RESOURCE_TYPES = [
     "agreement", # !Agreement
@@ -116,12 +119,14 @@ class Event(models.Model):
     """
     Keep the webhook events
     """
-    event_id = models.CharField(max_length=64, null=False, blank=False)
+    event_id = models.CharField(max_length=64, null=False, blank=False, unique=True)
     resource_type = models.CharField(max_length=32, null=False, blank=False)
     event_type = models.CharField(max_length=80, null=False, blank=False)
-    json = models.TextField()
+    json = CompressedJSONField()
     create_date = models.DateTimeField(auto_now_add=True)
 
+    objects = BlobDeferringManager()
+
     class Meta :
         db_table = "webhook_event"
         verbose_name = _("Event")
@@ -132,6 +137,30 @@ class Event(models.Model):
         return "%d (%d - %d)" % (self.event_id, self.resource_type, self.event_type)
 
 
+class EventDeadLetter(models.Model):
+    """
+    Keep the webhook events that could not be applied after all the retries
+    """
+    event_id = models.CharField(max_length=64, null=True, blank=True)
+    resource_type = models.CharField(max_length=32, null=True, blank=True)
+    event_type = models.CharField(max_length=80, null=True, blank=True)
+    json = CompressedJSONField()
+    attempts = models.IntegerField()
+    error = models.TextField(null=True, blank=True)
+    create_date = models.DateTimeField(auto_now_add=True)
+
+    objects = BlobDeferringManager()
+
+    class Meta :
+        db_table = "webhook_event_dead_letter"
+        verbose_name = _("Dead Letter Event")
+        verbose_name_plural = _("Dead Letter Events")
+
+    def __unicode__(self):
+        """ Get the title """
+        return "%s (%s attempts)" % (self.event_id, self.attempts)
+
+
 class BillingPlan(models.Model):
     """
     Keep the billing plans
@@ -147,12 +176,15 @@ class BillingPlan(models.Model):
     return_url = models.URLField(max_length=1000, null=False, blank=False)
     cancel_url = models.URLField(max_length=1000, null=False, blank=False)
     notify_url = models.URLField(max_length=1000, null=True, blank=True, help_text="reserved for future usage")
-    json = models.TextField()
+    json = CompressedJSONField()
     create_time = models.DateTimeField()
     update_time = models.DateTimeField()
+
+    objects = BlobDeferringManager()
     
     class Meta :
         db_table = "billing_plan"
+        index_together = [("client_id", "create_time")]
         verbose_name = _("Billing Plan")
         verbose_name_plural = _("Billing Plans")
 
@@ -166,7 +198,7 @@ class BillingPlanPaymentDefinition(models.Model):
     Keep the payment definition included in a billing plan
     """
     billing_plan = models.ForeignKey(BillingPlan, on_delete=models.CASCADE)
-    definition_id = models.CharField(max_length=128, null=False, blank=False)
+    definition_id = models.CharField(max_length=128, null=False, blank=False, db_index=True)
     name = models.CharField(max_length=128, null=False, blank=False)
     type = models.CharField(max_length=10, null=False, blank=False)
     frequency = models.CharField(max_length=10, null=False, blank=False, help_text="BILLING_PLAN_FREQUENCY")
@@ -175,7 +207,9 @@ class BillingPlanPaymentDefinition(models.Model):
     charge_models = models.CharField(max_length=255, null=False, blank=False)
     amount_value = models.DecimalField(max_digits=12, decimal_places=4, help_text="payment_definitions[i].charge_models[j].amount.total")
     amount_currency = models.CharField(max_length=8, null=False, blank=False, help_text="payment_definitions[i].charge_models[j].amount.currency")
-    json = models.TextField()
+    json = CompressedJSONField()
+
+    objects = BlobDeferringManager()
     
     class Meta :
         db_table = "billing_plan_payment_definition"
@@ -193,7 +227,7 @@ class BillingAgreement(models.Model):
     """
     client_id = models.CharField(max_length=128, null=False, blank=False, help_text="username of the application in OpenAM")
     agreement_id = models.CharField(max_length=128, null=True, blank=True, unique=True, help_text="resource.id")
-    payment_token = models.CharField(max_length=128, null=False, blank=False, help_text="EC-xxxx")
+    payment_token = models.CharField(max_length=128, null=False, blank=False, db_index=True, help_text="EC-xxxx")
     name = models.CharField(max_length=128, null=False, blank=False)
     description = models.CharField(max_length=128, null=False, blank=False)
     state = models.CharField(max_length=128, null=True, blank=True, help_text="resource.state")
@@ -205,11 +239,14 @@ class BillingAgreement(models.Model):
     num_cycles_completed = models.IntegerField(null=True, blank=True,)
     num_cycles_remaining = models.IntegerField(null=True, blank=True,)
     failed_payment_count = models.IntegerField(null=True, blank=True,)
-    json = models.TextField()
+    json = CompressedJSONField()
     start_date = models.DateTimeField()
+
+    objects = BlobDeferringManager()
     
     class Meta :
         db_table = "billing_agreement"
+        index_together = [("client_id", "start_date")]
         verbose_name = _("Billing Agreement")
         verbose_name_plural = _("Billing Agreements")
 
@@ -225,7 +262,7 @@ class Payment(models.Model):
         3. order
     """
     client_id = models.CharField(max_length=128, null=False, blank=False, help_text="username of the application in OpenAM")
-    pay_id = models.CharField(max_length=128, null=False, help_text="id from paypal api, PAY-xxx")
+    pay_id = models.CharField(max_length=128, null=False, db_index=True, help_text="id from paypal api, PAY-xxx")
     intent = models.CharField(max_length=16, null=False, blank=False)
     state = models.CharField(max_length=10, null=False, blank=False)
     payment_method = models.CharField(max_length=64, null=False, blank=False, default="paypal")
@@ -233,12 +270,16 @@ class Payment(models.Model):
     approval_url = models.URLField(max_length=400, null=True, blank=True, help_text="application oriented")
     return_url = models.URLField(max_length=400, null=False, blank=False)
     cancel_url = models.URLField(max_length=400, null=False, blank=False)
-    json = models.TextField()
+    json = CompressedJSONField()
     create_time = models.DateTimeField()
     update_time = models.DateTimeField()
+    sync_time = models.DateTimeField(null=True, default=None, help_text="last copy of the Paypal payment (json)")
+
+    objects = BlobDeferringManager()
 
     class Meta :
         db_table = "payment"
+        index_together = [("client_id", "create_time")]
         verbose_name = _("Payment")
         verbose_name_plural = _("Payments")
 
@@ -260,7 +301,9 @@ class PaymentTransaction(models.Model):
     invoice_number = models.CharField(max_length=127, null=True, blank=True)
     soft_descriptor = models.CharField(max_length=22, null=True, blank=True)
     item_list = models.TextField(max_length=500)
-    json = models.TextField(max_length=2000)
+    json = CompressedJSONField(max_length=2000)
+
+    objects = BlobDeferringManager()
 
     class Meta :
         db_table = "payment_transaction"
@@ -283,16 +326,18 @@ class Sale(models.Model):
     state = models.CharField(max_length=32, null=False, blank=False)
     transaction_value = models.DecimalField(max_digits=12, decimal_places=4, null=True, help_text="resource.transaction_fee.value")
     transaction_currency = models.CharField(max_length=8, null=True, blank=False, help_text="resource.transaction_fee.currency")
-    billing_agreement_id = models.CharField(max_length=128, null=True, default=None)
+    billing_agreement_id = models.CharField(max_length=128, null=True, default=None, db_index=True)
     payment_mode = models.CharField(max_length=32, null=True, default=None)
-    parent_payment = models.CharField(max_length=128, null=True, default=None)
+    parent_payment = models.CharField(max_length=128, null=True, default=None, db_index=True)
     reason_code = models.CharField(max_length=128, null=True, default=None)
     protection_eligibility = models.CharField(max_length=32, null=True, default=None)
     protection_eligibility_type = models.CharField(max_length=128, null=True, default=None)
-    json = models.TextField()
+    json = CompressedJSONField()
     create_time = models.DateTimeField()
     update_time = models.DateTimeField()
 
+    objects = PaypalResourceManager()
+
     class Meta :
         db_table = "sale"
         verbose_name = _("Sale")
@@ -317,15 +362,17 @@ class Authorization(models.Model):
     transaction_value = models.DecimalField(max_digits=12, decimal_places=4, null=True, blank=True, help_text="resource.transaction_fee.value")
     transaction_currency = models.CharField(max_length=8, null=True, blank=True, help_text="resource.transaction_fee.currency")
     payment_mode = models.CharField(max_length=32, null=True, blank=True, default=None)
-    parent_payment = models.CharField(max_length=128, null=True, blank=True, default=None)
+    parent_payment = models.CharField(max_length=128, null=True, blank=True, default=None, db_index=True)
     reason_code = models.CharField(max_length=128, null=True, default=None)
     protection_eligibility = models.CharField(max_length=32, null=True, default=None)
     protection_eligibility_type = models.CharField(max_length=128, null=True, default=None)
-    json = models.TextField()
+    json = CompressedJSONField()
     valid_until = models.DateTimeField()
     create_time = models.DateTimeField()
     update_time = models.DateTimeField()
 
+    objects = PaypalResourceManager()
+
     class Meta :
         db_table = "authorization"
         verbose_name = _("Authorization")
@@ -345,13 +392,15 @@ class Capture(models.Model):
     is_final_capture = models.BooleanField(blank=False, null=False)
     state = models.CharField(max_length=32, null=False, blank=False)
     reason_code = models.CharField(max_length=128, blank=True, null=True)
-    parent_payment = models.CharField(max_length=128, null=False, blank=False)
+    parent_payment = models.CharField(max_length=128, null=False, blank=False, db_index=True)
     transaction_fee_value = models.DecimalField(max_digits=12, decimal_places=4)
     transaction_fee_currency =  models.CharField(max_length=8, null=False, blank=False)
-    json = models.TextField()
+    json = CompressedJSONField()
     create_time = models.DateTimeField()
     update_time = models.DateTimeField()
 
+    objects = PaypalResourceManager()
+
     class Meta :
         db_table = "capture"
         verbose_name = _("Capture")
@@ -367,20 +416,22 @@ class Refund(models.Model):
     """
 
     refund_id = models.CharField(max_length=32, null=False, blank=False, unique=True, help_text="resource.id")
-    sale_id = models.CharField(max_length=96, null=True, blank=False, help_text="resource<sale>.id")
-    capture_id = models.CharField(max_length=96, null=True, blank=False, help_text="resource<capture>.id")
+    sale_id = models.CharField(max_length=96, null=True, blank=False, db_index=True, help_text="resource<sale>.id")
+    capture_id = models.CharField(max_length=96, null=True, blank=False, db_index=True, help_text="resource<capture>.id")
     description = models.TextField(max_length=1000, null=True)
     amount_value = models.DecimalField(max_digits=12, decimal_places=4, help_text="resource.amount.total")
     amount_currency = models.CharField(max_length=8, null=False, blank=False, help_text="resource.amount.currency")
     state = models.CharField(max_length=32, null=False, blank=False)
     reason = models.CharField(max_length=255, null=True)
-    parent_payment = models.CharField(max_length=128, null=True)
+    parent_payment = models.CharField(max_length=128, null=True, db_index=True)
     invoice_number = models.CharField(max_length=128, null=True, blank=False, help_text="resource.invoice_number")
     custom = models.CharField(max_length=255, null=True)
-    json = models.TextField()
+    json = CompressedJSONField()
     create_time = models.DateTimeField()
     update_time = models.DateTimeField()
 
+    objects = PaypalResourceManager()
+
 
     class Meta :
         db_table = "refund"
@@ -397,13 +448,15 @@ class Refund(models.Model):
 
 class PaymentTransactionLog(models.Model):
 
-    payment_id = models.CharField(max_length=96, null=False, blank=False, help_text="payment id")
+    payment_id = models.CharField(max_length=96, null=False, blank=False, db_index=True, help_text="payment id")
     transaction_type = models.CharField(max_length=45, null=False, blank=False, help_text="transaction type")
-    request_json = models.TextField(null=True)
-    response_json = models.TextField(null=True)
+    request_json = CompressedJSONField(null=True)
+    response_json = CompressedJSONField(null=True)
     create_time = models.DateTimeField()
     update_time = models.DateTimeField()
 
+    objects = BlobDeferringManager()
+
     class Meta :
         db_table = "payment_transaction_log"
         verbose_name = _("PaymentTransactionLog")
@@ -412,3 +465,24 @@ class PaymentTransactionLog(models.Model):
     def __unicode__(self):
         return "%s - %s" % (self.payment_id, transaction.type)
 
+
+class IdempotencyKey(models.Model):
+    """
+    Keep the first response of the create requests that carry an Idempotency-Key header
+    """
+    key = models.CharField(max_length=40, unique=True, help_text="sha1 of the endpoint, the OpenAM client and user and the Idempotency-Key")
+    fingerprint = models.CharField(max_length=40, help_text="sha1 of the request body")
+    status = models.IntegerField(null=True, help_text="HTTP status of the response; empty while the request is in flight")
+    response_json = CompressedJSONField(null=True)
+    create_time = models.DateTimeField()
+    expire_time = models.DateTimeField(db_index=True)
+
+    objects = BlobDeferringManager()
+
+    class Meta :
+        db_table = "idempotency_key"
+        verbose_name = _("Idempotency Key")
+        verbose_name_plural = _("Idempotency Keys")
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.key, self.status)
@@ -1,11 +1,59 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import json
 import httplib
 import urllib
 from traceback import print_exc
 from django.conf import settings
 
+from api import metrics
+from api.cache import createCache, hashKey
+from api.resilience import guarded
+
+
+__cache_defaults__ = {
+    "ENABLED": True,
+    "MAX_ENTRIES": 10000,
+    "MAX_TTL": 300,
+    "NEGATIVE_TTL": 30,
+    "BACKEND": None,
+}
+
+
+# tokeninfo attributes that identify the user, in order of preference
+USER_ATTRIBUTES = ["sub", "uid", "user_id", "mail"]
+
+
+def getCacheConfig():
+    """Merge the OPENAM_TOKEN_CACHE settings with the default values"""
+    config = dict(__cache_defaults__)
+    config.update(getattr(settings, "OPENAM_TOKEN_CACHE", {}))
+    return config
+
+
+def getIdentity(tokeninfo):
+    """Get the OpenAM client and the user that an access token has been issued to
+
+    Usage::
+        >>> from api.openam import getIdentity
+        >>> getIdentity('{"client_id": "client-1", "sub": "demo", "expires_in": 3600}')
+        {'client_id': 'client-1', 'user': 'demo'}
+
+    :param tokeninfo: the tokeninfo response of OpenAM (JSON)
+    :type tokeninfo: string
+    :returns: the client_id and the user; None where the tokeninfo lacks them
+    :rtype: dictionary
+    """
+    try:
+        info = json.loads(tokeninfo)
+    except (TypeError, ValueError):
+        info = None
+    if not isinstance(info, dict):
+        return {"client_id": None, "user": None}
+    user = next((info[attribute] for attribute in USER_ATTRIBUTES if info.get(attribute)), None)
+    return {"client_id": info.get("client_id"), "user": user}
+
 
 class OpenamAuth(object):
     """description of class"""
@@ -14,13 +62,86 @@ class OpenamAuth(object):
         "check_access_token":   "/openam/oauth2/tokeninfo",
     }
 
+    # the tokeninfo responses, shared by all the instances of the process
+    cache = None
+
 
     def __init__(self):
         """ Class constructor """
         pass
 
 
+    @classmethod
+    def getCache(cls):
+        """Get (or create on first use) the cache of the tokeninfo responses
+
+        :returns: the cache
+        :rtype: api.cache.TTLCache
+        """
+        if cls.cache is None:
+            cls.cache = createCache(getCacheConfig())
+        return cls.cache
+
+
+    @metrics.timed("openam")
     def validateAccessToken(self, accessToken):
+        """Validate the access token of a user in OpenAM
+
+        The tokeninfo response is cached until the token expires (bounded by
+        OPENAM_TOKEN_CACHE['MAX_TTL']), while the rejected tokens (HTTP 401) are
+        cached for OPENAM_TOKEN_CACHE['NEGATIVE_TTL'] seconds.
+
+        :param accessToken: the access token of the user
+        :type accessToken: string
+        :returns: the HTTP status and the response body
+        :rtype: tuple(integer, string)
+        """
+        config = getCacheConfig()
+        if not config["ENABLED"]:
+            return self.getTokenInfo(accessToken)
+
+        cache = OpenamAuth.getCache()
+        key = hashKey("openam", accessToken)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+        status, response = self.getTokenInfo(accessToken)
+        ttl = self.getCacheTimeout(status, response, config)
+        if ttl > 0:
+            cache.set(key, (status, response), ttl)
+        return status, response
+
+
+    def getCacheTimeout(self, status, response, config):
+        """Get for how many seconds a tokeninfo response can be cached
+
+        :returns: the timeout in seconds or 0 if the response must not be cached
+        :rtype: integer
+        """
+        try:
+            if int(status) == 401:
+                return config["NEGATIVE_TTL"]
+            if int(status) == 200:
+                expires_in = int(json.loads(response).get("expires_in", 0))
+                return max(0, min(expires_in, config["MAX_TTL"]))
+        except (ValueError, TypeError, AttributeError):
+            pass
+        return 0
+
+
+    @guarded("openam", "tokeninfo", text=True)
+    def getTokenInfo(self, accessToken):
+        """Retrieve the tokeninfo of an access token from OpenAM
+
+        The call is bounded by OAUTH_TIMEOUT seconds and it runs through the circuit
+        breaker of OpenAM (see api.resilience).
+
+        :param accessToken: the access token of the user
+        :type accessToken: string
+        :returns: the HTTP status and the response body
+        :rtype: tuple(integer, string)
+        """
         try:
             endpoint = OpenamAuth.urls['check_access_token']
             endpoint += "?access_token=" + str(accessToken)
@@ -29,11 +150,14 @@ class OpenamAuth(object):
                 "Accept": "application/json",
                 "Content-Type": "application/json"
             }
-            
-            connection = httplib.HTTPConnection(settings.OAUTH_SERVER)
-            connection.request("GET", endpoint, None, headers)
-            response = connection.getresponse()
-            return response.status, response.read()
+
+            connection = httplib.HTTPConnection(settings.OAUTH_SERVER, timeout=getattr(settings, "OAUTH_TIMEOUT", 10))
+            try:
+                connection.request("GET", endpoint, None, headers)
+                response = connection.getresponse()
+                return response.status, response.read()
+            finally:
+                connection.close()
         except Exception, e:
             print_exc()
             return 500, str(e)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import base64
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Keyset (seek) pagination on (<view.keyset_field>, id), newest first
+
+    A page is selected with "WHERE (field, id) < (cursor)" instead of an OFFSET,
+    so any page costs the same as the first one given an index that ends in
+    (field, id). The cursor of the next page is returned in the "next" link.
+
+    Usage::
+        >>> class PaymentsRetrieveApiView(generics.ListAPIView):
+        ...     pagination_class = KeysetPagination
+        ...     keyset_field = "create_time"
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """Get the rows of the requested page
+
+        :returns: the rows of the page
+        :rtype: list
+        """
+        self.request = request
+        self.field = getattr(view, "keyset_field", "create_time")
+        self.page_size = self.getPageSize(request)
+
+        cursor = self.decodeCursor(request.query_params.get(self.cursor_query_param))
+        if cursor is not None:
+            (value, pk) = cursor
+            queryset = queryset.filter(Q(**{self.field + "__lt": value}) | Q(**{self.field: value, "pk__lt": pk}))
+
+        rows = list(queryset.order_by("-" + self.field, "-pk")[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        self.last = rows[-1] if rows else None
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.getNextLink()),
+            ("results", data)
+        ]))
+
+    def getPageSize(self, request):
+        """Get the page size from the query parameters (bounded by max_page_size)"""
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return settings.REST_FRAMEWORK.get("PAGE_SIZE", 50)
+
+    def getNextLink(self):
+        """Get the URL of the next page or None on the last page"""
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encodeCursor(self.last))
+
+    def encodeCursor(self, row):
+        """Encode the (field, id) position of a row"""
+        value = getattr(row, self.field)
+        return base64.urlsafe_b64encode("%s|%d" % (value.isoformat(), row.pk))
+
+    def decodeCursor(self, cursor):
+        """Decode a cursor to a (datetime, id) position
+
+        :raises NotFound: if the cursor is invalid
+        """
+        if not cursor:
+            return None
+        try:
+            (value, pk) = base64.urlsafe_b64decode(str(cursor)).split("|")
+            value = parse_datetime(value)
+            if value is None:
+                raise ValueError(cursor)
+            return value, int(pk)
+        except (TypeError, ValueError):
+            raise NotFound("Invalid cursor")
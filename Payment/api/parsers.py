@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+from rest_framework.parsers import JSONParser
+
+from api import metrics
+
+
+class TimedJSONParser(JSONParser):
+    """JSON parser whose parsing counts as the serialization span of the request
+    (see api.metrics)
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        with metrics.span("serialization"):
+            return super(TimedJSONParser, self).parse(stream, media_type, parser_context)
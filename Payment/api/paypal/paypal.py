@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import json
+import time
+import uuid
+import hashlib
 import httplib
 import urllib
 from traceback import print_exc
@@ -8,8 +12,56 @@ from django.conf import settings
 import requests
 
 from config import __base_map__, __endpoint_map__
+from session import getSession, getTimeout
+from ratelimit import TokenBucket, getBackoff, getConfig as getRateLimitConfig
+from api import metrics
+from api.cache import SingleFlight, createCache, hashKey
+from api.resilience import UpstreamUnavailable, attempt, guarded
 
 
+__token_cache_defaults__ = {
+    "ENABLED": True,
+    "MAX_ENTRIES": 10000,
+    "MAX_TTL": 3600,
+    "NEGATIVE_TTL": 30,
+    "BACKEND": None,
+}
+
+
+__details_cache_defaults__ = {
+    "ENABLED": True,
+    "MAX_ENTRIES": 10000,
+    "TTL": 5,
+    "TERMINAL_TTL": 3600,
+    "TERMINAL_STATES": ["approved", "failed", "canceled", "expired"],
+    "BACKEND": None,
+}
+
+
+def getTokenCacheConfig():
+    """Merge the PAYPAL_TOKEN_CACHE settings with the default values"""
+    config = dict(__token_cache_defaults__)
+    config.update(getattr(settings, "PAYPAL_TOKEN_CACHE", {}))
+    return config
+
+
+def getDetailsCacheConfig():
+    """Merge the PAYMENT_DETAILS_CACHE settings with the default values"""
+    config = dict(__details_cache_defaults__)
+    config.update(getattr(settings, "PAYMENT_DETAILS_CACHE", {}))
+    return config
+
+
+def getEntityTag(status, response):
+    """Get the entity tag of a successful response (a digest of its canonical JSON form)
+
+    :returns: the unquoted entity tag or None
+    :rtype: string
+    """
+    if int(status) != 200 or not isinstance(response, dict):
+        return None
+    return hashlib.sha1(json.dumps(response, sort_keys=True, separators=(",", ":"))).hexdigest()
+
 
 class Paypal(object):
     """Paypal class
@@ -24,6 +76,8 @@ class Paypal(object):
         self.__base_map__ = __base_map__
         self.__endpoint_map__ = __endpoint_map__
         self.http_authorization_token = http_authorization_token
+        self.session = getSession()
+        self.timeout = getTimeout()
 
         self.headers = {
             "Accept": "application/json",
@@ -32,11 +86,124 @@ class Paypal(object):
             "Authorization": "Bearer " + str(self.http_authorization_token)
         }
 
+    @metrics.timed("paypal")
+    def send(self, method, endpoint, request_id=None, headers=None, **kwargs):
+        """Send a request to Paypal through the rate limiter, retrying on 429/5xx
+
+        Every attempt takes a token from the bucket that the worker processes share
+        (PAYPAL_RATE_LIMIT); if no token frees up within WAIT seconds, a 429 is returned
+        without calling Paypal. The responses with a status in RETRY_STATUSES are retried
+        up to RETRIES times after a jittered exponential backoff (or the Retry-After of
+        Paypal), as long as the total delay stays within RETRY_BUDGET seconds. A POST
+        carries a PayPal-Request-Id that is the same on all the attempts, so Paypal
+        processes a retried creation or execution only once.
+
+        Within a guarded method (see api.resilience.guarded), only the HTTP attempts
+        hold a slot of the bulkhead of the endpoint class: the waits on the bucket and
+        the backoffs do not, so a burst of 429s does not fill the bulkhead with sleeping
+        retries. An attempt that gets no slot ends the call with a 503 at once.
+
+        Usage::
+            >>> from api.paypal import paypal
+            >>> payment = paypal.Payment("your_authorization_bearer_token")
+            >>> response = payment.send("post", "https://api.sandbox.paypal.com/v1/payments/payment", json={})
+
+        :param method: the HTTP method, i.e. get, post, patch
+        :type method: string
+        :param endpoint: the URL of the Paypal resource
+        :type endpoint: string
+        :param request_id: the idempotency key of a POST; a random one if omitted
+        :type request_id: string
+        :returns: the last response
+        :rtype: requests.Response
+        """
+        headers = dict(headers if headers is not None else self.headers)
+        if method.lower() == "post":
+            headers["PayPal-Request-Id"] = str(request_id or uuid.uuid4())
+        try:
+            return self.retry(method, endpoint, headers, **kwargs)
+        except UpstreamUnavailable as ex:
+            return buildResponse(503, "Service Unavailable", endpoint,
+                                 {"error": "Service unavailable", "upstream": ex.upstream, "reason": ex.reason})
+
+    def retry(self, method, endpoint, headers, **kwargs):
+        """Make the attempts of a request within the rate limit (see send)
+
+        :rtype: requests.Response
+        :raises UpstreamUnavailable: if an attempt gets no bulkhead slot
+        """
+        config = getRateLimitConfig()
+        if not config["ENABLED"]:
+            return self.request(method, endpoint, headers, **kwargs)
+
+        bucket = TokenBucket.get(config["PATH"])
+        delays = 0
+        for retry in range(config["RETRIES"] + 1):
+            if not bucket.acquire(config["RATE"], config["BURST"], config["WAIT"]):
+                return buildResponse(429, "Too Many Requests", endpoint, {"error": "Too many requests towards Paypal"})
+            response = self.request(method, endpoint, headers, **kwargs)
+            if response.status_code not in config["RETRY_STATUSES"] or retry == config["RETRIES"]:
+                return response
+            delay = getBackoff(retry, config, response.headers.get("Retry-After"))
+            if delays + delay > config["RETRY_BUDGET"]:
+                return response
+            delays += delay
+            time.sleep(delay)
+
+    def request(self, method, endpoint, headers, **kwargs):
+        """Make one HTTP attempt, holding a bulkhead slot (see send)
+
+        :rtype: requests.Response
+        :raises UpstreamUnavailable: if the bulkhead is full
+        """
+        with attempt():
+            return self.session.request(method, endpoint, headers=headers, timeout=self.timeout, **kwargs)
+
+
+def buildResponse(status_code, reason, endpoint, data):
+    """Build a response of the service on behalf of Paypal (i.e. when the call is rejected locally)
+
+    :rtype: requests.Response
+    """
+    response = requests.Response()
+    (response.status_code, response.reason, response.url) = (status_code, reason, endpoint)
+    response._content = json.dumps(data)
+    return response
+
 
 class Token(Paypal):
     """Token class that inherits the Paypal class
+
+    The outcome of the validation is cached per token until the token expires,
+    while the concurrent validations of the same token share a single call.
     """
-    
+
+    # the validation outcomes and the in-flight validations of the process
+    cache = None
+    flight = SingleFlight()
+
+    @classmethod
+    def getCache(cls):
+        """Get (or create on first use) the cache of the validation outcomes
+
+        :returns: the cache
+        :rtype: api.cache.TTLCache
+        """
+        if cls.cache is None:
+            cls.cache = createCache(getTokenCacheConfig())
+        return cls.cache
+
+    @classmethod
+    def stats(cls):
+        """Get the counters of the validation cache
+
+        :returns: the cache hits/misses and the deduplicated in-flight validations
+        :rtype: dictionary
+        """
+        stats = cls.getCache().stats()
+        stats["deduplicated"] = cls.flight.deduplicated
+        return stats
+
     def validate(self):
         """Validate the authorization information in Paypal
 
@@ -45,13 +212,49 @@ class Token(Paypal):
             >>> payment = paypal.Token("your_authorization_bearer_token")
             >>> (http_status, response_json) = payment.validate()
 
+        :returns: the HTTP status and the response body (if any)
+        :rtype: tuple(integer, dictionary)
+        """
+        config = getTokenCacheConfig()
+        if not config["ENABLED"]:
+            return self.authenticate()
+
+        cache = Token.getCache()
+        key = hashKey("paypal", self.http_authorization_token)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        return Token.flight.do(key, self.validateAndCache, key, cache, config)
+
+    def validateAndCache(self, key, cache, config):
+        """Validate the token in Paypal and cache the outcome
+
+        Only the HTTP status and the expiry of a successful validation are kept;
+        the access token included in the Paypal response is never cached.
+        """
+        status, response = self.authenticate()
+        if int(status) == 200:
+            try:
+                ttl = min(int(response.get("expires_in", 0)), config["MAX_TTL"])
+            except (ValueError, TypeError, AttributeError):
+                ttl = 0
+            if ttl > 0:
+                cache.set(key, (status, {"expires_in": response["expires_in"]}), ttl)
+        elif int(status) == 401:
+            cache.set(key, (status, response), config["NEGATIVE_TTL"])
+        return status, response
+
+    @guarded("paypal", "oauth2", per_attempt=True)
+    def authenticate(self):
+        """Request an access token from Paypal using the authorization information
+
         :returns: the HTTP status and the response body (if any)
         :rtype: tuple(integer, dictionary)
         """
         try:
             self.headers["Content-type"] = "application/x-www-form-urlencoded"
             endpoint = str(self.__base_map__['sandbox']) + str(self.__endpoint_map__['authentication'])
-            request = requests.post(endpoint, data="grant_type=client_credentials", headers=self.headers)
+            request = self.send("post", endpoint, data="grant_type=client_credentials", headers=self.headers)
             try:
                 return request.status_code, request.json()
             except ValueError as ex:
@@ -68,7 +271,107 @@ class Payment(Paypal):
     For more details visit the link https://developer.paypal.com/docs/api/payments/
     """
 
-    def create(self, payload):
+    # the payment details, the authorized tokens and the in-flight lookups of the process (see cachedDetails)
+    details_cache = None
+    details_flight = SingleFlight()
+
+    @classmethod
+    def getDetailsCache(cls):
+        """Get (or create on first use) the cache of the payment details
+
+        :returns: the cache
+        :rtype: api.cache.TTLCache
+        """
+        if cls.details_cache is None:
+            cls.details_cache = createCache(getDetailsCacheConfig())
+        return cls.details_cache
+
+    @classmethod
+    def invalidate(cls, pay_id):
+        """Remove the cached details of a payment, i.e. when Paypal notifies a change
+
+        :param pay_id: the payment id in Paypal format (PAY-xxx)
+        :type pay_id: string
+        """
+        cls.getDetailsCache().delete("payment:%s" % pay_id)
+
+    @classmethod
+    def authorize(cls, pay_id, http_authorization_token):
+        """Remember that Paypal has granted an access token access to a payment
+        (i.e. the token has created, executed or shown it)
+
+        The grant is kept as long as a validated token (PAYPAL_TOKEN_CACHE['MAX_TTL']).
+        """
+        key = "payment-tokens:%s" % pay_id
+        cache = cls.getDetailsCache()
+        tokens = cache.get(key) or frozenset()
+        cache.set(key, tokens | frozenset([hashKey("paypal", http_authorization_token)]), getTokenCacheConfig()["MAX_TTL"])
+
+    @classmethod
+    def isAuthorized(cls, pay_id, http_authorization_token):
+        """Check if Paypal has granted an access token access to a payment (see authorize)
+
+        :rtype: bool
+        """
+        tokens = cls.getDetailsCache().get("payment-tokens:%s" % pay_id)
+        return tokens is not None and hashKey("paypal", http_authorization_token) in tokens
+
+    def cachedDetails(self, pay_id, local=None):
+        """Show the details of a payment without calling Paypal when possible
+
+        The details are served from the cache if they have been fetched recently (for
+        TERMINAL_TTL seconds once the payment is in a terminal state and for TTL seconds
+        otherwise), then from the local copy (if a local function is given) and else from
+        Paypal. The cache and the local copy serve only the access tokens that Paypal has
+        already authorized for the payment; any other token is checked against Paypal.
+
+        Usage::
+            >>> from api.paypal import paypal
+            >>> payment = paypal.Payment("your_authorization_bearer_token")
+            >>> (http_status, response_json, etag, source) = payment.cachedDetails("PAY-xxx")
+
+        :param pay_id: the payment id in Paypal format (PAY-xxx)
+        :type pay_id: string
+        :param local: function that gets the local copy of a payment document or None
+        :type local: function
+        :returns: the HTTP status, the response body, its entity tag (None unless the status
+            is 200) and its source ("cache", "local" or "paypal")
+        :rtype: tuple(integer, dictionary, string, string)
+        """
+        config = getDetailsCacheConfig()
+        key = "payment:%s" % pay_id
+        authorized = Payment.isAuthorized(pay_id, self.http_authorization_token)
+        if authorized and config["ENABLED"]:
+            cached = Payment.getDetailsCache().get(key)
+            if cached is not None:
+                return cached[0], cached[1], cached[2], "cache"
+        if authorized and local is not None:
+            document = local(pay_id)
+            if document is not None:
+                return 200, document, getEntityTag(200, document), "local"
+        if not config["ENABLED"]:
+            (status, response) = self.details(pay_id)
+            if int(status) == 200:
+                Payment.authorize(pay_id, self.http_authorization_token)
+            return status, response, getEntityTag(status, response), "paypal"
+
+        token = hashKey("paypal", self.http_authorization_token)
+        (status, response, etag) = Payment.details_flight.do("%s:%s" % (key, token), self.detailsAndCache, pay_id, key, config)
+        return status, response, etag, "paypal"
+
+    def detailsAndCache(self, pay_id, key, config):
+        """Fetch the details of a payment in Paypal and cache them if they have been returned"""
+        (status, response) = self.details(pay_id)
+        etag = getEntityTag(status, response)
+        if etag is not None:
+            state = str(response.get("state", "")).lower()
+            ttl = config["TERMINAL_TTL"] if state in config["TERMINAL_STATES"] else config["TTL"]
+            Payment.getDetailsCache().set(key, (status, response, etag), ttl)
+            Payment.authorize(pay_id, self.http_authorization_token)
+        return status, response, etag
+
+    @guarded("paypal", "payments", per_attempt=True)
+    def create(self, payload, request_id=None):
         """Create a payment in Paypal
 
         Usage::
@@ -78,12 +381,14 @@ class Payment(Paypal):
 
         :param payload: the description of payment 
         :type payload: JSON
+        :param request_id: the idempotency key (PayPal-Request-Id); a random one if omitted
+        :type request_id: string
         :returns: the HTTP status and the response body (if any)
         :rtype: tuple(integer, dictionary)
         """
         try:
             endpoint = str(self.__base_map__['sandbox']) + str(self.__endpoint_map__['payment'])
-            request = requests.post(endpoint, json=payload, headers=self.headers)
+            request = self.send("post", endpoint, request_id=request_id, json=payload)
             try:
                 return request.status_code, request.json()
             except ValueError as ex:
@@ -92,7 +397,8 @@ class Payment(Paypal):
             return 500, dict({"error":"Internal server error"})
 
 
-    def execute(self, pay_id, payload):
+    @guarded("paypal", "payments", per_attempt=True)
+    def execute(self, pay_id, payload, request_id=None):
         """Execute a payment in Paypal after customer agreement
 
         Usage::
@@ -104,6 +410,8 @@ class Payment(Paypal):
         :type pay_id: string
         :param payload: the payer_id details
         :type payload: JSON
+        :param request_id: the idempotency key (PayPal-Request-Id); a random one if omitted
+        :type request_id: string
         :returns: the HTTP status and the response body (if any)
         :rtype: tuple(number, dictionary)
         """
@@ -111,12 +419,39 @@ class Payment(Paypal):
             endpoint = str(self.__base_map__['sandbox']) + str(self.__endpoint_map__['payment'])
             endpoint += str("/") + str(pay_id) 
             endpoint += str("/") + str("execute")
-            request = requests.post(endpoint, json=payload, headers=self.headers)
+            request = self.send("post", endpoint, request_id=request_id, json=payload)
+            try:
+                return request.status_code, request.json()
+            except ValueError as ex:
+                return request.status_code, dict({"error": request.reason})
+        except:
+            return 500, dict({"error":"Internal server error"})
+
+
+    @guarded("paypal", "payments", per_attempt=True)
+    def details(self, pay_id):
+        """Show the details of a payment in Paypal
+
+        Usage::
+            >>> from api.paypal import paypal
+            >>> payment = paypal.Payment("your_authorization_bearer_token")
+            >>> (http_status, response_json) = payment.details("PAY-xxx")
+
+        :param pay_id: the payment id in Paypal format (PAY-xxx)
+        :type pay_id: string
+        :returns: the HTTP status and the response body (if any)
+        :rtype: tuple(integer, dictionary)
+        """
+        try:
+            endpoint = str(self.__base_map__['sandbox']) + str(self.__endpoint_map__['payment'])
+            endpoint += str("/") + str(pay_id)
+            request = self.send("get", endpoint)
             try:
                 return request.status_code, request.json()
             except ValueError as ex:
                 return request.status_code, dict({"error": request.reason})
         except:
+            print_exc()
             return 500, dict({"error":"Internal server error"})
 
 
@@ -126,7 +461,8 @@ class BillingPlan(Paypal):
     For more details visit the link https://developer.paypal.com/docs/api/payments.billing-plans
     """
 
-    def create(self, payload):
+    @guarded("paypal", "billing", per_attempt=True)
+    def create(self, payload, request_id=None):
         """Create a billing plan in Paypal
 
         Usage::
@@ -136,12 +472,14 @@ class BillingPlan(Paypal):
 
         :param payload: the description of billing plan 
         :type payload: dictionary/JSON
+        :param request_id: the idempotency key (PayPal-Request-Id); a random one if omitted
+        :type request_id: string
         :returns: the HTTP status and the response body (if any)
         :rtype: tuple(integer, dictionary)
         """
         try:
             endpoint = str(self.__base_map__['sandbox']) + str(self.__endpoint_map__['billing_plan'])
-            request = requests.post(endpoint, json=payload, headers=self.headers)
+            request = self.send("post", endpoint, request_id=request_id, json=payload)
             try:
                 return request.status_code, request.json()
             except ValueError as ex:
@@ -152,6 +490,7 @@ class BillingPlan(Paypal):
             return 500, dict({"error":"Internal server error"})
 
 
+    @guarded("paypal", "billing", per_attempt=True)
     def activate(self, plan_id):
         """Activate an existing billing plan in Paypal
 
@@ -177,7 +516,7 @@ class BillingPlan(Paypal):
                     }
                 }
             ]
-            request = requests.patch(endpoint, json=payload, headers=self.headers)
+            request = self.send("patch", endpoint, json=payload)
             try:
                 return request.status_code, request.json()
             except ValueError as ex:
@@ -194,7 +533,8 @@ class BillingAgreement(Paypal):
     For more details visit the link https://developer.paypal.com/docs/api/payments.billing-agreements
     """
 
-    def create(self, payload):
+    @guarded("paypal", "billing", per_attempt=True)
+    def create(self, payload, request_id=None):
         """Create a billing agreement in Paypal
 
         Usage::
@@ -204,12 +544,14 @@ class BillingAgreement(Paypal):
 
         :param payload: the description of billing agreement 
         :type payload: dictionary/JSON
+        :param request_id: the idempotency key (PayPal-Request-Id); a random one if omitted
+        :type request_id: string
         :returns: the HTTP status and the response body (if any)
         :rtype: tuple(integer, dictionary)
         """
         try:
             endpoint = str(self.__base_map__['sandbox']) + str(self.__endpoint_map__['billing_agreement'])
-            request = requests.post(endpoint, json=payload, headers=self.headers)
+            request = self.send("post", endpoint, request_id=request_id, json=payload)
             try:
                 return request.status_code, request.json()
             except ValueError as ex:
@@ -220,7 +562,8 @@ class BillingAgreement(Paypal):
             return 500, dict({"error":"Internal server error"})
 
 
-    def execute(self, payment_token):
+    @guarded("paypal", "billing", per_attempt=True)
+    def execute(self, payment_token, request_id=None):
         """Execute a billing agreement after customer confirmation
 
         Usage::
@@ -230,13 +573,15 @@ class BillingAgreement(Paypal):
 
         :param payment_token: the payment_token provided from the paypal, i.e. EC-xxxxxxxxxxx
         :type payment_token: string
+        :param request_id: the idempotency key (PayPal-Request-Id); a random one if omitted
+        :type request_id: string
         :returns: the HTTP status and the response body (if any)
         :rtype: tuple(integer, dictionary)
         """
         try:
             endpoint = str(self.__base_map__['sandbox']) + str(self.__endpoint_map__['billing_agreement'])
             endpoint += "/" + str(payment_token) + "/" + "agreement-execute"
-            request = requests.post(endpoint, data=None, headers=self.headers)
+            request = self.send("post", endpoint, request_id=request_id, data=None)
             try:
                 return request.status_code, request.json()
             except ValueError as ex:
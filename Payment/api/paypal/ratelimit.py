@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import struct
+import random
+import threading
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+__defaults__ = {
+    "ENABLED": True,
+    "RATE": 30,
+    "BURST": 30,
+    "PATH": os.path.join(settings.PROJECT_ROOT, "queue", "paypal_rate_limit"),
+    "WAIT": 5,
+    "RETRIES": 3,
+    "RETRY_STATUSES": (429, 500, 502, 503, 504),
+    "BACKOFF_BASE": 0.5,
+    "BACKOFF_MAX": 8,
+    "RETRY_BUDGET": 20,
+}
+
+# tokens (float) and the time of the last refill (float)
+STATE = struct.Struct("<dd")
+
+
+def getConfig():
+    """Merge the PAYPAL_RATE_LIMIT settings with the default values"""
+    config = dict(__defaults__)
+    config.update(getattr(settings, "PAYPAL_RATE_LIMIT", {}))
+    return config
+
+
+class TokenBucket(object):
+    """Token bucket shared by the worker processes of the host through a locked file
+
+    The bucket holds up to BURST tokens and it is refilled with RATE tokens per second;
+    every Paypal call takes a token. The state is kept in a 16 bytes file that the
+    processes update under an exclusive lock (fcntl), so the rate applies to the host
+    and not to each worker. Without fcntl (i.e. on Windows) the bucket is per process.
+
+    Usage::
+        >>> from api.paypal.ratelimit import TokenBucket
+        >>> bucket = TokenBucket.get("/tmp/paypal_rate_limit")
+        >>> if bucket.acquire(rate=30, burst=30, timeout=5):
+        ...     pass
+    """
+
+    instances = dict()
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path):
+        """Get the bucket stored in the given path (one instance per path)
+
+        :rtype: TokenBucket
+        """
+        with cls.instances_lock:
+            if path not in cls.instances:
+                cls.instances[path] = cls(path)
+            return cls.instances[path]
+
+    def __init__(self, path):
+        """Class constructor
+
+        :param path: the path of the state file; the directory is created if it is missing
+        :type path: string
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = None
+        self.descriptor = None
+        self.pid = None
+        directory = os.path.dirname(path)
+        if fcntl is not None and directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open(self):
+        """Get the descriptor of the state file of the current process"""
+        if self.pid != os.getpid():
+            self.descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.pid = os.getpid()
+        return self.descriptor
+
+    def take(self, rate, burst):
+        """Take a token if there is one
+
+        :returns: 0 if a token has been taken, else the seconds until the next token
+        :rtype: float
+        """
+        with self.lock:
+            descriptor = self.open() if fcntl is not None else None
+            if descriptor is not None:
+                fcntl.flock(descriptor, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                if descriptor is not None:
+                    os.lseek(descriptor, 0, os.SEEK_SET)
+                    data = os.read(descriptor, STATE.size)
+                    state = STATE.unpack(data) if len(data) == STATE.size else (float(burst), now)
+                else:
+                    state = self.state or (float(burst), now)
+                tokens = min(float(burst), state[0] + max(0.0, now - state[1]) * rate)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                if descriptor is not None:
+                    os.lseek(descriptor, 0, os.SEEK_SET)
+                    os.write(descriptor, STATE.pack(tokens, now))
+                else:
+                    self.state = (tokens, now)
+                return wait
+            finally:
+                if descriptor is not None:
+                    fcntl.flock(descriptor, fcntl.LOCK_UN)
+
+    def acquire(self, rate, burst, timeout):
+        """Take a token, waiting up to timeout seconds for one
+
+        :param rate: tokens per second
+        :type rate: float
+        :param burst: the capacity of the bucket
+        :type burst: integer
+        :param timeout: the maximum wait in seconds
+        :type timeout: float
+        :rtype: bool
+        """
+        deadline = time.time() + timeout
+        while True:
+            wait = self.take(rate, burst)
+            if wait == 0:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(wait, remaining))
+
+
+def getBackoff(attempt, config, retry_after=None):
+    """Get the delay before a retry: exponential with full jitter, or the Retry-After of Paypal
+
+    :param attempt: the number of the retry, starting from 0
+    :type attempt: integer
+    :param retry_after: the Retry-After header of the response (seconds)
+    :type retry_after: string
+    :returns: the delay in seconds
+    :rtype: float
+    """
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), config["BACKOFF_MAX"])
+    except ValueError:
+        pass
+    return random.uniform(0, min(config["BACKOFF_MAX"], config["BACKOFF_BASE"] * (2 ** attempt)))
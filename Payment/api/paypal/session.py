@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from api.resilience import getServingScale
+
+
+__defaults__ = {
+    "POOL_CONNECTIONS": 4,
+    "POOL_MAXSIZE": 20,
+    "POOL_BLOCK": False,
+    "CONNECT_TIMEOUT": 3.05,
+    "READ_TIMEOUT": 30,
+    "MAX_RETRIES": 2,
+    "BACKOFF_FACTOR": 0.3,
+    "STATUS_FORCELIST": (),
+}
+
+__lock__ = threading.Lock()
+__session__ = {"pid": None, "session": None}
+
+
+def getConfig():
+    """Merge the PAYPAL_HTTP settings with the default values
+
+    The POOL_MAXSIZE is scaled to the serving mode like the bulkheads of the Paypal
+    calls (see api.resilience.getServingScale).
+
+    :returns: the connection pool configuration
+    :rtype: dictionary
+    """
+    config = dict(__defaults__)
+    config.update(getattr(settings, "PAYPAL_HTTP", {}))
+    config["POOL_MAXSIZE"] = int(config["POOL_MAXSIZE"] * getServingScale())
+    return config
+
+
+def getTimeout():
+    """Get the (connect, read) timeout applied on every Paypal call
+
+    :returns: the connect and read timeout in seconds
+    :rtype: tuple(float, float)
+    """
+    config = getConfig()
+    return config["CONNECT_TIMEOUT"], config["READ_TIMEOUT"]
+
+
+def createSession():
+    """Create a keep-alive session backed by a pooled HTTP adapter
+
+    The retry policy covers the connection errors of every method. The retries on
+    HTTP statuses are left to Paypal.send (see api.paypal.ratelimit), which paces them
+    through the rate limiter and re-sends a POST with its PayPal-Request-Id; the
+    STATUS_FORCELIST of the adapter applies only on the idempotent methods (GET, PUT etc).
+
+    :returns: a new session
+    :rtype: requests.Session
+    """
+    config = getConfig()
+    retries = Retry(
+        total=config["MAX_RETRIES"],
+        connect=config["MAX_RETRIES"],
+        read=0,
+        backoff_factor=config["BACKOFF_FACTOR"],
+        status_forcelist=config["STATUS_FORCELIST"],
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=config["POOL_CONNECTIONS"],
+        pool_maxsize=config["POOL_MAXSIZE"],
+        pool_block=config["POOL_BLOCK"],
+        max_retries=retries
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def getSession():
+    """Get the process-wide session towards the Paypal API
+
+    The session is created lazily and re-created after a fork, so that the
+    worker processes never share the sockets of their parent.
+
+    Usage::
+        >>> from api.paypal.session import getSession
+        >>> response = getSession().get("https://api.sandbox.paypal.com/v1/payments/payment/PAY-xxx")
+
+    :returns: the shared session
+    :rtype: requests.Session
+    """
+    pid = os.getpid()
+    if __session__["pid"] != pid:
+        with __lock__:
+            if __session__["pid"] != pid:
+                __session__["session"] = createSession()
+                __session__["pid"] = pid
+    return __session__["session"]
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+from rest_framework.renderers import JSONRenderer
+
+from api import metrics
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """JSON renderer whose rendering counts as the serialization span of the request
+    (see api.metrics)
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with metrics.span("serialization"):
+            return super(TimedJSONRenderer, self).render(data, accepted_media_type, renderer_context)
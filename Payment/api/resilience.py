@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import logging
+import threading
+import functools
+import contextlib
+import collections
+from django.conf import settings
+
+
+log = logging.getLogger(__name__)
+
+# the per-attempt bulkhead of the guarded call that the current thread runs (see attempt)
+__local__ = threading.local()
+
+__defaults__ = {
+    'ENABLED': True,
+    'WINDOW': 30,
+    'MIN_CALLS': 20,
+    'FAILURE_RATE': 0.5,
+    'OPEN_TIMEOUT': 30,
+    'HALF_OPEN_CALLS': 3,
+    'BULKHEADS': {},
+    'BULKHEAD_LIMIT': 20,
+    'BULKHEAD_WAIT': 0.5,
+}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def getConfig():
+    """Merge the UPSTREAM_RESILIENCE settings with the default values
+
+    The bulkhead limits are scaled to the serving mode (see getServingScale).
+    """
+    config = dict(__defaults__)
+    config.update(getattr(settings, 'UPSTREAM_RESILIENCE', {}))
+    scale = getServingScale()
+    config['BULKHEADS'] = dict((name, int(limit * scale)) for (name, limit) in config['BULKHEADS'].items())
+    config['BULKHEAD_LIMIT'] = int(config['BULKHEAD_LIMIT'] * scale)
+    return config
+
+
+def getServingScale():
+    """Get the factor of the per-process limits of the upstream calls
+
+    The limits of the settings are sized for a threaded worker that serves up to
+    THREADED_REQUESTS requests at once. A gevent worker (PAYMENT_SERVING, see wsgi.py)
+    serves up to PAYMENT_GREENLETS requests at once, so its limits are scaled by
+    PAYMENT_GREENLETS / THREADED_REQUESTS.
+
+    :returns: the factor, 1 in the threaded mode
+    :rtype: float
+    """
+    if getattr(settings, 'PAYMENT_SERVING', "threads") != "gevent":
+        return 1.0
+    return max(1.0, float(getattr(settings, 'PAYMENT_GREENLETS', 1000)) / getattr(settings, 'THREADED_REQUESTS', 50))
+
+
+class UpstreamUnavailable(Exception):
+    """The call has been rejected without reaching the upstream (open breaker or full bulkhead)"""
+
+    def __init__(self, upstream, reason):
+        super(UpstreamUnavailable, self).__init__("%s is unavailable (%s)" % (upstream, reason))
+        self.upstream = upstream
+        self.reason = reason
+
+
+class CircuitBreaker(object):
+    """Per-upstream circuit breaker on the failure rate of a time window
+
+    The breaker opens when at least MIN_CALLS calls have completed in the last WINDOW
+    seconds and FAILURE_RATE of them have failed; then the calls are rejected for
+    OPEN_TIMEOUT seconds. Afterwards up to HALF_OPEN_CALLS probes are let through: the
+    breaker closes if they all succeed and opens again on the first failure.
+
+    Usage::
+        >>> from api.resilience import CircuitBreaker
+        >>> breaker = CircuitBreaker.get("paypal")
+        >>> if breaker.allow():
+        ...     breaker.record(failed=False)
+    """
+
+    instances = dict()
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, name):
+        """Get the breaker of an upstream (one instance per name)
+
+        :rtype: CircuitBreaker
+        """
+        with cls.instances_lock:
+            if name not in cls.instances:
+                cls.instances[name] = cls(name)
+            return cls.instances[name]
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.outcomes = collections.deque()
+        self.failures = 0
+        self.state = CLOSED
+        self.opened_at = 0
+        self.probes = 0
+        self.successful_probes = 0
+        # the half-open periods so far; a probe permit belongs to one of them
+        self.generation = 0
+        self.rejected = 0
+        self.opened = 0
+
+    def prune(self, now, window):
+        while self.outcomes and self.outcomes[0][0] < now - window:
+            (_, failed) = self.outcomes.popleft()
+            self.failures -= failed
+
+    def allow(self, config=None):
+        """Check if a call may proceed; a permitted half-open call is a probe
+
+        :rtype: bool
+        """
+        return self.permit(config)[0]
+
+    def permit(self, config=None):
+        """Check if a call may proceed, like allow()
+
+        :returns: whether the call may proceed and, for a probe, the half-open period
+            of its permit (see cancel), else None
+        :rtype: tuple(bool, integer)
+        """
+        config = config or getConfig()
+        now = time.time()
+        with self.lock:
+            if self.state == OPEN and now - self.opened_at >= config['OPEN_TIMEOUT']:
+                (self.state, self.probes, self.successful_probes) = (HALF_OPEN, 0, 0)
+                self.generation += 1
+                log.info("Circuit breaker %s is half-open" % self.name)
+            if self.state == CLOSED:
+                return True, None
+            if self.state == HALF_OPEN and self.probes < config['HALF_OPEN_CALLS']:
+                self.probes += 1
+                return True, self.generation
+            self.rejected += 1
+            return False, None
+
+    def cancel(self, generation):
+        """Give back the probe permit of a call that has not been made
+
+        :param generation: the half-open period of the permit (see permit)
+        :type generation: integer
+        """
+        with self.lock:
+            if self.state == HALF_OPEN and self.generation == generation and self.probes > 0:
+                self.probes -= 1
+
+    def record(self, failed, config=None):
+        """Record the outcome of a permitted call"""
+        config = config or getConfig()
+        now = time.time()
+        with self.lock:
+            if self.state == HALF_OPEN:
+                if failed:
+                    self.trip(now)
+                else:
+                    self.successful_probes += 1
+                    if self.successful_probes >= config['HALF_OPEN_CALLS']:
+                        (self.state, self.failures) = (CLOSED, 0)
+                        self.outcomes.clear()
+                        log.info("Circuit breaker %s is closed" % self.name)
+                return
+            if self.state == OPEN:
+                return
+            self.outcomes.append((now, int(failed)))
+            self.failures += int(failed)
+            self.prune(now, config['WINDOW'])
+            calls = len(self.outcomes)
+            if calls >= config['MIN_CALLS'] and self.failures >= config['FAILURE_RATE'] * calls:
+                self.trip(now)
+
+    def trip(self, now):
+        (self.state, self.opened_at) = (OPEN, now)
+        self.opened += 1
+        self.outcomes.clear()
+        self.failures = 0
+        log.error("Circuit breaker %s is open" % self.name)
+
+    def stats(self):
+        """Get the state and the counters of the breaker
+
+        :rtype: dictionary
+        """
+        with self.lock:
+            calls = len(self.outcomes)
+            return {
+                "state": self.state,
+                "calls": calls,
+                "failure_rate": float(self.failures) / calls if calls else 0.0,
+                "rejected": self.rejected,
+                "opened": self.opened,
+            }
+
+
+class Bulkhead(object):
+    """Bound the concurrent calls of an upstream endpoint class
+
+    A call waits at most BULKHEAD_WAIT seconds for a free slot and it is rejected
+    otherwise, so a slow endpoint can not hold all the threads of a worker.
+
+    Usage::
+        >>> from api.resilience import Bulkhead
+        >>> bulkhead = Bulkhead.get("paypal:payments", 20)
+        >>> if bulkhead.acquire(0.5):
+        ...     try:
+        ...         pass
+        ...     finally:
+        ...         bulkhead.release()
+    """
+
+    instances = dict()
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, name, limit):
+        """Get the bulkhead of an upstream endpoint class (one instance per name)
+
+        :rtype: Bulkhead
+        """
+        with cls.instances_lock:
+            if name not in cls.instances:
+                cls.instances[name] = cls(name, limit)
+            return cls.instances[name]
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.rejected = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout):
+        """Take a slot, waiting up to timeout seconds
+
+        :rtype: bool
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.active >= self.limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.rejected += 1
+                    return False
+                self.condition.wait(remaining)
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def stats(self):
+        """Get the limit and the counters of the bulkhead
+
+        :rtype: dictionary
+        """
+        return {"limit": self.limit, "active": self.active, "rejected": self.rejected}
+
+
+def call(upstream, endpoint_class, function, *args, **kwargs):
+    """Call an upstream through its circuit breaker and the bulkhead of the endpoint class
+
+    The function returns the HTTP status and the response of the upstream; a status
+    of 500 or more (including the 500 that the clients return on a timeout or a
+    connection error) or an exception counts as a failure.
+
+    The breaker is checked first, so while it is open the calls are rejected at once,
+    without waiting for a bulkhead slot. A probe that the bulkhead rejects gives its
+    permit back to the breaker.
+
+    :param upstream: i.e. paypal, openam
+    :type upstream: string
+    :param endpoint_class: i.e. oauth2, payments
+    :type endpoint_class: string
+    :returns: the outcome of the function
+    :rtype: tuple(integer, object)
+    :raises UpstreamUnavailable: if the breaker is open or the bulkhead is full
+    """
+    return run(upstream, endpoint_class, False, function, args, kwargs)
+
+
+class AttemptSlots(object):
+    """The bulkhead of a guarded call that holds a slot per attempt (see attempt)"""
+
+    def __init__(self, upstream, bulkhead, wait):
+        self.upstream = upstream
+        self.bulkhead = bulkhead
+        self.wait = wait
+        self.reached = 0
+        self.rejected = False
+
+
+def run(upstream, endpoint_class, per_attempt, function, args, kwargs):
+    """Run a call like call(); if per_attempt, the bulkhead slot is taken by every
+    attempt of the function (see attempt) instead of the whole call"""
+    config = getConfig()
+    if not config['ENABLED']:
+        return function(*args, **kwargs)
+
+    name = "%s:%s" % (upstream, endpoint_class)
+    breaker = CircuitBreaker.get(upstream)
+    (allowed, probe) = breaker.permit(config)
+    if not allowed:
+        raise UpstreamUnavailable(upstream, "circuit breaker is open")
+    bulkhead = Bulkhead.get(name, config['BULKHEADS'].get(name, config['BULKHEAD_LIMIT']))
+    slots = AttemptSlots(upstream, bulkhead, config['BULKHEAD_WAIT']) if per_attempt else None
+    if slots is None and not bulkhead.acquire(config['BULKHEAD_WAIT']):
+        if probe is not None:
+            breaker.cancel(probe)
+        log.warn("Bulkhead %s is full" % name)
+        raise UpstreamUnavailable(upstream, "bulkhead %s is full" % name)
+
+    previous = getattr(__local__, "slots", None)
+    __local__.slots = slots
+    failed = True
+    try:
+        result = function(*args, **kwargs)
+        failed = int(result[0]) >= 500
+    finally:
+        __local__.slots = previous
+        if slots is None:
+            bulkhead.release()
+        if slots is not None and slots.rejected and slots.reached == 0:
+            # the call has not reached the upstream
+            if probe is not None:
+                breaker.cancel(probe)
+        else:
+            breaker.record(failed, config)
+    if slots is not None and slots.rejected:
+        raise UpstreamUnavailable(upstream, "bulkhead %s is full" % name)
+    return result
+
+
+@contextlib.contextmanager
+def attempt():
+    """Hold the bulkhead slot of the guarded call of the current thread during one
+    attempt of the call (see guarded); elsewhere the block runs as is
+
+    Usage::
+        >>> from api import resilience
+        >>> with resilience.attempt():
+        ...     response = session.request(method, endpoint)
+
+    :raises UpstreamUnavailable: if the bulkhead is full after BULKHEAD_WAIT seconds
+    """
+    slots = getattr(__local__, "slots", None)
+    if slots is None:
+        yield
+        return
+    if not slots.bulkhead.acquire(slots.wait):
+        slots.rejected = True
+        log.warn("Bulkhead %s is full" % slots.bulkhead.name)
+        raise UpstreamUnavailable(slots.upstream, "bulkhead %s is full" % slots.bulkhead.name)
+    slots.reached += 1
+    try:
+        yield
+    finally:
+        slots.bulkhead.release()
+
+
+def guarded(upstream, endpoint_class, text=False, per_attempt=False):
+    """Decorate a client method that returns (HTTP status, response) so that it runs
+    through call(); a rejected call returns a 503 at once
+
+    A method that waits between its attempts (i.e. on the rate limiter or a backoff)
+    is guarded per attempt: the breaker sees the outcome of the whole call, while the
+    bulkhead slot is held only by each attempt (see attempt), so the waiting calls do
+    not fill the bulkhead. The slot of an attempt is awaited up to BULKHEAD_WAIT
+    seconds like the slot of a call.
+
+    Usage::
+        >>> class Payment(Paypal):
+        ...     @guarded("paypal", "payments", per_attempt=True)
+        ...     def create(self, payload):
+        ...         pass
+
+    :param text: the method returns the response as JSON text instead of a dictionary
+    :type text: bool
+    :param per_attempt: the bulkhead slot is taken by every attempt instead of the call
+    :type per_attempt: bool
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            try:
+                return run(upstream, endpoint_class, per_attempt, method, args, kwargs)
+            except UpstreamUnavailable as ex:
+                response = {"error": "Service unavailable", "upstream": ex.upstream, "reason": ex.reason}
+                return 503, json.dumps(response) if text else response
+        return wrapper
+    return decorator
+
+
+def stats():
+    """Get the state of the circuit breakers and the bulkheads of the process
+
+    :rtype: dictionary
+    """
+    with CircuitBreaker.instances_lock:
+        breakers = dict(CircuitBreaker.instances)
+    with Bulkhead.instances_lock:
+        bulkheads = dict(Bulkhead.instances)
+    return {
+        "breakers": dict((name, breaker.stats()) for (name, breaker) in breakers.items()),
+        "bulkheads": dict((name, bulkhead.stats()) for (name, bulkhead) in bulkheads.items()),
+    }
@@ -1,6 +1,8 @@
 
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 from api import models
+import ast
 import json
 
 
@@ -15,7 +17,6 @@ class PaymentSerializer(serializers.ModelSerializer):
     payment = serializers.SerializerMethodField()
 
     def get_payment(self, object):
-        print type(object.json)
         return json.loads(object.json)
 
     class Meta:
@@ -23,3 +24,69 @@ class PaymentSerializer(serializers.ModelSerializer):
         fields = ('id', 'payment', )
 
 
+class PayloadSerializer(serializers.Serializer):
+    """Validate the shape of a request payload that is forwarded to Paypal
+
+    Only the declared top-level fields are checked; the validated data is the
+    payload itself (the parsed request.data), so it is passed to the paypal
+    client and the insert* helpers without a copy.
+
+    Usage::
+        >>> serializer = PaymentPayloadSerializer(data=request.data)
+        >>> if serializer.is_valid():
+        ...     payment.create(serializer.validated_data)
+    """
+
+    # accept a payload sent as a JSON (or python literal) string
+    accept_text = False
+
+    def to_internal_value(self, data):
+        if self.accept_text and isinstance(data, basestring):
+            try:
+                data = json.loads(data)
+            except ValueError:
+                try:
+                    data = ast.literal_eval(data)
+                except (ValueError, SyntaxError):
+                    pass
+        if not isinstance(data, dict):
+            raise serializers.ValidationError({api_settings.NON_FIELD_ERRORS_KEY: ["Expected a JSON object"]})
+        super(PayloadSerializer, self).to_internal_value(data)
+        return data
+
+
+class PaymentPayloadSerializer(PayloadSerializer):
+    """POST /v1/payments/payment"""
+    intent = serializers.ChoiceField(choices=["sale", "authorize", "order"])
+    payer = serializers.DictField()
+    transactions = serializers.ListField(child=serializers.DictField())
+    redirect_urls = serializers.DictField()
+
+    def validate_transactions(self, value):
+        if not len(value):
+            raise serializers.ValidationError("At least one transaction is required")
+        return value
+
+
+class PaymentExecutePayloadSerializer(PayloadSerializer):
+    """POST /v1/payments/payment/<id>/execute"""
+    payer_id = serializers.CharField()
+
+
+class BillingPlanPayloadSerializer(PayloadSerializer):
+    """POST /v1/payments/billing-plans"""
+    name = serializers.CharField()
+    description = serializers.CharField()
+    type = serializers.ChoiceField(choices=["FIXED", "INFINITE"])
+    payment_definitions = serializers.ListField(child=serializers.DictField())
+
+
+class BillingAgreementPayloadSerializer(PayloadSerializer):
+    """POST /v1/payments/billing-agreements"""
+    accept_text = True
+
+    name = serializers.CharField()
+    description = serializers.CharField()
+    start_date = serializers.CharField()
+    plan = serializers.DictField()
+    payer = serializers.DictField()
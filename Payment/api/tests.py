@@ -5,8 +5,48 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import os
+import json
+import hashlib
+import datetime
+import time
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+
 import django
-from django.test import TestCase
+import requests
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.db.backends.sqlite3 import base as sqlite
+from django.db.utils import OperationalError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api import auditlog
+from api import details
+from api import fields
+from api import idempotency
+from api import metrics
+from api import resilience
+from api import serializers
+from api import utilities
+from api import views
+from api.backends.limited import LimitedConnectionsMixin
+from api.broker import EventQueue
+from api.managers import PaypalResourceQuerySet
+from api.cache import SingleFlight, TTLCache
+from api.openam import OpenamAuth, getIdentity
+from api.models import (
+    Authorization, BillingAgreement, BillingPlan, BillingPlanPaymentDefinition, Event, EventDeadLetter, IdempotencyKey, Payment,
+    PaymentTransaction, PaymentTransactionLog, Refund, Sale
+)
+from api.paypal import paypal
+from api.paypal.ratelimit import TokenBucket
+from api.paypal.session import createSession, getConfig as getSessionConfig
 
 # TODO: Configure your database in settings.py and sync before running tests.
 
@@ -24,3 +64,1106 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class SerializationTest(SimpleTestCase):
+    """Tests for the conversion of the Paypal objects."""
+
+    def test_to_json(self):
+        """Tests that toJson matches json.dumps of the former object2dict."""
+        payment = {u"id": u"PAY-1", u"transactions": [{u"amount": {u"total": u"1.00"}, u"description": u"Caf\xe9"}]}
+        self.assertEqual(json.loads(utilities.toJson(payment)), payment)
+        self.assertEqual(utilities.toJson(payment), json.dumps(payment))
+        self.assertIs(utilities.object2dict(payment, False), payment)
+        self.assertEqual(utilities.object2dict("{'id': 'PAY-1'}", False), {"id": "PAY-1"})
+
+
+class PayloadSerializerTest(SimpleTestCase):
+    """Tests for the validation of the request payloads."""
+
+    def test_payload_is_not_copied(self):
+        """Tests that the validated payload is the parsed request data."""
+        payload = {"intent": "sale", "payer": {"payment_method": "paypal"},
+                   "transactions": [{"amount": {"total": "1.00", "currency": "EUR"}}],
+                   "redirect_urls": {"return_url": "http://localhost/return", "cancel_url": "http://localhost/cancel"}}
+        serializer = serializers.PaymentPayloadSerializer(data=payload)
+        self.assertTrue(serializer.is_valid())
+        self.assertIs(serializer.validated_data, payload)
+
+        serializer = serializers.PaymentPayloadSerializer(data=dict(payload, intent="buy", transactions=[]))
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(sorted(serializer.errors), ["intent", "transactions"])
+        self.assertFalse(serializers.PaymentExecutePayloadSerializer(data=[payload]).is_valid())
+
+    def test_agreement_text(self):
+        """Tests that a billing agreement is accepted as a JSON or a python literal string."""
+        agreement = {"name": "n", "description": "d", "start_date": "2017-10-01T00:00:00Z",
+                     "plan": {"id": "P-1"}, "payer": {"payment_method": "paypal"}}
+        for data in [agreement, json.dumps(agreement), str(agreement)]:
+            serializer = serializers.BillingAgreementPayloadSerializer(data=data)
+            self.assertTrue(serializer.is_valid())
+            self.assertEqual(serializer.validated_data, agreement)
+        self.assertFalse(serializers.BillingAgreementPayloadSerializer(data="{").is_valid())
+
+
+class PaypalSessionTest(SimpleTestCase):
+    """Tests for the shared Paypal HTTP session."""
+
+    def test_session_is_shared(self):
+        """Tests that every Paypal client reuses the same pooled session."""
+        first = paypal.Payment("token")
+        second = paypal.BillingPlan("token")
+        self.assertIs(first.session, second.session)
+        self.assertEqual(first.timeout, (3.05, 30))
+
+    @override_settings(PAYPAL_HTTP={'POOL_MAXSIZE': 7, 'MAX_RETRIES': 1})
+    def test_pool_configuration(self):
+        """Tests that the adapter honours the PAYPAL_HTTP settings."""
+        adapter = createSession().get_adapter("https://api.sandbox.paypal.com")
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertEqual(adapter.max_retries.total, 1)
+        self.assertNotIn('POST', adapter.max_retries.method_whitelist)
+
+
+class OpenamTokenCacheTest(SimpleTestCase):
+    """Tests for the cache of the OpenAM tokeninfo responses."""
+
+    class StubOpenamAuth(OpenamAuth):
+        """OpenamAuth that answers locally and counts the tokeninfo calls."""
+        calls = 0
+        status = 200
+        response = '{"expires_in": 120, "scope": ["cn"]}'
+
+        def getTokenInfo(self, accessToken):
+            self.__class__.calls += 1
+            return self.status, self.response
+
+    def setUp(self):
+        OpenamAuth.cache = None
+        self.StubOpenamAuth.calls = 0
+
+    def test_valid_token_is_cached(self):
+        """Tests that a valid token is introspected only once."""
+        auth = self.StubOpenamAuth()
+        self.assertEqual(auth.validateAccessToken("abc")[0], 200)
+        self.assertEqual(auth.validateAccessToken("abc")[0], 200)
+        self.assertEqual(self.StubOpenamAuth.calls, 1)
+        self.assertEqual(OpenamAuth.getCache().stats()["hits"], 1)
+
+    def test_rejected_token_is_cached(self):
+        """Tests the negative caching of the HTTP 401 responses."""
+        auth = self.StubOpenamAuth()
+        auth.status, auth.response = 401, '{"error": "invalid_token"}'
+        auth.validateAccessToken("abc")
+        self.assertEqual(auth.validateAccessToken("abc")[0], 401)
+        self.assertEqual(self.StubOpenamAuth.calls, 1)
+
+    def test_server_errors_are_not_cached(self):
+        """Tests that the failures of OpenAM are not cached."""
+        auth = self.StubOpenamAuth()
+        auth.status, auth.response = 500, 'error'
+        auth.validateAccessToken("abc")
+        auth.validateAccessToken("abc")
+        self.assertEqual(self.StubOpenamAuth.calls, 2)
+
+    def test_lru_eviction(self):
+        """Tests that the cache is bounded."""
+        cache = TTLCache(max_entries=2)
+        for key in ["a", "b", "a", "c"]:
+            cache.set(key, key, 60)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "a")
+        self.assertEqual(cache.get("c"), "c")
+
+
+class PaypalTokenCacheTest(SimpleTestCase):
+    """Tests for the cache of the Paypal token validations."""
+
+    class StubToken(paypal.Token):
+        """Token that answers locally and counts the Paypal calls."""
+        calls = 0
+        delay = 0
+
+        def authenticate(self):
+            self.__class__.calls += 1
+            time.sleep(self.delay)
+            return 200, {"access_token": "A101", "expires_in": 32400}
+
+    def setUp(self):
+        paypal.Token.cache = None
+        paypal.Token.flight = SingleFlight()
+        self.StubToken.calls = 0
+        self.StubToken.delay = 0
+
+    def test_valid_token_is_cached(self):
+        """Tests that a valid token is validated once in Paypal."""
+        self.assertEqual(self.StubToken("abc").validate()[0], 200)
+        (status, response) = self.StubToken("abc").validate()
+        self.assertEqual(status, 200)
+        self.assertNotIn("access_token", response)
+        self.assertEqual(self.StubToken.calls, 1)
+
+    def test_concurrent_validations_are_deduplicated(self):
+        """Tests that concurrent validations of a token share a single call."""
+        self.StubToken.delay = 0.2
+        threads = [threading.Thread(target=self.StubToken("abc").validate) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.StubToken.calls, 1)
+        self.assertEqual(paypal.Token.stats()["deduplicated"], 4)
+
+
+class ConcurrentValidationTest(SimpleTestCase):
+    """Tests for the concurrent validation of the request headers."""
+
+    def slow_check(self, delay):
+        time.sleep(delay)
+        return 200, {}
+
+    def test_all_checks_pass(self):
+        """Tests that the checks run in parallel."""
+        started = time.time()
+        result = views.runConcurrently([(self.slow_check, 0.3), (self.slow_check, 0.3)])
+        self.assertEqual(result, (200, {}))
+        self.assertLess(time.time() - started, 0.55)
+
+    def test_fail_fast(self):
+        """Tests that the first rejection is returned without waiting the rest."""
+        started = time.time()
+        result = views.runConcurrently([(self.slow_check, 1), (lambda token: (401, {"error": token}), "invalid")])
+        self.assertEqual(result, (401, {"error": "invalid"}))
+        self.assertLess(time.time() - started, 0.5)
+
+
+SALE_EVENT = {
+    "id": "WH-2WR32451HC0233532-67976317FL4543714",
+    "resource_type": "sale",
+    "event_type": "PAYMENT.SALE.COMPLETED",
+    "resource": {
+        "id": "80021663DE681814L",
+        "state": "completed",
+        "amount": {"total": "30.00", "currency": "EUR"},
+        "payment_mode": "INSTANT_TRANSFER",
+        "parent_payment": "PAY-1B56960729604235TKQQIYVY",
+        "create_time": "2017-09-06T10:00:00Z",
+        "update_time": "2017-09-06T10:00:05Z"
+    }
+}
+
+
+class WebhookQueueTest(TestCase):
+    """Tests for the queued ingestion of the webhook events."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = {'MODE': 'queue', 'QUEUE_PATH': os.path.join(self.directory, 'webhooks.sqlite3'),
+                       'MAX_ATTEMPTS': 2, 'RETRY_DELAY': 0}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lease_and_retry(self):
+        """Tests that a leased message is hidden until it is released."""
+        queue = EventQueue(self.config['QUEUE_PATH'])
+        queue.put('{}', 'WH-1')
+        (message_id, payload, attempts) = queue.claim(lease=60)
+        self.assertIsNone(queue.claim(lease=60))
+        queue.retry(message_id, 0, "error")
+        self.assertEqual(queue.claim(lease=60)[2], 1)
+        queue.ack(message_id)
+        self.assertEqual(queue.size(), 0)
+
+    def test_queued_event_is_applied(self):
+        """Tests that the view acknowledges at once and the worker applies the event."""
+        with self.settings(WEBHOOK_INGEST=self.config):
+            response = self.client.post('/api/v1/notifications/webhooks', json.dumps(SALE_EVENT),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(Sale.objects.count(), 0)
+
+            call_command('process_webhook_events', once=True, workers=1)
+        self.assertEqual(Sale.objects.get(sale_id="80021663DE681814L").state, "completed")
+        self.assertEqual(Event.objects.count(), 1)
+
+    def test_failed_event_is_dead_lettered(self):
+        """Tests that an event is moved to the dead letters after all its attempts."""
+        event = dict(SALE_EVENT, resource_type="agreement", resource={"id": "I-0LN988D3JACS"})
+        with self.settings(WEBHOOK_INGEST=self.config):
+            views.getEventQueue().put(json.dumps(event), event["id"])
+            call_command('process_webhook_events', once=True, workers=1)
+        self.assertEqual(EventDeadLetter.objects.get().attempts, 2)
+        self.assertEqual(EventQueue.get(self.config['QUEUE_PATH']).size(), 0)
+
+
+class WebhookBatchTest(TestCase):
+    """Tests for the batch ingestion of the webhook events."""
+
+    def sale_event(self, event_id, sale_id, state):
+        resource = dict(SALE_EVENT["resource"], id=sale_id, state=state)
+        return dict(SALE_EVENT, id=event_id, resource=resource)
+
+    def test_batch(self):
+        """Tests the deduplication and the per-event results of a batch."""
+        Sale.objects.create(sale_id="S-1", amount_value="1", amount_currency="EUR", state="pending",
+                            json="{}", create_time="2017-09-06T10:00:00Z", update_time="2017-09-06T10:00:00Z")
+        events = [
+            self.sale_event("WH-1", "S-1", "completed"),
+            self.sale_event("WH-2", "S-2", "pending"),
+            self.sale_event("WH-2", "S-2", "pending"),
+            self.sale_event("WH-3", "S-2", "completed"),
+            {"id": "WH-4", "resource_type": "refund", "event_type": "PAYMENT.SALE.REFUNDED", "resource": {}},
+            {"id": "WH-5", "resource_type": "sale"},
+        ]
+        response = self.client.post('/api/v1/notifications/webhooks/batch', json.dumps(events),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        results = response.data["results"]
+        self.assertEqual([result["status"] for result in results], [200, 201, 200, 201, 400, 400])
+        self.assertTrue(results[2]["duplicate"])
+        self.assertEqual(Sale.objects.get(sale_id="S-1").state, "completed")
+        self.assertEqual(Sale.objects.get(sale_id="S-2").state, "completed")
+        self.assertEqual(sorted(Event.objects.values_list("event_id", flat=True)), ["WH-1", "WH-2", "WH-3"])
+
+    def test_failed_event_is_redelivered(self):
+        """Tests that a failed event is rolled back, not stored, and applied on its redelivery."""
+        failed = dict(self.sale_event("WH-1", "S-1", "completed"), resource={})
+        self.assertEqual(views.applyWebhookEvents([failed])[0]["status"], 400)
+        self.assertEqual(views.applyWebhookEvents([self.sale_event("WH-1", "S-1", "completed")])[0]["status"], 201)
+        self.assertEqual(Sale.objects.get(sale_id="S-1").state, "completed")
+
+        def applyWebhookEvent(payload):
+            Sale.objects.filter(sale_id="S-1").update(state="refunded")
+            return 400, {"error": "Error in the payment definitions"}
+        (self.applyWebhookEvent, views.applyWebhookEvent) = (views.applyWebhookEvent, applyWebhookEvent)
+        try:
+            plan_event = {"id": "WH-2", "resource_type": "plan", "event_type": "BILLING.PLAN.UPDATED", "resource": {}}
+            self.assertEqual(views.applyWebhookEvents([plan_event])[0]["status"], 400)
+        finally:
+            views.applyWebhookEvent = self.applyWebhookEvent
+        self.assertEqual(Sale.objects.get(sale_id="S-1").state, "completed")
+        self.assertEqual(list(Event.objects.values_list("event_id", flat=True)), ["WH-1"])
+
+    def test_bulk_update_and_redelivery(self):
+        """Tests that the existing rows are updated with one statement and that stored events are not applied again."""
+        for sale_id in ["S-1", "S-2", "S-3"]:
+            Sale.objects.create(sale_id=sale_id, amount_value="1", amount_currency="EUR", state="pending",
+                                json="{}", create_time="2017-09-06T10:00:00Z", update_time="2017-09-06T10:00:00Z")
+        events = [self.sale_event("WH-%d" % i, "S-%d" % i, "completed") for i in range(1, 4)]
+        with CaptureQueriesContext(connection) as queries:
+            results = views.applyWebhookEvents(events)
+        self.assertEqual([result["status"] for result in results], [200, 200, 200])
+        self.assertEqual(len([query for query in queries.captured_queries if "UPDATE" in query["sql"]]), 1)
+        self.assertEqual(list(Sale.objects.order_by("sale_id").values_list("state", flat=True)), ["completed"] * 3)
+
+        Sale.objects.filter(sale_id="S-1").update(state="refunded")
+        results = views.applyWebhookEvents(events[:1])
+        self.assertEqual(results, [{"id": "WH-1", "status": 200, "duplicate": True}])
+        self.assertEqual(Sale.objects.get(sale_id="S-1").state, "refunded")
+
+
+class EventDeduplicationTest(TestCase):
+    """Tests for the deduplication of the webhook events."""
+
+    def test_duplicate_is_ignored(self):
+        """Tests that a redelivered event is stored once."""
+        self.assertTrue(views.storeEvent(SALE_EVENT))
+        self.assertFalse(views.storeEvent(SALE_EVENT))
+        self.assertEqual(Event.objects.count(), 1)
+
+    def test_redelivery_is_not_applied(self):
+        """Tests that a redelivered event is not applied again and that a failed event is not kept."""
+        self.assertEqual(views.ingestEvent(SALE_EVENT)[0], 201)
+        Sale.objects.update(state="refunded")
+        self.assertEqual(views.ingestEvent(SALE_EVENT), (200, {"id": SALE_EVENT["id"], "duplicate": True}))
+        self.assertEqual(Sale.objects.get().state, "refunded")
+
+        (http_status, _) = views.ingestEvent(dict(SALE_EVENT, id="WH-FAILED", resource={}))
+        self.assertGreaterEqual(http_status, 400)
+        self.assertFalse(Event.objects.filter(event_id="WH-FAILED").exists())
+
+
+class PaymentsReportTest(TestCase):
+    """Tests for the per-client reporting of the payments."""
+
+    headers = {"HTTP_OPENAM_CLIENT": "client-1", "HTTP_OPENAM_CLIENT_TOKEN": "token"}
+
+    def setUp(self):
+        self.validateOpenamToken = views.validateOpenamToken
+        views.validateOpenamToken = lambda token: (200, {"client_id": "client-1", "user": "user-1"})
+        for i in range(5):
+            for client_id in ["client-1", "client-2"]:
+                Payment.objects.create(client_id=client_id, pay_id="PAY-%s-%d" % (client_id, i), intent="sale",
+                                       state="created", note_to_payer="-", return_url="http://localhost/return",
+                                       cancel_url="http://localhost/cancel",
+                                       json=json.dumps({"id": "PAY-%s-%d" % (client_id, i)}),
+                                       create_time="2017-09-0%dT10:00:00Z" % (i + 1),
+                                       update_time="2017-09-0%dT10:00:00Z" % (i + 1))
+
+    def tearDown(self):
+        views.validateOpenamToken = self.validateOpenamToken
+
+    def test_keyset_pages(self):
+        """Tests that the pages of a client are complete, ordered and disjoint."""
+        url, pay_ids = '/api/v1/reports/payments?page_size=2', []
+        while url is not None:
+            response = self.client.get(url, **self.headers)
+            self.assertEqual(response.status_code, 200)
+            pay_ids += [payment["payment"]["id"] for payment in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(pay_ids, ["PAY-client-1-%d" % i for i in reversed(range(5))])
+
+    def test_range(self):
+        """Tests the filtering by date and the validation of the range."""
+        response = self.client.get('/api/v1/reports/payments?from=2017-09-02&to=2017-09-04', **self.headers)
+        self.assertEqual([payment["payment"]["id"] for payment in response.data["results"]], ["PAY-client-1-2", "PAY-client-1-1"])
+        response = self.client.get('/api/v1/reports/payments?from=yesterday', **self.headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/v1/reports/payments', HTTP_OPENAM_CLIENT="client-1")
+        self.assertEqual(response.status_code, 400)
+
+    def test_client_is_bound_to_token(self):
+        """Tests that a token of a client can not read the reports of another client."""
+        response = self.client.get('/api/v1/reports/payments', **dict(self.headers, HTTP_OPENAM_CLIENT="client-2"))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(getIdentity('{"client_id": "client-2", "uid": "demo", "sub": "u-1"}'),
+                         {"client_id": "client-2", "user": "u-1"})
+        self.assertEqual(getIdentity("<html/>"), {"client_id": None, "user": None})
+
+
+class ExportTest(TestCase):
+    """Tests for the streaming export."""
+
+    headers = {"HTTP_OPENAM_CLIENT": "client-1", "HTTP_OPENAM_CLIENT_TOKEN": "token"}
+    tokens = {"token": "client-1", "token-2": "client-2"}
+
+    def setUp(self):
+        self.validateOpenamToken = views.validateOpenamToken
+        views.validateOpenamToken = lambda token: (200, {"client_id": self.tokens[token], "user": "user-1"})
+        for (i, client_id) in enumerate(["client-1", "client-2", "client-1"]):
+            Payment.objects.create(client_id=client_id, pay_id="PAY-%d" % i, intent="sale", state="approved",
+                                   note_to_payer="-", return_url="http://localhost/return",
+                                   cancel_url="http://localhost/cancel", json="{}",
+                                   create_time="2017-09-0%dT10:00:00Z" % (i + 1), update_time="2017-09-0%dT10:00:00Z" % (i + 1))
+            Sale.objects.create(sale_id="S-%d" % i, amount_value="1.5", amount_currency="EUR", state="completed",
+                                parent_payment="PAY-%d" % i, json=json.dumps({"id": "S-%d" % i, "note": u"\u20ac"}),
+                                create_time="2017-09-0%dT10:00:00Z" % (i + 1), update_time="2017-09-0%dT10:00:00Z" % (i + 1))
+        Refund.objects.create(refund_id="R-1", sale_id="S-1", amount_value="1", amount_currency="EUR", state="completed",
+                              json="{}", create_time="2017-09-05T10:00:00Z", update_time="2017-09-05T10:00:00Z")
+
+    def tearDown(self):
+        views.validateOpenamToken = self.validateOpenamToken
+
+    def test_ndjson(self):
+        """Tests that the sales of the client are streamed in chunks."""
+        response = self.client.get('/api/v1/reports/export/sales?from=2017-09-01', **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = [json.loads(line) for line in "".join(response.streaming_content).splitlines()]
+        self.assertEqual([line["sale_id"] for line in lines], ["S-0", "S-2"])
+        self.assertEqual(lines[0]["json"], {"id": "S-0", "note": u"\u20ac"})
+        self.assertEqual(lines[0]["amount_value"], "1.5000")
+
+        output = StringIO()
+        call_command("export_records", "sales", "client-1", output="csv", chunk_size=1, stdout=output)
+        rows = output.getvalue().splitlines()
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(rows[0].startswith("id,sale_id,"))
+
+    def test_filters(self):
+        """Tests the ownership of the refunds and the validation of the parameters."""
+        response = self.client.get('/api/v1/reports/export/refunds', HTTP_OPENAM_CLIENT="client-2", HTTP_OPENAM_CLIENT_TOKEN="token-2")
+        self.assertEqual(len("".join(response.streaming_content).splitlines()), 1)
+        response = self.client.get('/api/v1/reports/export/refunds', **self.headers)
+        self.assertEqual("".join(response.streaming_content), "")
+        response = self.client.get('/api/v1/reports/export/sales?output=xml', **self.headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/v1/reports/export/sales?to=tomorrow', **self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_client_is_bound_to_token(self):
+        """Tests that a token of a client can not stream the records of another client."""
+        response = self.client.get('/api/v1/reports/export/sales', HTTP_OPENAM_CLIENT="client-2", HTTP_OPENAM_CLIENT_TOKEN="token")
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(response.streaming)
+
+
+class CompressedJSONFieldTest(TestCase):
+    """Tests for the compressed storage of the Paypal documents."""
+
+    document = json.dumps(dict(SALE_EVENT["resource"], description=u"Caf\xe9 " * 20))
+
+    def test_round_trip(self):
+        """Tests that a document is compressed in the column and decompressed on access."""
+        sale = Sale.objects.create(sale_id="S-1", amount_value="1", amount_currency="EUR", state="completed",
+                                   json=self.document, create_time="2017-09-06T10:00:00Z", update_time="2017-09-06T10:00:00Z")
+        stored = Sale.objects.values_list("json", flat=True).get(pk=sale.pk)
+        self.assertTrue(fields.isCompressed(stored))
+        self.assertLess(len(stored), len(self.document))
+
+        sale = Sale.objects.with_json().get(pk=sale.pk)
+        self.assertTrue(fields.isCompressed(sale.__dict__["json"]))
+        sale.state = "refunded"
+        sale.save()
+        self.assertEqual(Sale.objects.values_list("json", flat=True).get(pk=sale.pk), stored)
+        self.assertEqual(json.loads(Sale.objects.get(pk=sale.pk).json), json.loads(self.document))
+        self.assertEqual(fields.compress("{}"), "{}")
+
+    def test_command(self):
+        """Tests the conversion of the existing rows in both directions."""
+        with override_settings(JSON_COMPRESSION={'ENABLED': False}):
+            Event.objects.create(event_id="WH-1", resource_type="sale", event_type="PAYMENT.SALE.COMPLETED", json=self.document)
+        self.assertEqual(Event.objects.values_list("json", flat=True).get(), self.document)
+        call_command("compress_json_columns", chunk_size=1, stdout=StringIO())
+        self.assertTrue(fields.isCompressed(Event.objects.values_list("json", flat=True).get()))
+        call_command("compress_json_columns", decompress=True, stdout=StringIO())
+        self.assertEqual(Event.objects.values_list("json", flat=True).get(), self.document)
+
+
+class DeferredJsonTest(TestCase):
+    """Tests for the columns selected by the lookups of the webhook listener."""
+
+    def setUp(self):
+        plan = BillingPlan.objects.create(client_id="client-1", plan_id="P-1", name="n", description="d", type="INFINITE",
+                                          state="ACTIVE", return_url="http://localhost/return",
+                                          cancel_url="http://localhost/cancel", json="{}",
+                                          create_time="2017-09-06T10:00:00Z", update_time="2017-09-06T10:00:00Z")
+        BillingAgreement.objects.create(client_id="client-1", agreement_id="I-1", payment_token="EC-1", name="n",
+                                        description="d", state="Active", plan=plan, json="{}", start_date="2017-09-06T10:00:00Z")
+        Sale.objects.create(sale_id=SALE_EVENT["resource"]["id"], amount_value="1", amount_currency="EUR", state="pending",
+                            json="{}", create_time="2017-09-06T10:00:00Z", update_time="2017-09-06T10:00:00Z")
+
+    def selected(self, queries):
+        """Get the SELECT statements of the captured queries"""
+        return [query["sql"] for query in queries.captured_queries if "SELECT" in query["sql"]]
+
+    def test_webhook_lookups(self):
+        """Tests that the webhook events do not read the stored documents."""
+        agreement_event = {"id": "WH-2", "resource_type": "agreement", "event_type": "BILLING.SUBSCRIPTION.UPDATED",
+                           "resource": {"id": "I-1", "state": "Cancelled"}}
+        for payload in [SALE_EVENT, agreement_event]:
+            with CaptureQueriesContext(connection) as queries:
+                views.applyWebhookEvent(payload)
+            for statement in self.selected(queries):
+                self.assertNotIn('."json"', statement)
+
+    def test_with_json(self):
+        """Tests that the reports load the documents in the same query."""
+        with CaptureQueriesContext(connection) as queries:
+            agreements = list(BillingAgreement.objects.with_json().filter(client_id="client-1"))
+            self.assertEqual(agreements[0].json, "{}")
+        self.assertEqual(len(queries), 1)
+        self.assertIn('."json"', queries.captured_queries[0]["sql"])
+
+
+class UpsertTest(TestCase):
+    """Tests for the upsert of the Paypal resources."""
+
+    def test_sale_event(self):
+        """Tests that a sale event is inserted once and then updated in place."""
+        self.assertEqual(views.applyWebhookEvent(SALE_EVENT)[0], 201)
+        event = dict(SALE_EVENT, resource=dict(SALE_EVENT["resource"], state="refunded"))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(views.applyWebhookEvent(event)[0], 200)
+        statements = [query["sql"] for query in queries.captured_queries if "SAVEPOINT" not in query["sql"]]
+        self.assertEqual(len(statements), 1)
+        self.assertIn("UPDATE", statements[0])
+        self.assertEqual(Sale.objects.get().state, "refunded")
+
+    def test_authorization_event(self):
+        """Tests that an authorization update is applied to the authorization."""
+        resource = {"id": "AUTH-1", "state": "authorized", "amount": {"total": "5.00", "currency": "EUR"},
+                    "payment_mode": "INSTANT_TRANSFER", "valid_until": "2017-10-06T10:00:00Z",
+                    "create_time": "2017-09-06T10:00:00Z", "update_time": "2017-09-06T10:00:00Z"}
+        event = {"id": "WH-3", "resource_type": "authorization", "event_type": "PAYMENT.AUTHORIZATION.CREATED", "resource": resource}
+        self.assertEqual(views.applyWebhookEvent(event)[0], 201)
+        event["resource"] = dict(resource, state="captured")
+        self.assertEqual(views.applyWebhookEvent(event), (200, {"resource": "authorization", "id": "AUTH-1"}))
+        self.assertEqual(Authorization.objects.get(authorization_id="AUTH-1").state, "captured")
+
+    def test_mysql_outcome(self):
+        """Tests that on MySQL a rewrite and the loser of a concurrent insert are reported as updates."""
+        def upsertMysql(queryset, instance, key, fields, connection):
+            queryset.filter(**{key: getattr(instance, key)}).update(state=instance.state)
+        (connection.vendor, PaypalResourceQuerySet.upsertMysql) = ("mysql", upsertMysql)
+        try:
+            self.assertEqual(views.applyWebhookEvent(SALE_EVENT)[0], 201)
+            self.assertEqual(views.applyWebhookEvent(SALE_EVENT)[0], 200)
+            # the row is inserted by a concurrent event after the lookup
+            PaypalResourceQuerySet.exists = lambda queryset: False
+            event = dict(SALE_EVENT, resource=dict(SALE_EVENT["resource"], state="refunded"))
+            self.assertEqual(views.applyWebhookEvent(event)[0], 200)
+        finally:
+            del connection.vendor, PaypalResourceQuerySet.upsertMysql, PaypalResourceQuerySet.exists
+        self.assertEqual((Sale.objects.count(), Sale.objects.get().state), (1, "refunded"))
+
+
+class PaymentInsertionTest(TestCase):
+    """Tests for the storage of a created payment."""
+
+    payload = {"redirect_urls": {"return_url": "http://localhost/return", "cancel_url": "http://localhost/cancel"}}
+
+    def paypal_payment(self, transactions):
+        return {"id": "PAY-1", "intent": "sale", "state": "created", "payer": {"payment_method": "paypal"},
+                "note_to_payer": "-", "create_time": "2017-09-06T10:00:00Z", "transactions": [
+                    {"amount": {"total": "1.00", "currency": "EUR"}, "description": "item %d" % i, "item_list": {"items": []}}
+                    for i in range(transactions)]}
+
+    def test_bulk_insertion(self):
+        """Tests that the transactions are inserted with a single statement."""
+        with CaptureQueriesContext(connection) as queries:
+            payment_id = views.insertPayment("client-1", self.payload, None, self.paypal_payment(50))
+        self.assertGreater(payment_id, 0)
+        inserts = [query["sql"] for query in queries.captured_queries if "INSERT" in query["sql"]]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(PaymentTransaction.objects.filter(payment_id=payment_id).count(), 50)
+
+    def test_rollback(self):
+        """Tests that an invalid transaction leaves neither the payment nor the other transactions behind."""
+        paypal_payment = self.paypal_payment(3)
+        del paypal_payment["transactions"][2]["amount"]
+        self.assertEqual(views.insertPayment("client-1", self.payload, None, paypal_payment), -1)
+        self.assertEqual(Payment.objects.count(), 0)
+        self.assertEqual(PaymentTransaction.objects.count(), 0)
+
+
+class PaymentDefinitionSyncTest(TestCase):
+    """Tests for the bulk writes of the billing plan payment definitions."""
+
+    def definition(self, definition_id, type, value):
+        return {"id": definition_id, "name": "%s definition" % type.lower(), "type": type, "frequency": "MONTH",
+                "frequency_interval": "1", "cycles": "12", "amount": {"value": value, "currency": "EUR"},
+                "charge_models": [], "description": "x" * 200}
+
+    def test_sync(self):
+        """Tests that the definitions are inserted and updated with a constant number of queries."""
+        plan = BillingPlan.objects.create(client_id="client-1", plan_id="P-1", name="n", description="d", type="INFINITE",
+                                          state="ACTIVE", return_url="http://localhost/return",
+                                          cancel_url="http://localhost/cancel", json="{}",
+                                          create_time="2017-09-06T10:00:00Z", update_time="2017-09-06T10:00:00Z")
+        self.assertTrue(views.syncBillingPlanPaymentDefinitions(plan.id, [self.definition("PD-1", "TRIAL", "1.00")]))
+
+        definitions = [self.definition("PD-1", "TRIAL", "2.00")] + [self.definition("PD-%d" % i, "REGULAR", "10.00") for i in range(2, 6)]
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(views.syncBillingPlanPaymentDefinitions(plan.id, definitions))
+        statements = [query["sql"] for query in queries.captured_queries if "SAVEPOINT" not in query["sql"]]
+        self.assertEqual([next(word for word in ["INSERT", "UPDATE", "SELECT"] if word in statement) for statement in statements], ["SELECT", "INSERT", "UPDATE"])
+
+        stored = BillingPlanPaymentDefinition.objects.with_json().order_by("definition_id")
+        self.assertEqual([definition.definition_id for definition in stored], ["PD-1", "PD-2", "PD-3", "PD-4", "PD-5"])
+        self.assertEqual(str(stored[0].amount_value), "2.0000")
+        self.assertEqual(json.loads(stored[0].json)["amount"]["value"], "2.00")
+        self.assertTrue(fields.isCompressed(BillingPlanPaymentDefinition.objects.values_list("json", flat=True).get(definition_id="PD-1")))
+
+
+class TransactionLogTest(TestCase):
+    """Tests for the write-behind transaction log."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = dict(auditlog.__defaults__, MODE="buffered", SPOOL_DIR=self.directory, BATCH_SIZE=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sync(self):
+        """Tests that an entry is inserted once with both the request and the response."""
+        with CaptureQueriesContext(connection) as queries:
+            auditlog.record("PAY-1", "info", None, '{"id": "PAY-1"}')
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertEqual(PaymentTransactionLog.objects.with_json().get(payment_id="PAY-1").response_json, '{"id": "PAY-1"}')
+
+    def test_buffered(self):
+        """Tests that the buffered entries are spooled and inserted in batches on flush."""
+        buffer = auditlog.TransactionLogBuffer(self.config)
+        for i in range(3):
+            buffer.append({"payment_id": "PAY-%d" % i, "transaction_type": "info", "request_json": None,
+                           "response_json": "{}", "create_time": "2017-09-06T10:00:00", "update_time": "2017-09-06T10:00:00"})
+        self.assertEqual(PaymentTransactionLog.objects.count(), 0)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(len([query for query in queries.captured_queries if "INSERT" in query["sql"]]), 2)
+        self.assertEqual(PaymentTransactionLog.objects.count(), 3)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_recovery(self):
+        """Tests that the entries of an orphaned segment are inserted, except for an interrupted write."""
+        entry = {"payment_id": "PAY-1", "transaction_type": "info", "request_json": None, "response_json": "{}",
+                 "create_time": "2017-09-06T10:00:00", "update_time": "2017-09-06T10:00:00"}
+        with open(os.path.join(self.directory, "1-1-1.spool"), "w") as spool:
+            spool.write(json.dumps(entry) + "\n" + json.dumps(entry)[:20])
+
+        self.assertEqual(auditlog.recover(self.config, age=3600), 0)
+        self.assertEqual(auditlog.recover(self.config, age=0), 1)
+        self.assertEqual(PaymentTransactionLog.objects.filter(payment_id="PAY-1").count(), 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class PaymentDetailsCacheTest(TestCase):
+    """Tests for the cache of the Paypal payment details."""
+
+    def setUp(self):
+        self.details = paypal.Payment.details
+        self.calls = []
+        self.state = "approved"
+
+        def details(payment, pay_id):
+            self.calls.append(payment.http_authorization_token)
+            return 200, {"id": pay_id, "state": self.state}
+        paypal.Payment.details = details
+        paypal.Payment.details_cache = None
+
+    def tearDown(self):
+        paypal.Payment.details = self.details
+        paypal.Payment.details_cache = None
+
+    def test_terminal_payment_is_cached(self):
+        """Tests that the details are fetched once per authorized token."""
+        response = self.client.get('/api/v1/payments/payment/PAY-1234567890', HTTP_AUTHORIZATION="Bearer A101")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["state"], "approved")
+        self.client.get('/api/v1/payments/payment/PAY-1234567890', HTTP_AUTHORIZATION="Bearer A101")
+        self.assertEqual(self.calls, ["A101"])
+        # the lookups served from the cache are logged as well
+        self.assertEqual(PaymentTransactionLog.objects.count(), 2)
+
+        # a cached entry is not returned to a token that Paypal has not authorized
+        self.client.get('/api/v1/payments/payment/PAY-1234567890', HTTP_AUTHORIZATION="Bearer B202")
+        self.assertEqual(self.calls, ["A101", "B202"])
+
+    def test_revalidation(self):
+        """Tests that a matching If-None-Match header gets a 304 without the body."""
+        response = self.client.get('/api/v1/payments/payment/PAY-1234567890', HTTP_AUTHORIZATION="Bearer A101")
+        etag = response["ETag"]
+        response = self.client.get('/api/v1/payments/payment/PAY-1234567890', HTTP_AUTHORIZATION="Bearer A101",
+                                   HTTP_IF_NONE_MATCH='"x", W/%s' % etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_webhook_invalidation(self):
+        """Tests that a webhook event on a sale of the payment removes the cached details."""
+        self.client.get('/api/v1/payments/payment/PAY-1234567890', HTTP_AUTHORIZATION="Bearer A101")
+        views.invalidatePaymentDetails({"resource_type": "sale", "resource": {"id": "S-1", "parent_payment": "PAY-1234567890"}})
+        self.state = "failed"
+        response = self.client.get('/api/v1/payments/payment/PAY-1234567890', HTTP_AUTHORIZATION="Bearer A101")
+        self.assertEqual(response.data["state"], "failed")
+        self.assertEqual(len(self.calls), 2)
+
+
+class LocalDetailsTest(TestCase):
+    """Tests for the local reads of the payment details."""
+
+    def setUp(self):
+        self.details = paypal.Payment.details
+        self.calls = []
+
+        def details(payment, pay_id):
+            self.calls.append(pay_id)
+            return 200, {"id": pay_id, "state": "approved", "transactions": [{"amount": {"total": "1.00"}}], "update_time": "2017-09-06T11:00:00Z",
+                         "create_time": "2017-09-06T10:00:00Z"}
+        paypal.Payment.details = details
+        paypal.Payment.details_cache = None
+        paypal.Payment.authorize("PAY-1234567890", "A101")
+
+        document = {"id": "PAY-1234567890", "state": "approved", "transactions": [
+            {"amount": {"total": "1.00", "currency": "EUR"}, "related_resources": [{"sale": {"id": "S-1", "state": "pending"}}]}]}
+        Payment.objects.create(client_id="client-1", pay_id="PAY-1234567890", intent="sale", state="approved",
+                               note_to_payer="-", return_url="http://localhost/return", cancel_url="http://localhost/cancel",
+                               json=json.dumps(document), create_time="2017-09-06T10:00:00Z",
+                               update_time="2017-09-06T10:00:00Z", sync_time=timezone.now())
+        Sale.objects.create(sale_id="S-1", amount_value="1.00", amount_currency="EUR", state="completed",
+                            parent_payment="PAY-1234567890", json=json.dumps({"id": "S-1", "state": "completed"}),
+                            create_time="2017-09-06T10:00:00Z", update_time="2017-09-06T10:05:00Z")
+        Refund.objects.create(refund_id="R-1", sale_id="S-1", amount_value="1.00", amount_currency="EUR", state="completed",
+                              parent_payment="PAY-1234567890", json=json.dumps({"id": "R-1", "state": "completed"}),
+                              create_time="2017-09-06T10:10:00Z", update_time="2017-09-06T10:10:00Z")
+
+    def tearDown(self):
+        paypal.Payment.details = self.details
+        paypal.Payment.details_cache = None
+
+    def test_local_read(self):
+        """Tests that a fresh local copy is assembled with a single query and without Paypal."""
+        with CaptureQueriesContext(connection) as queries:
+            document = details.getLocalDetails("PAY-1234567890")
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertEqual(document["transactions"][0]["related_resources"],
+                         [{"sale": {"id": "S-1", "state": "completed"}}, {"refund": {"id": "R-1", "state": "completed"}}])
+
+        response = self.client.get('/api/v1/payments/payment/PAY-1234567890', HTTP_AUTHORIZATION="Bearer A101")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Payment-Source"], "local")
+        self.assertEqual(self.calls, [])
+        self.assertEqual(json.loads(PaymentTransactionLog.objects.with_json().get(payment_id="PAY-1234567890").response_json)["id"],
+                         "PAY-1234567890")
+
+        # any other token is checked against Paypal
+        response = self.client.get('/api/v1/payments/payment/PAY-1234567890', HTTP_AUTHORIZATION="Bearer B202")
+        self.assertEqual(response["X-Payment-Source"], "paypal")
+
+    def test_stale_copy(self):
+        """Tests that a stale copy is fetched from Paypal and replaced."""
+        Payment.objects.update(sync_time=timezone.now() - datetime.timedelta(days=2))
+        self.assertIsNone(details.getLocalDetails("PAY-1234567890"))
+
+        response = self.client.get('/api/v1/payments/payment/PAY-1234567890', HTTP_AUTHORIZATION="Bearer A101")
+        self.assertEqual(response["X-Payment-Source"], "paypal")
+        self.assertEqual(self.calls, ["PAY-1234567890"])
+        self.assertEqual(details.getLocalDetails("PAY-1234567890")["transactions"][0]["related_resources"],
+                         [{"refund": {"id": "R-1", "state": "completed"}}, {"sale": {"id": "S-1", "state": "completed"}}])
+
+
+@override_settings(UPSTREAM_RESILIENCE={"WINDOW": 30, "MIN_CALLS": 4, "FAILURE_RATE": 0.5, "OPEN_TIMEOUT": 0.2,
+                                        "HALF_OPEN_CALLS": 2, "BULKHEADS": {"test:slow": 1}, "BULKHEAD_WAIT": 0.1})
+class ResilienceTest(SimpleTestCase):
+    """Tests for the circuit breakers and the bulkheads of the upstream calls."""
+
+    # the project settings, without the override of the class
+    upstream_resilience = settings.UPSTREAM_RESILIENCE
+
+    def setUp(self):
+        resilience.CircuitBreaker.instances.clear()
+        resilience.Bulkhead.instances.clear()
+        self.calls = 0
+
+    def respond(self, status, delay=0):
+        self.calls += 1
+        time.sleep(delay)
+        return status, {}
+
+    def test_breaker(self):
+        """Tests that the breaker opens on the failure rate, rejects at once and closes after the probes."""
+        respond = resilience.guarded("test", "fast")(self.respond)
+        for status in [200, 500, 500, 200]:
+            self.assertEqual(respond(status)[0], status)
+        self.assertEqual(resilience.stats()["breakers"]["test"]["state"], "open")
+
+        (status, response) = respond(200)
+        self.assertEqual((status, response["upstream"], self.calls), (503, "test", 4))
+
+        time.sleep(0.25)
+        self.assertEqual(respond(200)[0], 200)
+        self.assertEqual(resilience.stats()["breakers"]["test"]["state"], "half_open")
+        self.assertEqual(respond(200)[0], 200)
+        self.assertEqual(resilience.stats()["breakers"]["test"]["state"], "closed")
+
+    def test_bulkhead(self):
+        """Tests that the calls beyond the limit of an endpoint class are rejected."""
+        respond = resilience.guarded("test", "slow")(self.respond)
+        thread = threading.Thread(target=respond, args=(200, 0.5))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(respond(200)[0], 503)
+        self.assertEqual(resilience.guarded("test", "fast")(self.respond)(200)[0], 200)
+        thread.join()
+        self.assertEqual(resilience.stats()["bulkheads"]["test:slow"], {"limit": 1, "active": 0, "rejected": 1})
+
+    def test_exposed(self):
+        """Tests that the breakers and the bulkheads are exposed as metrics and only to the allowed addresses."""
+        respond = resilience.guarded("test", "slow")(self.respond)
+        for status in [200, 500]:
+            respond(status)
+        self.assertIn('payment_api_circuit_breaker_failure_rate{upstream="test"} 0.5', metrics.expose()[0].splitlines())
+        for status in [500, 500, 200]:
+            respond(status)
+        (body, content_type) = metrics.expose()
+        for line in ['payment_api_circuit_breaker_state{upstream="test",state="open"} 1',
+                     'payment_api_circuit_breaker_state{upstream="test",state="closed"} 0',
+                     '# TYPE payment_api_circuit_breaker_rejected_total counter',
+                     'payment_api_circuit_breaker_rejected_total{upstream="test"} 1',
+                     'payment_api_bulkhead_active{bulkhead="test:slow"} 0',
+                     'payment_api_bulkhead_limit{bulkhead="test:slow"} 1']:
+            self.assertIn(line, body.splitlines())
+        self.assertIn("# TYPE payment_api_circuit_breaker_rejected counter", metrics.expose(openmetrics=True)[0])
+
+        self.assertEqual(self.client.get('/api/v1/health/upstreams').status_code, 200)
+        self.assertEqual(self.client.get('/api/v1/health/upstreams', REMOTE_ADDR="10.0.0.1").status_code, 403)
+
+    def test_breaker_before_bulkhead(self):
+        """Tests that an open breaker rejects without waiting for the bulkhead and that a rejected probe is given back."""
+        respond = resilience.guarded("test", "slow")(self.respond)
+        for status in [500, 500, 500, 500]:
+            respond(status)
+        bulkhead = resilience.Bulkhead.get("test:slow", 1)
+        self.assertTrue(bulkhead.acquire(0))
+        started = time.time()
+        self.assertEqual(respond(200)[1]["reason"], "circuit breaker is open")
+        self.assertLess(time.time() - started, 0.05)
+        self.assertEqual(bulkhead.stats()["rejected"], 0)
+
+        time.sleep(0.25)
+        self.assertEqual(respond(200)[1]["reason"], "bulkhead test:slow is full")
+        bulkhead.release()
+        self.assertEqual([respond(200)[0] for i in range(2)], [200, 200])
+        self.assertEqual(resilience.stats()["breakers"]["test"]["state"], "closed")
+
+    def test_serving_scale(self):
+        """Tests that the bulkheads and the Paypal connection pool are scaled to the greenlets of the gevent mode."""
+        self.assertEqual(resilience.getConfig()["BULKHEADS"], {"test:slow": 1})
+        with override_settings(PAYMENT_SERVING="gevent", PAYMENT_GREENLETS=1000, THREADED_REQUESTS=50,
+                               UPSTREAM_RESILIENCE=self.upstream_resilience):
+            config = resilience.getConfig()
+            self.assertEqual((config["BULKHEADS"]["paypal:payments"], config["BULKHEAD_LIMIT"]), (400, 400))
+            # a keep-alive connection for every Paypal call that the bulkheads admit
+            self.assertEqual(getSessionConfig()["POOL_MAXSIZE"],
+                             sum(limit for (name, limit) in config["BULKHEADS"].items() if name.startswith("paypal:")))
+        with override_settings(PAYMENT_SERVING="gevent", PAYMENT_GREENLETS=10):
+            self.assertEqual(resilience.getConfig()["BULKHEADS"], {"test:slow": 1})
+
+
+@override_settings(DATABASE_CONNECTIONS={"LIMIT": 1, "WAIT": 0.1})
+class LimitedConnectionsTest(SimpleTestCase):
+    """Tests for the bound on the open database connections of the process."""
+
+    def setUp(self):
+        resilience.Bulkhead.instances.clear()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        resilience.Bulkhead.instances.clear()
+        shutil.rmtree(self.directory)
+
+    def test_limit(self):
+        """Tests that a connection beyond the limit waits and fails, and that a closed connection frees its slot."""
+        wrapper = type("DatabaseWrapper", (LimitedConnectionsMixin, sqlite.DatabaseWrapper), {})
+        settings_dict = dict(connection.settings_dict, NAME=os.path.join(self.directory, "payment.sqlite3"))
+        (first, second) = (wrapper(dict(settings_dict), "first"), wrapper(dict(settings_dict), "second"))
+        first.ensure_connection()
+        started = time.time()
+        self.assertRaises(OperationalError, second.ensure_connection)
+        self.assertGreaterEqual(time.time() - started, 0.1)
+        first.close()
+        second.ensure_connection()
+        second.close()
+        self.assertEqual(resilience.stats()["bulkheads"]["database:connections"], {"limit": 1, "active": 0, "rejected": 1})
+
+
+class RateLimitTest(SimpleTestCase):
+    """Tests for the rate limiter and the retries of the Paypal calls."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(PAYPAL_RATE_LIMIT={
+            "PATH": os.path.join(self.directory, "bucket"), "RATE": 0.5, "BURST": 2, "WAIT": 0,
+            "BACKOFF_BASE": 0.01, "BACKOFF_MAX": 0.05})
+        self.settings.enable()
+        self.requests = []
+        self.statuses = []
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.directory)
+
+    def request(self, method, endpoint, headers=None, **kwargs):
+        self.requests.append(headers)
+        response = requests.Response()
+        (response.status_code, response._content) = (self.statuses.pop(0), json.dumps({"id": "PAY-1"}))
+        return response
+
+    def test_shared_bucket(self):
+        """Tests that the buckets of the same file (i.e. of different processes) share the tokens."""
+        path = os.path.join(self.directory, "shared")
+        self.assertEqual(TokenBucket(path).take(0.5, 2), 0)
+        self.assertEqual(TokenBucket(path).take(0.5, 2), 0)
+        self.assertGreater(TokenBucket(path).take(0.5, 2), 1)
+
+    def test_retry_keeps_request_id(self):
+        """Tests that a POST is retried on 429/5xx with the same PayPal-Request-Id."""
+        payment = paypal.Payment("token")
+        payment.session = type("Session", (object,), {"request": lambda _, *args, **kwargs: self.request(*args, **kwargs)})()
+        self.statuses = [503, 201]
+        self.assertEqual(payment.create({}, request_id="key-1"), (201, {"id": "PAY-1"}))
+        self.assertEqual([headers["PayPal-Request-Id"] for headers in self.requests], ["key-1", "key-1"])
+
+        self.statuses = [200]
+        (status, response) = payment.details("PAY-1")
+        self.assertEqual((status, response["error"]), (429, "Too many requests towards Paypal"))
+        self.assertEqual(len(self.requests), 2)
+
+    def test_waits_hold_no_bulkhead_slot(self):
+        """Tests that a Paypal call holds its bulkhead slot during its HTTP attempts only."""
+        resilience.CircuitBreaker.instances.clear()
+        resilience.Bulkhead.instances.clear()
+        paypal.Payment.details_cache = None
+        rate_limit = dict(settings.PAYPAL_RATE_LIMIT, RATE=100, BURST=100, BACKOFF_MAX=0.3)
+
+        def retried(method, endpoint, headers=None, **kwargs):
+            response = self.request(method, endpoint, headers, **kwargs)
+            response.headers["Retry-After"] = "0.3"
+            return response
+
+        def nested(method, endpoint, headers=None, **kwargs):
+            results.append(second.details("PAY-3"))
+            return self.request(method, endpoint, headers, **kwargs)
+        (first, second) = (paypal.Payment("token"), paypal.Payment("token"))
+        second.session = type("Session", (object,), {"request": lambda _, *args, **kwargs: self.request(*args, **kwargs)})()
+        results = []
+        with override_settings(PAYPAL_RATE_LIMIT=rate_limit,
+                               UPSTREAM_RESILIENCE={"BULKHEADS": {"paypal:payments": 1}, "BULKHEAD_WAIT": 0}):
+            first.session = type("Session", (object,), {"request": staticmethod(retried)})()
+            self.statuses = [503, 201]
+            thread = threading.Thread(target=lambda: results.append(first.create({}, request_id="key-2")))
+            thread.start()
+            time.sleep(0.1)
+            self.statuses.insert(0, 200)
+            self.assertEqual(second.details("PAY-2"), (200, {"id": "PAY-1"}))
+            thread.join()
+            self.assertEqual(results, [(201, {"id": "PAY-1"})])
+
+            first.session = type("Session", (object,), {"request": staticmethod(nested)})()
+            self.statuses = [201]
+            self.assertEqual(first.create({}, request_id="key-3")[0], 201)
+            self.assertEqual((results[-1][0], results[-1][1]["reason"]), (503, "bulkhead paypal:payments is full"))
+            self.assertEqual(resilience.stats()["bulkheads"]["paypal:payments"], {"limit": 1, "active": 0, "rejected": 1})
+            self.assertEqual(resilience.stats()["breakers"]["paypal"]["state"], "closed")
+        paypal.Payment.details_cache = None
+
+
+class IdempotencyTest(TestCase):
+    """Tests for the Idempotency-Key header of the create endpoints."""
+
+    payload = {"intent": "sale", "payer": {"payment_method": "paypal"},
+               "transactions": [{"amount": {"total": "1.00", "currency": "EUR"}}],
+               "redirect_urls": {"return_url": "http://localhost/return", "cancel_url": "http://localhost/cancel"}}
+    headers = {"HTTP_OPENAM_CLIENT": "client-1", "HTTP_OPENAM_CLIENT_TOKEN": "8d5f2e6b-5b6a-4f1e-9c1e",
+               "HTTP_PAYPAL_ACCESS_TOKEN": "A101", "HTTP_IDEMPOTENCY_KEY": "key-1"}
+    # OpenAM token: (client, user)
+    identities = {"8d5f2e6b-5b6a-4f1e-9c1e": ("client-1", "user-1"), "0c3a9d7e-2f4b-4c8a-8e5d": ("client-1", "user-2"),
+                  "5e1b7c2d-9a8f-4d3e-b6c4": ("client-2", "user-1"), "7f2c4e9a-1d3b-4a6e-8c5f": ("client-1", None)}
+
+    def setUp(self):
+        (self.validateRequest, self.create) = (views.validateRequest, paypal.Payment.create)
+        (self.request_ids, self.validations) = ([], [])
+
+        def validateRequest(headers):
+            self.validations.append(headers['HTTP_OPENAM_CLIENT_TOKEN'])
+            if headers['HTTP_OPENAM_CLIENT_TOKEN'] not in self.identities:
+                return 401, {"error": "invalid_token"}
+            (client_id, user) = self.identities[headers['HTTP_OPENAM_CLIENT_TOKEN']]
+            return 200, {"client_id": client_id, "user": user}
+
+        def create(payment, payload, request_id=None):
+            self.request_ids.append(request_id)
+            return 201, {"id": "PAY-%d" % len(self.request_ids), "intent": "sale", "state": "created",
+                         "payer": {"payment_method": "paypal"}, "note_to_payer": "-",
+                         "create_time": "2017-09-06T10:00:00Z", "transactions": [], "links": []}
+        views.validateRequest = validateRequest
+        paypal.Payment.create = create
+
+    def tearDown(self):
+        (views.validateRequest, paypal.Payment.create) = (self.validateRequest, self.create)
+
+    def post(self, payload=None, **headers):
+        return self.client.post('/api/v1/payments/payment', json.dumps(payload or self.payload),
+                                content_type="application/json", **dict(self.headers, **headers))
+
+    def test_repeat_is_replayed(self):
+        """Tests that a repeated request gets the first response without a new Paypal call or insertion."""
+        first = self.post()
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(len(self.validations), 1)
+        repeat = self.post(HTTP_PAYPAL_ACCESS_TOKEN="A102")
+        self.assertEqual((repeat.status_code, repeat.data, repeat["Idempotent-Replayed"]), (201, first.data, "true"))
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(len(self.request_ids), 1)
+
+        # the PayPal-Request-Id is the key of the stored response
+        key = idempotency.hashParts("payments/payment", "client-1", "user-1", "key-1")
+        self.assertEqual(self.request_ids[0], key)
+        self.assertEqual(IdempotencyKey.objects.get().key, key)
+
+        # the key is scoped to the client and the user of the token and it is bound to the payload
+        self.assertEqual(self.post(HTTP_OPENAM_CLIENT="client-2")["Idempotent-Replayed"], "true")
+        self.assertEqual(self.post(HTTP_OPENAM_CLIENT_TOKEN="5e1b7c2d-9a8f-4d3e-b6c4").status_code, 201)
+        self.assertEqual(self.post(HTTP_OPENAM_CLIENT_TOKEN="0c3a9d7e-2f4b-4c8a-8e5d").status_code, 201)
+        self.assertEqual(self.post(dict(self.payload, intent="order")).status_code, 422)
+        self.assertEqual(self.post(HTTP_IDEMPOTENCY_KEY="").status_code, 201)
+        self.assertEqual(Payment.objects.count(), 4)
+
+    def test_headers_are_validated_first(self):
+        """Tests that a request with an invalid token gets no stored response and claims no key."""
+        self.assertEqual(self.post().status_code, 201)
+        response = self.post(HTTP_OPENAM_CLIENT_TOKEN="revoked-token")
+        self.assertEqual((response.status_code, response.data), (401, {"error": "invalid_token"}))
+        self.assertFalse(response.has_header("Idempotent-Replayed"))
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+        # a token without a user has no key space of its own
+        self.assertEqual(self.post(HTTP_OPENAM_CLIENT_TOKEN="7f2c4e9a-1d3b-4a6e-8c5f").status_code, 400)
+        self.assertEqual((IdempotencyKey.objects.count(), len(self.request_ids)), (1, 1))
+
+    def test_duplicate_in_flight(self):
+        """Tests that a duplicate of a request in flight gets a 409 at once, and that an abandoned claim expires."""
+        now = timezone.now()
+        key = idempotency.hashParts("payments/payment", "client-1", "user-1", "key-1")
+        fingerprint = hashlib.sha1(json.dumps(self.payload, sort_keys=True)).hexdigest()
+        IdempotencyKey.objects.create(key=key, fingerprint=fingerprint, create_time=now,
+                                      expire_time=now + datetime.timedelta(seconds=60))
+        started = time.time()
+        response = self.post()
+        self.assertEqual((response.status_code, response["Retry-After"]), (409, "1"))
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(self.request_ids, [])
+
+        IdempotencyKey.objects.filter(key=key).update(expire_time=now)
+        self.assertEqual(self.post().status_code, 201)
+        self.assertEqual(IdempotencyKey.objects.get(key=key).status, 201)
+        self.assertEqual(idempotency.purge(), 0)
+
+
+@override_settings(PAYPAL_RATE_LIMIT={"ENABLED": False})
+class MetricsTest(TestCase):
+    """Tests for the request duration histograms."""
+
+    def setUp(self):
+        metrics.Histogram.instances.clear()
+        paypal.Payment.details_cache = None
+        self.getSession = paypal.getSession
+
+        def request(method, endpoint, headers=None, **kwargs):
+            response = requests.Response()
+            (response.status_code, response._content) = (200, json.dumps({"id": "PAY-1234567890", "state": "created"}))
+            return response
+        paypal.getSession = lambda: type("Session", (object,), {"request": staticmethod(request)})()
+
+    def tearDown(self):
+        paypal.getSession = self.getSession
+        paypal.Payment.details_cache = None
+
+    def test_breakdown(self):
+        """Tests that a request is observed per component with its request id as the exemplar."""
+        response = self.client.get('/api/v1/payments/payment/PAY-1234567890', HTTP_AUTHORIZATION="Bearer A101",
+                                   HTTP_X_REQUEST_ID="req-1")
+        self.assertEqual((response.status_code, response["X-Request-Id"]), (200, "req-1"))
+        self.assertEqual([timing.split(";")[0] for timing in response["Server-Timing"].split(", ")],
+                         ["paypal", "db", "serialization"])
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response["Content-Type"], metrics.PROMETHEUS_CONTENT_TYPE)
+        for component in ["total", "paypal", "db", "serialization"]:
+            self.assertIn('payment_api_request_duration_seconds_count{endpoint="show_payment_details",component="%s"} 1'
+                          % component, response.content)
+        self.assertNotIn("req-1", response.content)
+
+        response = self.client.get('/metrics', HTTP_ACCEPT="application/openmetrics-text; version=1.0.0")
+        self.assertIn('# {request_id="req-1"}', response.content)
+        self.assertTrue(response.content.endswith("# EOF\n"))
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR="10.0.0.1").status_code, 403)
+
+    def test_nested_spans(self):
+        """Tests that the nested spans of a component count once and that pool threads count on the request."""
+        context = metrics.start("req-2")
+        with metrics.span("db"):
+            with metrics.span("db"):
+                time.sleep(0.05)
+        thread = threading.Thread(target=metrics.bind(metrics.timed("openam")(time.sleep)), args=(0.02,))
+        thread.start()
+        thread.join()
+        metrics.stop()
+        self.assertLess(context.timings["db"], 0.09)
+        self.assertGreaterEqual(context.timings["openam"], 0.02)
+        self.assertIsNone(metrics.getContext())
@@ -5,6 +5,7 @@ endpoints = patterns(
     '',
     # listener
     url(r'^notifications/webhooks$', views.WebHook.as_view(),                        name="webhook_notifications"),
+    url(r'^notifications/webhooks/batch$', views.WebHookBatch.as_view(),              name="webhook_notifications_batch"),
     
     # wrap paypal endpoints
     url(r'^payments/payment$', views.PaymentCreateApiView.as_view(), name="create_payment"),
@@ -16,6 +17,10 @@ endpoints = patterns(
     # Reporting endpoints
     url(r'^reports/billing-agreements$', views.BillingAgreementsRetrieveApiView.as_view(), name="retrieve_billing_agreement"),
     url(r'^reports/payments$', views.PaymentsRetrieveApiView.as_view(), name="retrieve_payments"),
+    url(r'^reports/export/(?P<resource>payments|payment-transactions|sales|refunds|captures)$', views.ExportApiView.as_view(), name="export_records"),
+
+    # Monitoring
+    url(r'^health/upstreams$', views.UpstreamsApiView.as_view(), name="upstreams_health"),
 
     #Show payment details 
     url(r'^payments/payment/(?P<payment_token>[A-Z0-9\-]{10,32})$', views.PaymentShowDetailsApiView.as_view(), name="show_payment_details"),
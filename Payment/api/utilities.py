@@ -4,6 +4,16 @@ import json
 import ast
 from traceback import print_exc
 import collections
+import datetime
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+try:
+    # C accelerated encoder (simplejson speedups)
+    import simplejson as encoder
+except ImportError:
+    import json as encoder
+
 
 def isJson(object):
     """
@@ -18,18 +28,78 @@ def isJson(object):
     return True
 
 
+def getData(object, filter_data=True):
+    """Get the payload of a Paypal object without copying it
+
+    :param object: a dictionary/list (api.paypal response) or a Paypal SDK resource
+    :param filter_data: use the __data__ of a Paypal SDK resource
+    :type filter_data: boolean
+    """
+    if filter_data == True and hasattr(object, "__data__"):
+        return object.__data__
+    if hasattr(object, "to_dict"):
+        return object.to_dict()
+    return object
+
+
 def object2dict(object, filter_data=True):
     """Convert a Paypal object to a dictionary
+
+    The dictionaries and lists are returned as they are, without a copy.
     """
     try:
-        if filter_data == True:
-            return ast.literal_eval(str(object.__data__))
-        return ast.literal_eval(str(object))
+        data = getData(object, filter_data)
+        if isinstance(data, (dict, list)):
+            return data
+        return ast.literal_eval(data if isinstance(data, basestring) else str(data))
     except:
         print_exc()
         return False
 
 
+def encodeDefault(value):
+    """Convert the nested Paypal SDK resources during the JSON encoding"""
+    data = getData(value)
+    if data is value:
+        raise TypeError("%r is not JSON serializable" % (value,))
+    return data
+
+
+def toJson(object, filter_data=False):
+    """Serialize a Paypal object to JSON in a single pass
+
+    It is equivalent to json.dumps(object2dict(object, filter_data)) without the
+    intermediate conversion.
+
+    Usage::
+        >>> toJson({"id": "PAY-xxx", "state": "created"})
+        '{"id": "PAY-xxx", "state": "created"}'
+
+    :param object: a dictionary/list (api.paypal response) or a Paypal SDK resource
+    :param filter_data: use the __data__ of a Paypal SDK resource
+    :type filter_data: boolean
+    :rtype: string
+    """
+    return encoder.dumps(getData(object, filter_data), default=encodeDefault)
+
+
+def parseDateTime(value):
+    """Convert an ISO 8601 date or date-time to an aware datetime (UTC if the offset is missing)
+
+    :param value: i.e. 2017-09-01 or 2017-09-01T10:00:00Z
+    :type value: string
+    :rtype: datetime
+    :raises ValueError: if the value is not a valid date or date-time
+    """
+    try:
+        result = parse_datetime(value) or datetime.datetime.combine(parse_date(value), datetime.time())
+    except TypeError:
+        raise ValueError("Invalid date-time %s" % value)
+    if timezone.is_naive(result):
+        result = timezone.make_aware(result, timezone.utc)
+    return result
+
+
 def unicodeDict2dict(data):
     if isinstance(data, basestring):
         return str(data)
@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, Value, When
+from django.http import HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import generics, filters, status, viewsets
 from rest_framework.authtoken.models import Token
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
@@ -11,8 +18,12 @@ from rest_framework.parsers import JSONParser
 from rest_framework.renderers import JSONRenderer
 from rest_framework.views import APIView
 
+import os
 import sys
 import json
+import collections
+import Queue
+import threading
 import logging
 import logging.handlers
 from traceback import print_exc
@@ -20,9 +31,10 @@ from urlparse import urlparse
 import requests
 import datetime
 import time
+from multiprocessing.pool import ThreadPool
 
 # project specific
-from api.openam import OpenamAuth
+from api.openam import OpenamAuth, getIdentity
 from api.models import (
     RESOURCE_TYPES,
     BillingPlan,
@@ -34,10 +46,17 @@ from api.models import (
     Payment,
     PaymentTransaction,
     Authorization,
-    Capture,
-    PaymentTransactionLog
+    Capture
 )
+from api import auditlog
+from api import details
 from api import utilities
+from api import export
+from api import idempotency
+from api import metrics
+from api import resilience
+from api.broker import EventQueue
+from api.pagination import KeysetPagination
 from api import serializers
 from api.paypal import paypal
 
@@ -72,6 +91,11 @@ class PaymentCreateApiView(APIView):
                 paramType: header
                 type: string
                 required: true
+              - name: Idempotency-Key
+                description: A unique key of the request; its retries get the first response without a new creation
+                paramType: header
+                type: string
+                required: false
 
             type:
               id:
@@ -122,6 +146,7 @@ class PaymentCreateApiView(APIView):
             produces:
               - application/json
     """
+    @idempotency.idempotent("payments/payment", validate=lambda request: validateHeaders(request))
     def post(self, request):
         """Create a payment via the Paypal Payments API 
 
@@ -129,22 +154,22 @@ class PaymentCreateApiView(APIView):
         """
         try:
             # Validate headers
-            (headers_status, headers_message) = validateRequest(self.request.META)
+            (headers_status, headers_message) = validateHeaders(self.request)
             if int(headers_status) != 200:
                 return Response(data=headers_message, status=headers_status)
 
             # Load the payment payload
-            payload = json.loads(json.dumps(request.data))
-
-            if type(payload) is not dict:
+            serializer = serializers.PaymentPayloadSerializer(data=request.data)
+            if not serializer.is_valid():
                 log.warn( "OpenAM client %s has sent invalid payment payload" % self.request.META.get('HTTP_OPENAM_CLIENT'))
-                return Response(data={"error": "Invalid json format", "status": status.HTTP_400_BAD_REQUEST}, 
+                return Response(data={"error": "Invalid json format", "status": status.HTTP_400_BAD_REQUEST, "details": serializer.errors}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            payload = serializer.validated_data
 
             # Create the payment in paypal
             payment = paypal.Payment(self.request.META.get('HTTP_PAYPAL_ACCESS_TOKEN', None))
-            (http_status, paypal_payment) = payment.create(payload)
+            (http_status, paypal_payment) = payment.create(payload, request_id=idempotency.getRequestId(request))
             if int(http_status) != 201:
                 log.error("OpenAM client %s failed to create a Paypal payment: HTTP status %d and message %s " %\
                     (self.request.META.get('HTTP_OPENAM_CLIENT'), http_status, json.dumps(paypal_payment)))
@@ -160,8 +185,7 @@ class PaymentCreateApiView(APIView):
             payment_id = insertPayment(self.request.META.get('HTTP_OPENAM_CLIENT'), payload, approval_url, paypal_payment)
             if payment_id < 0:
                 return Response(data={"error": "Error in payment insertion"}, status=status.HTTP_400_BAD_REQUEST)
-            for paypal_transaction in paypal_payment['transactions']:
-                transaction_id = insertPaymentTransaction(payment_id, paypal_transaction)
+            paypal.Payment.authorize(paypal_payment['id'], self.request.META.get('HTTP_PAYPAL_ACCESS_TOKEN', None))
 
             log.info("OpenAM client %s has created a payment on demand from user having token '%s*****' with id %s" %\
                  (self.request.META.get('HTTP_OPENAM_CLIENT'), self.request.META.get('HTTP_OPENAM_CLIENT_TOKEN')[0:14], paypal_payment['id']) )
@@ -204,6 +228,11 @@ class BillingPlanCreateApiView(APIView):
                 paramType: header
                 type: string
                 required: true
+              - name: Idempotency-Key
+                description: A unique key of the request; its retries get the first response without a new creation
+                paramType: header
+                type: string
+                required: false
 
             responseMessages:
               - code: 201
@@ -228,6 +257,7 @@ class BillingPlanCreateApiView(APIView):
             produces:
               - application/json
     """
+    @idempotency.idempotent("payments/billing-plans", validate=lambda request: validateHeaders(request))
     def post(self, request):
         """Create a billing plan for recurring payments via the Paypal Billing Plan API
 
@@ -235,22 +265,23 @@ class BillingPlanCreateApiView(APIView):
         """
         try:
             # Validate headers
-            (headers_status, headers_message) = validateRequest(self.request.META)
+            (headers_status, headers_message) = validateHeaders(self.request)
             if int(headers_status) != 200:
                 return Response(data=headers_message, status=headers_status)
 
             # Load the plan payload
-            payload = self.request.data
-            if not utilities.isJson(json.dumps(payload)) or type(payload) is not dict:
+            serializer = serializers.BillingPlanPayloadSerializer(data=request.data)
+            if not serializer.is_valid():
                 log.warn( "OpenAM client %s has sent invalid billing plan payload" % self.request.META.get('HTTP_OPENAM_CLIENT'))
                 return Response(
-                    data={"error": "Invalid json format", "status": status.HTTP_400_BAD_REQUEST}, 
+                    data={"error": "Invalid json format", "status": status.HTTP_400_BAD_REQUEST, "details": serializer.errors}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            payload = serializer.validated_data
 
             # Create a billing plan in paypal
             plan = paypal.BillingPlan(self.request.META.get('HTTP_PAYPAL_ACCESS_TOKEN', None))
-            (http_status, paypal_billing_plan) = plan.create(payload)
+            (http_status, paypal_billing_plan) = plan.create(payload, request_id=idempotency.getRequestId(request))
             if int(http_status) != 201:
                 log.error("OpenAM client %s failed to create a Paypal billing plan: HTTP status %d and message %s " %\
                     (self.request.META.get('HTTP_OPENAM_CLIENT'), http_status, json.dumps(paypal_billing_plan)))
@@ -265,8 +296,7 @@ class BillingPlanCreateApiView(APIView):
                 )
 
             # Insert a list of payment definitions into database 
-            for paypal_payment_definition in paypal_billing_plan['payment_definitions']:
-                payment_definition = insertBillingPlanPaymentDefinition(paypal_payment_definition, billing_plan_id)
+            syncBillingPlanPaymentDefinitions(billing_plan_id, paypal_billing_plan['payment_definitions'])
 
             log.info("OpenAM client %s has created a billing plan on demand from user having token '%s*****' with id %s" %\
                  (self.request.META.get('HTTP_OPENAM_CLIENT'), self.request.META.get('HTTP_OPENAM_CLIENT_TOKEN')[0:14], paypal_billing_plan['id']) )
@@ -385,6 +415,11 @@ class BillingAgreementCreateApiView(APIView):
                 paramType: header
                 type: string
                 required: true
+              - name: Idempotency-Key
+                description: A unique key of the request; its retries get the first response without a new creation
+                paramType: header
+                type: string
+                required: false
 
             responseMessages:
               - code: 201
@@ -409,6 +444,7 @@ class BillingAgreementCreateApiView(APIView):
             produces:
               - application/json
     """
+    @idempotency.idempotent("payments/billing-agreements", validate=lambda request: validateHeaders(request))
     def post(self, request):
         """Create a billing agreement via the Paypal Billing Agreements API
 
@@ -416,25 +452,23 @@ class BillingAgreementCreateApiView(APIView):
         """
         try:
             # Validate headers
-            (headers_status, headers_message) = validateRequest(self.request.META)
+            (headers_status, headers_message) = validateHeaders(self.request)
             if int(headers_status) != 200:
                 return Response(data=headers_message, status=headers_status)
 
             # Load agreement payload
-            payload = json.loads(json.dumps(request.data))
-            import ast
-            payload = ast.literal_eval(payload)
-
-            if not utilities.isJson(json.dumps(payload)) or type(payload) is not dict:
+            serializer = serializers.BillingAgreementPayloadSerializer(data=request.data)
+            if not serializer.is_valid():
                 log.warn( "No valid billing agreement payload from the openAM client %s" % self.request.META.get('HTTP_OPENAM_CLIENT'))
                 return Response(
-                    data={"error": "Invalid json format", "status": status.HTTP_400_BAD_REQUEST}, 
+                    data={"error": "Invalid json format", "status": status.HTTP_400_BAD_REQUEST, "details": serializer.errors}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            payload = serializer.validated_data
 
             # Create a billing agreement in paypal
             agreement = paypal.BillingAgreement(self.request.META.get('HTTP_PAYPAL_ACCESS_TOKEN', None))
-            (http_status, paypal_billing_agreement) = agreement.create(payload)
+            (http_status, paypal_billing_agreement) = agreement.create(payload, request_id=idempotency.getRequestId(request))
             if int(http_status) != 201:
                 log.error("Paypal error in the attempt of billing agreement creation: HTTP status %d and message %s " % (http_status, json.dumps(paypal_billing_agreement)))
                 return Response(data=paypal_billing_agreement, status=http_status)
@@ -555,7 +589,9 @@ class BillingAgreementExecuteApiView(APIView):
 class WebHook(APIView):
     """Listener for Paypal events
 
-    Receives event notifications from the Paypal and store them in db according to their resource type
+    Receives event notifications from the Paypal and store them in db according to their resource type.
+    If WEBHOOK_INGEST['MODE'] is "queue", the events are only appended in a local durable queue and
+    they are applied later by the process_webhook_events command.
     """
 
     def post(self, request, *args):
@@ -569,148 +605,391 @@ class WebHook(APIView):
 
         # retrieve notification
         payload = self.request.data
-        resource_type = payload.get("resource_type").lower()
-        log.info("Paypal has sent a notification with type=%s" % resource_type)
-
-        if not Event.objects.filter(event_id=payload.get("id")).count():
-            event = Event(
-                event_id=payload.get("id"),
-                resource_type=payload.get("resource_type"),
-                event_type=payload.get("event_type"),
-                json=str(self.request.data),
-            )
-            event.save()
+        invalidatePaymentDetails(payload)
 
-        if resource_type in ["plan"]:
-            resource = payload.get("resource")
-            if resource['state'].lower() not in ["created"]:
-                try:
-                    plan = BillingPlan.objects.get(plan_id=resource["id"])
-                    if plan.state.lower() != "deleted" :
-                        if not updateBillingPlan(plan.id, resource):
-                            return Response(
-                                data={"error": "Error in billing plan update"},
-                                status=status.HTTP_400_BAD_REQUEST
-                            )
-
-                        for paypal_payment_definition in resource['payment_definitions']:
-                            definition = BillingPlanPaymentDefinition.objects.get(definition_id=paypal_payment_definition["id"])
-                            updateBillingPlanPaymentDefinition(definition.id, paypal_payment_definition)
-
-                        log.info("Paypal has updated the billing plan having id=%s" % (resource["id"], resource['state']))
-                        return Response(data={"resource": "plan", "id": plan.id}, status=status.HTTP_200_OK)
-
-                    raise Exception("Unhandled plan notification")
-                except Exception as ex:
-                    log.error("Paypal has failed to update the billing plan having id=%s" % (resource["id"], resource['state']))
-                    log.error(str(ex))
-                    return Response(data={"error": "error", "id": plan.id}, status=status.HTTP_400_BAD_REQUEST)
-
-        if resource_type in ["agreement"]:
-            resource = payload.get("resource")
+        if getWebhookConfig()['MODE'] == "queue":
             try:
-                agreement = BillingAgreement.objects.get(agreement_id=resource['id'])
-                if agreement.state.lower() != "cancelled":
-                    if not updateBillingAgreement(agreement.id, resource):
-                        return Response(
-                            data={"error": "Error in billing agreement update"},
-                            status=status.HTTP_400_BAD_REQUEST
-                        )
-
-                    log.info("Paypal has updated the billing agreement having id=%s, state=%s" % (resource['id'], resource['state']))
-                    return Response(data={"resource": "agreement", "id": resource['id']}, status=status.HTTP_200_OK)
-
-                raise Exception("Unhandled agreement notification")
+                getEventQueue().put(utilities.toJson(payload), payload.get("id"))
             except Exception as ex:
-                log.error("Paypal has failed to update the billing agreement having id=%s" % (resource["id"]))
-                log.error(str(ex))
-                return Response(data={"error": "error", "id": resource['id']}, status=status.HTTP_400_BAD_REQUEST)
+                log.error("Failed to queue the Paypal notification with id=%s: %s" % (payload.get("id"), str(ex)))
+                return Response(data={"error": "Service unavailable"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            log.info("Paypal has sent a notification with id=%s (queued)" % payload.get("id"))
+            return Response(data={"id": payload.get("id")}, status=status.HTTP_202_ACCEPTED)
+
+        (http_status, data) = ingestEvent(payload)
+        return Response(data=data, status=http_status)
+
+
+def getWebhookConfig():
+    """Merge the WEBHOOK_INGEST settings with the default values"""
+    config = {
+        "MODE": "sync",
+        "QUEUE_PATH": os.path.join(settings.PROJECT_ROOT, "queue", "webhooks.sqlite3"),
+        "WORKERS": 4,
+        "MAX_ATTEMPTS": 8,
+        "RETRY_DELAY": 5,
+        "LEASE": 300,
+        "BATCH_SIZE": 1000,
+    }
+    config.update(getattr(settings, "WEBHOOK_INGEST", {}))
+    return config
+
+def invalidatePaymentDetails(payload):
+    """Remove the cached details of the payment that a webhook event refers to
+
+    The payment is the resource of the payment events and the parent payment of the
+    sale, authorization, capture and refund events.
+
+    :param payload: the Paypal notification
+    :type payload: dictionary
+    """
+    if not isinstance(payload, dict) or not isinstance(payload.get("resource"), dict):
+        return
+    resource = payload["resource"]
+    if str(payload.get("resource_type", "")).lower() == "payment":
+        pay_id = resource.get("id")
+    else:
+        pay_id = resource.get("parent_payment")
+    if pay_id:
+        paypal.Payment.invalidate(pay_id)
+
+def getEventQueue():
+    """Get the local queue of the webhook events
+
+    :rtype: api.broker.EventQueue
+    """
+    return EventQueue.get(getWebhookConfig()['QUEUE_PATH'])
 
-        if resource_type in ['sale']:
-            resource = payload.get("resource")
-            try:
-                sale = Sale.objects.filter(sale_id=resource["id"])
-                if sale.count() == 1:
-                    if updateSale(sale[0].id, resource) == True:
-                        log.info("Paypal has updated the sale with id=%s, state=%s" % (sale[0].id, sale[0].state))
-                        return Response(data={"resource": "sale"}, status=status.HTTP_200_OK)
-                else:
-                    sale_id = insertSale(resource)
-                    log.info("Paypal has inserted a sale with id=%s" % (sale_id))
-                    return Response(data={"resource": "sale"}, status=status.HTTP_201_CREATED)
-
-                raise Exception("Unhandled sale notification")
-            except Exception as ex:
-                log.error("Paypal has failed to insert/update a sale")
-                log.error(str(ex))
-                return Response(data={"resource": "sale"}, status=status.HTTP_400_BAD_REQUEST)
+def storeEvent(payload):
+    """Keep a webhook event unless it has already been stored
 
-        if resource_type in ["authorization"]:
-            resource = payload.get("resource")
-            try:
-                authorization = Authorization.objects.filter(authorization_id=resource["id"])
-                if authorization.count():
-                    if updateSale(authorization[0].id, resource) == True:
-                        log.info("Paypal has updated the authorization payment with id=%s, state=%s" % (authorization[0].id, authorization[0].state))
-                        return Response(data={"resource": "authorization", "id": authorization[0].id}, status=status.HTTP_200_OK)
-                else:
-                    authorization_id = insertAuthorization(resource)
-                    log.info("Paypal has inserted an authorization with id=%s" % (authorization_id))
-                    return Response(data={"resource": resource_type, "id": authorization_id}, status=status.HTTP_201_CREATED)
-
-                raise Exception("Unhandled authorize notification")
-            except Exception as ex:
-                log.error("Paypal has failed to insert/update an authorization")
-                log.error(str(ex))
-                return Response(data={"resource": "authorization"}, status=status.HTTP_400_BAD_REQUEST)
+    The unique index on event_id rejects the duplicates, so the check costs a single
+    insert (inside a savepoint) even under concurrent deliveries of the same event.
 
-        if resource_type in ["capture"]:
-            resource = payload.get("resource")
+    :param payload: the Paypal notification
+    :type payload: dictionary
+    :returns: True if the event has been stored; False if it is a duplicate
+    :rtype: bool
+    """
+    event = Event(
+        event_id=payload.get("id"),
+        resource_type=payload.get("resource_type"),
+        event_type=payload.get("event_type"),
+        json=str(payload),
+    )
+    try:
+        with transaction.atomic():
+            event.save()
+        return True
+    except IntegrityError:
+        if Event.objects.filter(event_id=event.event_id).exists():
+            return False
+        raise
+
+def ingestEvent(payload):
+    """Store a webhook event and apply it, once
+
+    The event is stored and applied in one transaction. A redelivered event is
+    acknowledged without being applied again, while a failed one is rolled back, so
+    that its redelivery by Paypal (or the retry of the queue) applies it.
+
+    :param payload: the Paypal notification
+    :type payload: dictionary
+    :returns: the HTTP status and the relative message
+    :rtype: tuple(integer, dictionary)
+    """
+    with transaction.atomic():
+        if not storeEvent(payload):
+            log.info("Paypal has sent again the notification with id=%s; it is ignored" % payload.get("id"))
+            return status.HTTP_200_OK, {"id": payload.get("id"), "duplicate": True}
+        (http_status, data) = applyWebhookEvent(payload)
+        if int(http_status) >= 400:
+            transaction.set_rollback(True)
+        return http_status, data
+
+def applyWebhookEvent(payload):
+    """Apply a webhook event on the stored plans, agreements, sales, authorizations, captures and refunds
+
+    :param payload: the Paypal notification
+    :type payload: dictionary
+    :returns: the HTTP status and the relative message
+    :rtype: tuple(integer, dictionary)
+    """
+    resource_type = payload.get("resource_type").lower()
+    log.info("Paypal has sent a notification with type=%s" % resource_type)
+
+    if resource_type in ["plan"]:
+        resource = payload.get("resource")
+        if resource['state'].lower() not in ["created"]:
             try:
-                capture = Capture.objects.filter(capture_id=resource["id"])
-                if capture.count() == 1:
-                    if updateCapture(capture.id, resource) == True:
-                        log.info("Paypal has updated the capture with id=%s, state=%s" % (capture[0].id, capture[0].state))
-                        return Response(data={"resource": resource_type}, status=status.HTTP_200_OK)
-                else:
-                    capture_id = insertCapture(resource)
-                    log.info("Paypal has sent a capture with id=%s" % (resource['id']))
-                    return Response(data={"resource": resource_type}, status=status.HTTP_201_CREATED)
-                    
-                raise Exception("Unhandled capture notification")
+                plan = BillingPlan.objects.get(plan_id=resource["id"])
+                if plan.state.lower() != "deleted" :
+                    if not updateBillingPlan(plan.id, resource):
+                        return status.HTTP_400_BAD_REQUEST, {"error": "Error in billing plan update"}
+
+                    if not syncBillingPlanPaymentDefinitions(plan.id, resource.get('payment_definitions', [])):
+                        return status.HTTP_400_BAD_REQUEST, {"error": "Error in billing plan's payment definitions update"}
+
+                    log.info("Paypal has updated the billing plan having id=%s, state=%s" % (resource["id"], resource['state']))
+                    return status.HTTP_200_OK, {"resource": "plan", "id": plan.id}
+
+                raise Exception("Unhandled plan notification")
             except Exception as ex:
-                log.error("Paypal has failed to insert/update a capture")
+                log.error("Paypal has failed to update the billing plan having id=%s, state=%s" % (resource["id"], resource['state']))
                 log.error(str(ex))
-                return Response(data={"resource": "capture"}, status=status.HTTP_400_BAD_REQUEST)
+                return status.HTTP_400_BAD_REQUEST, {"error": "error", "id": resource["id"]}
 
+    if resource_type in ["agreement"]:
+        resource = payload.get("resource")
+        try:
+            agreement = BillingAgreement.objects.get(agreement_id=resource['id'])
+            if agreement.state.lower() != "cancelled":
+                if not updateBillingAgreement(agreement.id, resource):
+                    return status.HTTP_400_BAD_REQUEST, {"error": "Error in billing agreement update"}
 
+                log.info("Paypal has updated the billing agreement having id=%s, state=%s" % (resource['id'], resource['state']))
+                return status.HTTP_200_OK, {"resource": "agreement", "id": resource['id']}
 
-        if resource_type in ["refund"]:
-            resource = payload.get("resource")
-            try:
-                refund = Refund.objects.filter(refund_id=resource["id"])    
-                if refund.count() == 1:
-                    if updateRefund(refund[0].id, resource) == True:
-                        log.info("Paypal has updated the refund with id=%s, state=%s" % (refund[0].id, refund[0].state))
-                        return Response(data={"resource": "refund"}, status=status.HTTP_200_OK)
-                else:
-                    refund_id = insertRefund(resource)
-                    log.info("Paypal has inserted a refund with id=%s" % (resource["id"]))
-                    return Response(data={"resource": "refund"}, status=status.HTTP_200_OK)
-
-                raise Exception("Unhandled refund notification")
-            except Exception as ex: 
-                log.error("Paypal has failed to insert/update a refund")
-                log.error(str(ex))
-                return Response(data={"resource": "refund"}, status=status.HTTP_400_BAD_REQUEST)
+            raise Exception("Unhandled agreement notification")
+        except Exception as ex:
+            log.error("Paypal has failed to update the billing agreement having id=%s" % (resource["id"]))
+            log.error(str(ex))
+            return status.HTTP_400_BAD_REQUEST, {"error": "error", "id": resource['id']}
+
+    if resource_type in ['sale']:
+        resource = payload.get("resource")
+        try:
+            if Sale.objects.upsert(buildSale(resource), "sale_id"):
+                log.info("Paypal has inserted a sale with id=%s" % (resource["id"]))
+                return status.HTTP_201_CREATED, {"resource": "sale"}
+            log.info("Paypal has updated the sale with id=%s, state=%s" % (resource["id"], resource["state"]))
+            return status.HTTP_200_OK, {"resource": "sale"}
+        except Exception as ex:
+            log.error("Paypal has failed to insert/update a sale")
+            log.error(str(ex))
+            return status.HTTP_400_BAD_REQUEST, {"resource": "sale"}
+
+    if resource_type in ["authorization"]:
+        resource = payload.get("resource")
+        try:
+            if Authorization.objects.upsert(buildAuthorization(resource), "authorization_id"):
+                log.info("Paypal has inserted an authorization with id=%s" % (resource["id"]))
+                return status.HTTP_201_CREATED, {"resource": resource_type, "id": resource["id"]}
+            log.info("Paypal has updated the authorization payment with id=%s, state=%s" % (resource["id"], resource["state"]))
+            return status.HTTP_200_OK, {"resource": "authorization", "id": resource["id"]}
+        except Exception as ex:
+            log.error("Paypal has failed to insert/update an authorization")
+            log.error(str(ex))
+            return status.HTTP_400_BAD_REQUEST, {"resource": "authorization"}
 
-        return Response(data={}, status=status.HTTP_200_OK)
+    if resource_type in ["capture"]:
+        resource = payload.get("resource")
+        try:
+            if Capture.objects.upsert(buildCapture(resource), "capture_id"):
+                log.info("Paypal has sent a capture with id=%s" % (resource['id']))
+                return status.HTTP_201_CREATED, {"resource": resource_type}
+            log.info("Paypal has updated the capture with id=%s, state=%s" % (resource["id"], resource["state"]))
+            return status.HTTP_200_OK, {"resource": resource_type}
+        except Exception as ex:
+            log.error("Paypal has failed to insert/update a capture")
+            log.error(str(ex))
+            return status.HTTP_400_BAD_REQUEST, {"resource": "capture"}
 
+    if resource_type in ["refund"]:
+        resource = payload.get("resource")
+        try:
+            if Refund.objects.upsert(buildRefund(resource), "refund_id"):
+                log.info("Paypal has inserted a refund with id=%s" % (resource["id"]))
+            else:
+                log.info("Paypal has updated the refund with id=%s, state=%s" % (resource["id"], resource["state"]))
+            return status.HTTP_200_OK, {"resource": "refund"}
+        except Exception as ex: 
+            log.error("Paypal has failed to insert/update a refund")
+            log.error(str(ex))
+            return status.HTTP_400_BAD_REQUEST, {"resource": "refund"}
 
+    return status.HTTP_200_OK, {}
 
 
-# test endpoint for reporting
-class BillingAgreementsRetrieveApiView(generics.ListAPIView):
+class WebHookBatch(APIView):
+    """Batch listener for Paypal events
+
+    Receives a list of event notifications (i.e. the replay of a backlog) and applies them
+    in one transaction per WEBHOOK_INGEST['BATCH_SIZE'] events. The response reports the
+    outcome of every event in the order of the request.
+    """
+
+    def post(self, request, *args):
+        events = self.request.data
+        if isinstance(events, dict):
+            events = events.get("events")
+        if not isinstance(events, list):
+            return Response(data={"error": "A list of events is expected"}, status=status.HTTP_400_BAD_REQUEST)
+
+        for payload in events:
+            invalidatePaymentDetails(payload)
+
+        batch_size = getWebhookConfig()['BATCH_SIZE']
+        results = []
+        for offset in range(0, len(events), batch_size):
+            results.extend(applyWebhookEvents(events[offset:offset + batch_size]))
+        log.info("Paypal batch of %d notifications has been applied" % len(events))
+        return Response(data={"results": results}, status=status.HTTP_200_OK)
+
+
+def applyWebhookEvents(events):
+    """Apply a batch of webhook events in a single transaction
+
+    The events are deduplicated by their id, within the batch and against the stored
+    events (a redelivered event is acknowledged and not applied again), and grouped by
+    resource type. The sales, authorizations, captures and refunds are written with a
+    bulk insert and a bulk update per type; the rest of the events are applied one by one,
+    each in a savepoint that is rolled back if it fails. Only the applied events are
+    stored, so the redelivery of a failed event applies it.
+
+    :param events: the Paypal notifications
+    :type events: list
+    :returns: the outcome of every event ({"id", "status"}), in the order of the batch
+    :rtype: list
+    """
+    resources = {
+        "sale": (Sale, "sale_id", buildSale),
+        "authorization": (Authorization, "authorization_id", buildAuthorization),
+        "capture": (Capture, "capture_id", buildCapture),
+        "refund": (Refund, "refund_id", buildRefund),
+    }
+    results = [None] * len(events)
+    unique = collections.OrderedDict()
+    for (index, payload) in enumerate(events):
+        if not isinstance(payload, dict) or not all(payload.get(field) for field in ["id", "resource_type", "event_type"]):
+            results[index] = {"id": None, "status": status.HTTP_400_BAD_REQUEST, "error": "Invalid event"}
+        elif payload["id"] in unique:
+            results[index] = {"id": payload["id"], "status": status.HTTP_200_OK, "duplicate": True}
+        else:
+            unique[payload["id"]] = index
+
+    try:
+        with transaction.atomic():
+            stored = set(Event.objects.filter(event_id__in=list(unique)).values_list("event_id", flat=True))
+            for event_id in stored:
+                results[unique.pop(event_id)] = {"id": event_id, "status": status.HTTP_200_OK, "duplicate": True}
+
+            groups = collections.defaultdict(list)
+            for (event_id, index) in unique.items():
+                resource_type = events[index]["resource_type"].lower()
+                if resource_type in resources:
+                    groups[resource_type].append(index)
+                    continue
+                with transaction.atomic():
+                    (http_status, data) = applyWebhookEvent(events[index])
+                    if int(http_status) >= 400:
+                        transaction.set_rollback(True)
+                results[index] = {"id": event_id, "status": http_status}
+
+            for (resource_type, indexes) in groups.items():
+                applyResourceEvents(resources[resource_type], events, indexes, results)
+
+            Event.objects.bulk_create([
+                Event(
+                    event_id=event_id,
+                    resource_type=events[index].get("resource_type"),
+                    event_type=events[index].get("event_type"),
+                    json=str(events[index])
+                ) for (event_id, index) in unique.items() if int(results[index]["status"]) < 400
+            ])
+    except Exception as ex:
+        log.error("Error in the batch of %d webhook events: %s" % (len(events), str(ex)))
+        for (event_id, index) in unique.items():
+            results[index] = {"id": event_id, "status": status.HTTP_500_INTERNAL_SERVER_ERROR, "error": str(ex)}
+    return results
+
+def applyResourceEvents(resource, events, indexes, results):
+    """Insert or update in bulk the resources of the events of the same type
+
+    The resources cost a constant number of queries: the lookup of the stored rows, a
+    bulk insertion and a bulk update (split only where the database bounds the
+    parameters of a statement, i.e. SQLite). When a resource appears in many events,
+    the last event wins.
+
+    :param resource: the model, the Paypal id field and the build function of the resource type
+    :type resource: tuple
+    :param events: the batch of the Paypal notifications
+    :type events: list
+    :param indexes: the positions of the events of this resource type in the batch
+    :type indexes: list
+    :param results: the outcome of every event of the batch; updated in place
+    :type results: list
+    """
+    (model, key, build) = resource
+    entries = collections.OrderedDict()
+    for index in indexes:
+        payload = events[index]
+        try:
+            instance = build(payload.get("resource") or {})
+        except Exception as ex:
+            results[index] = {"id": payload["id"], "status": status.HTTP_400_BAD_REQUEST, "error": str(ex)}
+            continue
+        resource_id = getattr(instance, key)
+        positions = entries.pop(resource_id, (None, []))[1]
+        entries[resource_id] = (instance, positions + [index])
+
+    existing = dict(model.objects.filter(**{key + "__in": list(entries)}).values_list(key, "pk"))
+    model.objects.bulk_create([instance for (resource_id, (instance, positions)) in entries.items() if resource_id not in existing])
+
+    updates = [instance for (resource_id, (instance, positions)) in entries.items() if resource_id in existing]
+    for instance in updates:
+        instance.pk = existing[getattr(instance, key)]
+    fields = [field.name for field in model._meta.concrete_fields if not field.primary_key]
+    batch_size = connection.ops.bulk_batch_size(["pk", "value"] * len(fields) + ["pk"], updates) or 1
+    for start in range(0, len(updates), batch_size):
+        batch = updates[start:start + batch_size]
+        model.objects.filter(pk__in=[instance.pk for instance in batch]).update(**dict(
+            (name, bulkValue(model, name, batch)) for name in fields
+        ))
+
+    for (resource_id, (instance, positions)) in entries.items():
+        http_status = status.HTTP_200_OK if resource_id in existing else status.HTTP_201_CREATED
+        for index in positions:
+            results[index] = {"id": events[index]["id"], "status": http_status}
+
+
+
+
+class ReportApiView(generics.ListAPIView):
+    """Base class of the reporting endpoints
+
+    Lists the entries of the OpenAM client (Openam-Client header) newest first, optionally
+    within the [from, to) range of the keyset_field, using keyset pagination on (keyset_field, id).
+    """
+
+    pagination_class = KeysetPagination
+    keyset_field = "create_time"
+
+    def list(self, request, *args, **kwargs):
+        (headers_status, headers_message) = validateReportRequest(self.request.META)
+        if int(headers_status) != 200:
+            return Response(data=headers_message, status=headers_status)
+        return super(ReportApiView, self).list(request, *args, **kwargs)
+
+    def filterReport(self, queryset):
+        """Restrict the queryset to the client of the request and to the requested time range
+
+        :raises ValidationError: if a bound of the range is not a valid date-time
+        """
+        queryset = queryset.filter(client_id=self.request.META.get('HTTP_OPENAM_CLIENT'))
+        for (parameter, lookup) in [("from", "__gte"), ("to", "__lt")]:
+            value = self.request.query_params.get(parameter)
+            if value is None:
+                continue
+            try:
+                bound = utilities.parseDateTime(value)
+            except ValueError:
+                raise ValidationError({parameter: "Invalid date-time %s" % value})
+            queryset = queryset.filter(**{self.keyset_field + lookup: bound})
+        return queryset
+
+
+class BillingAgreementsRetrieveApiView(ReportApiView):
     """
         Retrieve a list of billing agreements
         ---
@@ -721,9 +1000,39 @@ class BillingAgreementsRetrieveApiView(generics.ListAPIView):
               - name: Openam-Client
                 description: The application's client_id in OpenAM
                 paramType: header
+                type: string
+                required: true
               - name: Openam-Client-Token
                 description: The user's access_token in the integrated with OpenAM application
                 paramType: header
+                type: string
+                required: true
+              - name: from
+                description: Lower bound (inclusive) of the start date, i.e. 2017-09-01T00:00:00Z
+                paramType: query
+                type: string
+                format: date-time
+              - name: to
+                description: Upper bound (exclusive) of the start date
+                paramType: query
+                type: string
+                format: date-time
+              - name: payer_id
+                description: The Paypal payer id of the user
+                paramType: query
+                type: string
+              - name: payer_email
+                description: The Paypal email of the user
+                paramType: query
+                type: string
+              - name: cursor
+                description: The position of the page, as returned in the "next" link
+                paramType: query
+                type: string
+              - name: page_size
+                description: Number of results per page
+                paramType: query
+                type: integer
 
             responseMessages:
               - code: 200
@@ -750,16 +1059,22 @@ class BillingAgreementsRetrieveApiView(generics.ListAPIView):
     """
 
     serializer_class = serializers.BillingAgreementSerializer
+    keyset_field = "start_date"
 
     def get_queryset(self):
         """Retrieve the billing agreements per application and specific user
         """
-        agreements_list = [10]
-        agreements = BillingAgreement.objects.filter(pk__in=set(list(agreements_list)))
+        agreements = self.filterReport(BillingAgreement.objects.with_json())
+        payer_id = self.request.query_params.get("payer_id")
+        if payer_id is not None:
+            agreements = agreements.filter(payer_id=payer_id)
+        payer_email = self.request.query_params.get("payer_email")
+        if payer_email is not None:
+            agreements = agreements.filter(payer_email=payer_email)
         return agreements
 
 
-class PaymentsRetrieveApiView(generics.ListAPIView):
+class PaymentsRetrieveApiView(ReportApiView):
     """
         Retrieve a list of payments
         ---
@@ -770,9 +1085,31 @@ class PaymentsRetrieveApiView(generics.ListAPIView):
               - name: Openam-Client
                 description: The application's client_id in OpenAM
                 paramType: header
+                type: string
+                required: true
               - name: Openam-Client-Token
                 description: The user's access_token in the integrated with OpenAM application
                 paramType: header
+                type: string
+                required: true
+              - name: from
+                description: Lower bound (inclusive) of the creation time, i.e. 2017-09-01T00:00:00Z
+                paramType: query
+                type: string
+                format: date-time
+              - name: to
+                description: Upper bound (exclusive) of the creation time
+                paramType: query
+                type: string
+                format: date-time
+              - name: cursor
+                description: The position of the page, as returned in the "next" link
+                paramType: query
+                type: string
+              - name: page_size
+                description: Number of results per page
+                paramType: query
+                type: integer
 
             responseMessages:
               - code: 200
@@ -799,24 +1136,147 @@ class PaymentsRetrieveApiView(generics.ListAPIView):
     """
 
     serializer_class = serializers.PaymentSerializer
+    keyset_field = "create_time"
 
     def get_queryset(self):
-        """Retrieve the payments per application and specific user
+        """Retrieve the payments per application
         """
-        payments_list = [8]
-        return Payment.objects.filter(pk__in=set(list(payments_list)))
+        return self.filterReport(Payment.objects.with_json())
+
+
+class ExportApiView(APIView):
+    """
+        Stream the payments, payment transactions, sales, refunds or captures of the client
+        ---
+        GET:
+            omit_parameters:
+              - form
+            parameters:
+              - name: Openam-Client
+                description: The application's client_id in OpenAM
+                paramType: header
+                type: string
+                required: true
+              - name: Openam-Client-Token
+                description: The user's access_token in the integrated with OpenAM application
+                paramType: header
+                type: string
+                required: true
+              - name: resource
+                description: payments, payment-transactions, sales, refunds or captures
+                paramType: path
+                type: string
+                required: true
+              - name: from
+                description: Lower bound (inclusive) of the creation time, i.e. 2017-09-01T00:00:00Z
+                paramType: query
+                type: string
+                format: date-time
+              - name: to
+                description: Upper bound (exclusive) of the creation time
+                paramType: query
+                type: string
+                format: date-time
+              - name: output
+                description: ndjson (default) or csv
+                paramType: query
+                type: string
+
+            responseMessages:
+              - code: 200
+                message: OK
+              - code: 400
+                message: Bad Request
+              - code: 401
+                message: Unauthorized
+              - code: 404
+                message: Not found
+              - code: 500
+                message: Internal Server Error
 
+            produces:
+              - application/x-ndjson
+              - text/csv
+    """
 
+    def get(self, request, resource, format=None):
+        (headers_status, headers_message) = validateReportRequest(request.META)
+        if int(headers_status) != 200:
+            return Response(data=headers_message, status=headers_status)
+
+        output = request.query_params.get("output", "ndjson")
+        if output not in export.EXPORT_FORMATS:
+            return Response(data={"output": "Supported formats: %s" % ", ".join(sorted(export.EXPORT_FORMATS))},
+                            status=status.HTTP_400_BAD_REQUEST)
+        bounds = []
+        for parameter in ["from", "to"]:
+            value = request.query_params.get(parameter)
+            try:
+                bounds.append(utilities.parseDateTime(value) if value is not None else None)
+            except ValueError:
+                return Response(data={parameter: "Invalid date-time %s" % value}, status=status.HTTP_400_BAD_REQUEST)
 
+        # the client that the token has been issued to (see validateReportRequest)
+        lines = export.exportRows(resource, headers_message["client_id"], bounds[0], bounds[1], output)
+        response = StreamingHttpResponse(lines, content_type=export.EXPORT_FORMATS[output])
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (resource, output)
+        return response
 
 
+class UpstreamsApiView(APIView):
+    """
+        State of the circuit breakers and the bulkheads of the OpenAM and Paypal calls (current process)
+
+        Only the METRICS['ALLOWED_ADDRESSES'] may read it, like /metrics, which exposes
+        the same state as gauges and counters.
+        ---
+        GET:
+            responseMessages:
+              - code: 200
+                message: OK
+              - code: 403
+                message: Forbidden
+            produces:
+              - application/json
+    """
+
+    def get(self, request, format=None):
+        if request.META.get('REMOTE_ADDR') not in metrics.getConfig()['ALLOWED_ADDRESSES']:
+            return Response(data={"error": "Forbidden"}, status=status.HTTP_403_FORBIDDEN)
+        return Response(data=resilience.stats(), status=status.HTTP_200_OK)
+
+
+def exposeMetrics(request):
+    """Serve the request duration histograms of the process (see api.metrics)
+
+    The metrics are in the Prometheus text format, or in the OpenMetrics format along
+    with the exemplar request ids if the Accept header asks for application/openmetrics-text.
+    Only the METRICS['ALLOWED_ADDRESSES'] may read them.
+
+    Use the endpoint: GET /metrics
+    """
+    if request.META.get('REMOTE_ADDR') not in metrics.getConfig()['ALLOWED_ADDRESSES']:
+        return HttpResponseForbidden()
+    openmetrics = "application/openmetrics-text" in request.META.get('HTTP_ACCEPT', "")
+    (body, content_type) = metrics.expose(openmetrics)
+    return HttpResponse(body, content_type=content_type)
+
+
+
+
+
+@metrics.timed("validation")
 def validateRequest(headers):
     """Validate the HTTP_OPENAM_CLIENT, HTTP_OPENAM_CLIENT_TOKEN and\
     HTTP_PAYPAL_ACCESS_TOKEN headers of the request
 
+    The OpenAM and the Paypal tokens are validated one after the other or, if
+    HEADERS_VALIDATION['MODE'] is "concurrent", in parallel.
+
     :param headers: the headers of the request
     :type headers: dictionary
-    :returns: the HTTP status and the relative message after the validation of headers
+    :returns: the HTTP status and the relative message after the validation of headers;
+        the identity of the OpenAM token (see api.openam.getIdentity) on success
     :rtype: tuple(integer, dictionary)
     """
     try:
@@ -834,27 +1294,171 @@ def validateRequest(headers):
             log.info("HTTP_PAYPAL_ACCESS_TOKEN header is missing")
             return 400, {"error": "PAYPAL_ACCESS_TOKEN is missing"}
 
-        # Validate user access token in OpenAM
-        ows = OpenamAuth()
-        openam_status, openam_response = ows.validateAccessToken(openam_access_token)
-        if int(openam_status) != 200:
-            log.info("Failed user authentication in OpenAM: HTTP status %d and message: %s" % (openam_status, openam_response))
-            return openam_status, json.loads(openam_response)
+        checks = [
+            (validateOpenamToken, openam_access_token),
+            (validatePaypalToken, paypal_access_token)
+        ]
+        if getValidationConfig()['MODE'] == "concurrent":
+            return runConcurrently(checks)
+
+        messages = dict()
+        for (check, token) in checks:
+            (check_status, check_message) = check(token)
+            if int(check_status) != 200:
+                return check_status, check_message
+            messages.update(check_message)
+        return 200, messages
+    except Exception as ex:
+        log.error("%s" % str(ex))
+        return 500, {"error": "Internal server error"}
+
+def validateHeaders(request):
+    """Validate the headers of a request once (see validateRequest)
+
+    The outcome is kept on the request, so the Idempotency-Key check (see
+    api.idempotency) and the view share the OpenAM and the Paypal calls.
+
+    :param request: the request
+    :type request: rest_framework.request.Request
+    :rtype: tuple(integer, dictionary)
+    """
+    if getattr(request, "headers_validation", None) is None:
+        request.headers_validation = validateRequest(request.META)
+    return request.headers_validation
+
+def validateReportRequest(headers):
+    """Validate the HTTP_OPENAM_CLIENT and HTTP_OPENAM_CLIENT_TOKEN headers of a reporting request
 
-        # Validate authorization token in Paypal
-        token = paypal.Token(paypal_access_token)
-        paypal_status, paypal_response = token.validate()
-        if int(paypal_status) != 200:
-            log.info("Failed authentication in Paypal: HTTP status %d and message: %s" % (paypal_status, paypal_response))
-            return paypal_status, json.loads(json.dumps(paypal_response))
+    The reports expose all the records of a client, so the HTTP_OPENAM_CLIENT must be
+    the client that OpenAM has issued the token to.
 
-        return 200, dict()
+    :param headers: the headers of the request
+    :type headers: dictionary
+    :returns: the HTTP status and the relative message after the validation of headers;
+        the identity of the token (see api.openam.getIdentity) on success
+    :rtype: tuple(integer, dictionary)
+    """
+    try:
+        if headers.get('HTTP_OPENAM_CLIENT', None) == None:
+            log.info("HTTP_OPENAM_CLIENT header is missing")
+            return 400, {"error": "OPENAM_CLIENT (client id) of application is missing. It is provided from OpenAM."}
+        if headers.get('HTTP_OPENAM_CLIENT_TOKEN', None) == None:
+            log.info("HTTP_OPENAM_CLIENT_TOKEN header is missing")
+            return 400, {"error": "OPENAM_CLIENT_TOKEN of user is missing. It is provided from OpenAM after successful user authentication"}
+        (openam_status, identity) = validateOpenamToken(headers['HTTP_OPENAM_CLIENT_TOKEN'])
+        if int(openam_status) != 200:
+            return openam_status, identity
+        if identity.get("client_id") != headers['HTTP_OPENAM_CLIENT']:
+            log.warn("OpenAM client %s has requested a report with a token of the client %s" %\
+                (headers['HTTP_OPENAM_CLIENT'], identity.get("client_id")))
+            return 403, {"error": "OPENAM_CLIENT does not match the client of the OPENAM_CLIENT_TOKEN"}
+        return 200, identity
     except Exception as ex:
         log.error("%s" % str(ex))
         return 500, {"error": "Internal server error"}
 
+def validateOpenamToken(openam_access_token):
+    """Validate the user access token in OpenAM
+
+    :param openam_access_token: the access token of the user
+    :type openam_access_token: string
+    :returns: the HTTP status and the relative message; the client_id and the user of
+        the token on success
+    :rtype: tuple(integer, dictionary)
+    """
+    ows = OpenamAuth()
+    openam_status, openam_response = ows.validateAccessToken(openam_access_token)
+    if int(openam_status) != 200:
+        log.info("Failed user authentication in OpenAM: HTTP status %d and message: %s" % (openam_status, openam_response))
+        return openam_status, json.loads(openam_response)
+    return 200, getIdentity(openam_response)
+
+def validatePaypalToken(paypal_access_token):
+    """Validate the authorization token in Paypal
+
+    :param paypal_access_token: the access token in Paypal
+    :type paypal_access_token: string
+    :returns: the HTTP status and the relative message
+    :rtype: tuple(integer, dictionary)
+    """
+    token = paypal.Token(paypal_access_token)
+    paypal_status, paypal_response = token.validate()
+    if int(paypal_status) != 200:
+        log.info("Failed authentication in Paypal: HTTP status %d and message: %s" % (paypal_status, paypal_response))
+        return paypal_status, paypal_response
+    return 200, dict()
+
+def getValidationConfig():
+    """Merge the HEADERS_VALIDATION settings with the default values"""
+    config = {"MODE": "sequential", "POOL_SIZE": 8, "TIMEOUT": 35}
+    config.update(getattr(settings, "HEADERS_VALIDATION", {}))
+    return config
+
+__validation_pool__ = {"pid": None, "pool": None}
+__validation_pool_lock__ = threading.Lock()
+
+def getValidationPool():
+    """Get the bounded thread pool of the concurrent validations (one per process)
+
+    :rtype: multiprocessing.pool.ThreadPool
+    """
+    pid = os.getpid()
+    if __validation_pool__["pid"] != pid:
+        with __validation_pool_lock__:
+            if __validation_pool__["pid"] != pid:
+                __validation_pool__["pool"] = ThreadPool(getValidationConfig()['POOL_SIZE'])
+                __validation_pool__["pid"] = pid
+    return __validation_pool__["pool"]
+
+def runConcurrently(checks):
+    """Run the validation checks in parallel and fail on the first rejection
+
+    The checks that have not started yet when a rejection arrives are skipped;
+    a check that is already waiting on its upstream completes in the background
+    and its outcome is discarded.
+
+    :param checks: a list of (function, argument) pairs; each function returns (status, message)
+    :type checks: list
+    :returns: the first rejection or HTTP 200 and the merged messages of the checks
+        if all the checks have passed
+    :rtype: tuple(integer, dictionary)
+    """
+    outcomes = Queue.Queue()
+    cancelled = threading.Event()
+
+    def run(check, argument):
+        if cancelled.is_set():
+            return
+        try:
+            outcomes.put(check(argument))
+        except Exception as ex:
+            log.error("Error in headers validation: %s" % str(ex))
+            outcomes.put((500, {"error": "Internal server error"}))
+
+    pool = getValidationPool()
+    for (check, argument) in checks:
+        pool.apply_async(metrics.bind(run), (check, argument))
+
+    try:
+        messages = dict()
+        for i in range(len(checks)):
+            (check_status, check_message) = outcomes.get(timeout=getValidationConfig()['TIMEOUT'])
+            if int(check_status) != 200:
+                return check_status, check_message
+            messages.update(check_message)
+        return 200, messages
+    except Queue.Empty:
+        log.error("Timeout in headers validation")
+        return 504, {"error": "Gateway timeout"}
+    finally:
+        cancelled.set()
+
+@metrics.timed("db")
 def insertPayment(client_id, payload, approval_url, paypal_payment):
-    """Create a new payment entry
+    """Create a new payment entry along with its transactions
+
+    The payment and its transactions are written in one transaction; the transactions
+    with a single bulk insertion.
 
     :param client_id: The application's client_id according to OpenAM
     :type client_id: string
@@ -878,45 +1482,68 @@ def insertPayment(client_id, payload, approval_url, paypal_payment):
             approval_url=approval_url,
             return_url=payload["redirect_urls"]["return_url"] if "return_url" in payload["redirect_urls"] else None,
             cancel_url=payload["redirect_urls"]["cancel_url"] if "cancel_url" in payload["redirect_urls"] else None,
-            json=json.dumps(utilities.object2dict(paypal_payment, False)),
+            json=utilities.toJson(paypal_payment),
             create_time=paypal_payment["create_time"],
-            update_time=paypal_payment["create_time"]
+            update_time=paypal_payment["create_time"],
+            sync_time=timezone.now()
         )
-        payment.save()
+        with transaction.atomic():
+            payment.save()
+            PaymentTransaction.objects.bulk_create([
+                buildPaymentTransaction(payment.id, paypal_transaction) for paypal_transaction in paypal_payment['transactions']
+            ])
         return payment.id
     except Exception as ex:
         log.error("Error in payment insertion: %s" % str(ex))
         return -1
 
-def insertPaymentTransaction(payment_id, paypal_transaction):
-    """Create a new payment  transaction entry
+@metrics.timed("db")
+def refreshPayment(paypal_payment):
+    """Replace the local copy of a payment with the one that Paypal has returned
+
+    The copy is served by the local reads of the payment details (see api.details)
+    until it becomes older than PAYMENT_LOCAL_READS['MAX_AGE'].
+
+    :param paypal_payment: Paypal payment
+    :type paypal_payment: object
+    :returns: True if the payment is stored locally, False in any other case
+    :rtype: bool
+    """
+    try:
+        return Payment.objects.filter(pay_id=paypal_payment["id"]).update(
+            state=paypal_payment["state"],
+            json=utilities.toJson(paypal_payment),
+            update_time=paypal_payment.get("update_time") or paypal_payment["create_time"],
+            sync_time=timezone.now()
+        ) > 0
+    except Exception as ex:
+        log.error("Error in payment refresh: %s" % str(ex))
+        return False
+
+def buildPaymentTransaction(payment_id, paypal_transaction):
+    """Build (without saving) a payment transaction entry
 
     :param payment_id: The primary key of the relative payment
     :type payment_id: integer
     :param paypal_transaction: Part of Paypal payment
     :type paypal_transaction: object
-    :returns: the payment ID if it has created or -1 in any other case
-    :rtype: integer
+    :returns: the unsaved payment transaction
+    :rtype: api.models.PaymentTransaction
     """
-    try:
-        transaction = PaymentTransaction(
-            payment_id=payment_id,
-            amount_value=paypal_transaction['amount']['total'],
-            amount_currency=paypal_transaction['amount']['currency'],
-            amount_details=json.dumps(utilities.object2dict(paypal_transaction['amount']['details'], False)) if 'details' in paypal_transaction['amount'] else '{}',
-            description=paypal_transaction['description'] if 'description' in paypal_transaction else None,
-            custom=paypal_transaction['custom'] if 'custom' in paypal_transaction else None,
-            invoice_number=paypal_transaction['invoice_number'] if 'invoice_number' in paypal_transaction else None,
-            soft_descriptor=paypal_transaction['soft_descriptor'] if 'soft_descriptor' in paypal_transaction else None,
-            item_list=json.dumps(utilities.object2dict(paypal_transaction['item_list'], False)),
-            json=json.dumps(utilities.object2dict(paypal_transaction, False))
-        )
-        transaction.save()
-        return transaction.id
-    except Exception as ex:
-        log.error("Error in payment transaction insertion: %s" % str(ex))
-        return -1
-
+    return PaymentTransaction(
+        payment_id=payment_id,
+        amount_value=paypal_transaction['amount']['total'],
+        amount_currency=paypal_transaction['amount']['currency'],
+        amount_details=utilities.toJson(paypal_transaction['amount']['details']) if 'details' in paypal_transaction['amount'] else '{}',
+        description=paypal_transaction['description'] if 'description' in paypal_transaction else None,
+        custom=paypal_transaction['custom'] if 'custom' in paypal_transaction else None,
+        invoice_number=paypal_transaction['invoice_number'] if 'invoice_number' in paypal_transaction else None,
+        soft_descriptor=paypal_transaction['soft_descriptor'] if 'soft_descriptor' in paypal_transaction else None,
+        item_list=utilities.toJson(paypal_transaction['item_list']),
+        json=utilities.toJson(paypal_transaction)
+    )
+
+@metrics.timed("db")
 def insertBillingplan(paypal_billing_plan, client_id):
     """Create a new billing plan entry
 
@@ -956,7 +1583,7 @@ def insertBillingplan(paypal_billing_plan, client_id):
             merchant_preferences_fee_currency =merchant_preferences_fee_currency,
             return_url=return_url,
             cancel_url=cancel_url,
-            json=json.dumps(utilities.object2dict(paypal_billing_plan, False)),
+            json=utilities.toJson(paypal_billing_plan),
             create_time=paypal_billing_plan["create_time"],
             update_time=paypal_billing_plan["create_time"]
         )
@@ -967,6 +1594,7 @@ def insertBillingplan(paypal_billing_plan, client_id):
         log.error("Error in billing plan insertion: %s" % str(ex))
         return -1
 
+@metrics.timed("db")
 def updateBillingPlan(pk, paypal_billing_plan):
     """Update an existing billing plan entry
 
@@ -1005,7 +1633,7 @@ def updateBillingPlan(pk, paypal_billing_plan):
             merchant_preferences_fee_currency =merchant_preferences_fee_currency,
             return_url=return_url,
             cancel_url=cancel_url,
-            json=json.dumps(utilities.object2dict(paypal_billing_plan, False)),
+            json=utilities.toJson(paypal_billing_plan),
             update_time=paypal_billing_plan["update_time"]
         )
         return True
@@ -1013,105 +1641,83 @@ def updateBillingPlan(pk, paypal_billing_plan):
         log.error("Error in billing plan modification (is:=%d): %s" % (pk, str(ex)) )
         return False
 
-def insertBillingPlanPaymentDefinition(paypal_payment_definition, billing_plan_id):
-    """Create a new billing plan payment definition 
+def buildBillingPlanPaymentDefinition(paypal_payment_definition, billing_plan_id):
+    """Build (without saving) a billing plan payment definition
 
     :param paypal_payment_definition: Paypal billing plan payment definition
     :type paypal_payment_definition: object
     :param billing_plan_id: ID of the associated billing plan
     :type billing_plan_id: integer
-    :returns: the billing plan payment definition ID if it has created or -1 in any other case
-    :rtype: integer
+    :returns: the unsaved payment definition
+    :rtype: api.models.BillingPlanPaymentDefinition
     """
-    try:
-        try:
-            frequency_interval = paypal_payment_definition['frequency_interval']
-        except:
-            frequency_interval = None
-        try:
-            cycles = paypal_payment_definition['cycles']
-        except:
-            cycles = None
-        try:
-            charge_models = paypal_payment_definition['charge_models']
-        except:
-            charge_models = dict()
-        try:
-            amount_value = paypal_payment_definition['amount']['value']
-        except:
-            amount_value = None
-        try:
-            amount_currency = paypal_payment_definition['amount']['currency']
-        except:
-            amount_currency = None
-
-        payment_definition = BillingPlanPaymentDefinition(
-            billing_plan_id=billing_plan_id,
-            definition_id=paypal_payment_definition['id'],
-            name=paypal_payment_definition['name'],
-            type=paypal_payment_definition['type'],
-            frequency=paypal_payment_definition['frequency'],
-            frequency_interval=frequency_interval,
-            cycles=cycles,
-            charge_models=json.dumps(utilities.object2dict(charge_models, False)),
-            amount_value=amount_value,
-            amount_currency=amount_currency,
-            json=json.dumps(utilities.object2dict(paypal_payment_definition, False))
-        )
-        payment_definition.save()
-        return payment_definition.id
-    except Exception as ex:
-        log.error("Error in billing plan's payment definition insertion: %s" % str(ex))
-        return -1
-
-def updateBillingPlanPaymentDefinition(pk, paypal_payment_definition):
-    """Update an existing payment definition of a billing plan
+    return BillingPlanPaymentDefinition(
+        billing_plan_id=billing_plan_id,
+        definition_id=paypal_payment_definition['id'],
+        name=paypal_payment_definition['name'],
+        type=paypal_payment_definition['type'],
+        frequency=paypal_payment_definition['frequency'],
+        frequency_interval=paypal_payment_definition.get('frequency_interval', None),
+        cycles=paypal_payment_definition.get('cycles', None),
+        charge_models=utilities.toJson(paypal_payment_definition.get('charge_models', dict())),
+        amount_value=paypal_payment_definition.get('amount', {}).get('value', None),
+        amount_currency=paypal_payment_definition.get('amount', {}).get('currency', None),
+        json=utilities.toJson(paypal_payment_definition)
+    )
+
+@metrics.timed("db")
+def syncBillingPlanPaymentDefinitions(billing_plan_id, paypal_payment_definitions):
+    """Insert the new and update the existing payment definitions of a billing plan
+
+    The definitions are written in one transaction with a constant number of queries:
+    the lookup of the stored definitions, a bulk insertion and a bulk update.
 
-    :param pk: the primary key of the payment definition (associated with a billing plan)
-    :type pk: integer 
-    :param paypal_payment_definition: Paypal billing plan payment definition
-    :type paypal_payment_definition: object
-    :returns: True for successful update or False in any other case
+    :param billing_plan_id: ID of the associated billing plan
+    :type billing_plan_id: integer
+    :param paypal_payment_definitions: Paypal billing plan payment definitions
+    :type paypal_payment_definitions: list
+    :returns: True for success or False in any other case
     :rtype: bool
     """
     try:
-        try:
-            frequency_interval = paypal_payment_definition['frequency_interval']
-        except:
-            frequency_interval = None
-        try:
-            cycles = paypal_payment_definition['cycles']
-        except:
-            cycles = None
-        try:
-            charge_models = paypal_payment_definition['charge_models']
-        except:
-            charge_models = dict()
-        try:
-            amount_value = paypal_payment_definition['amount']['value']
-        except:
-            amount_value = None
-        try:
-            amount_currency = paypal_payment_definition['amount']['currency']
-        except:
-            amount_currency = None
-
-        BillingPlanPaymentDefinition.objects.filter(pk=pk).update(
-            name=paypal_payment_definition['name'],
-            type=paypal_payment_definition['type'],
-            frequency=paypal_payment_definition['frequency'],
-            frequency_interval=frequency_interval,
-            cycles=cycles,
-            charge_models=json.dumps(utilities.object2dict(charge_models, False)),
-            amount_value=amount_value,
-            amount_currency=amount_currency,
-            json=json.dumps(utilities.object2dict(paypal_payment_definition, False))
-        )
+        definitions = [buildBillingPlanPaymentDefinition(definition, billing_plan_id) for definition in paypal_payment_definitions]
+        with transaction.atomic():
+            existing = dict(BillingPlanPaymentDefinition.objects.filter(billing_plan_id=billing_plan_id)\
+                .values_list("definition_id", "pk"))
+            BillingPlanPaymentDefinition.objects.bulk_create(
+                [definition for definition in definitions if definition.definition_id not in existing]
+            )
+
+            updates = [definition for definition in definitions if definition.definition_id in existing]
+            if updates:
+                for definition in updates:
+                    definition.pk = existing[definition.definition_id]
+                fields = ["name", "type", "frequency", "frequency_interval", "cycles", "charge_models",
+                          "amount_value", "amount_currency", "json"]
+                BillingPlanPaymentDefinition.objects.filter(pk__in=[definition.pk for definition in updates]).update(**dict(
+                    (name, bulkValue(BillingPlanPaymentDefinition, name, updates)) for name in fields
+                ))
         return True
     except Exception as ex:
-        log.error("Error in billing plan's payment definition modification (pk:=%d): %s" % (pk, str(ex)) )
+        log.error("Error in the payment definitions of the billing plan (pk:=%d): %s" % (billing_plan_id, str(ex)))
         return False
 
+def bulkValue(model, name, instances):
+    """Get the CASE expression that sets a field of many rows to their own values in a single UPDATE
+
+    :param model: the model of the instances
+    :param name: the name of the field
+    :type name: string
+    :param instances: the instances with their primary keys
+    :type instances: list
+    """
+    field = model._meta.get_field(name)
+    return Case(
+        *[When(pk=instance.pk, then=Value(getattr(instance, field.attname), output_field=field)) for instance in instances],
+        output_field=field
+    )
+
+@metrics.timed("db")
 def insertBillingAgreement(paypal_billing_agreement, client_id):
     """Create a new billing agreement (related to existing plan)
 
@@ -1158,7 +1764,7 @@ def insertBillingAgreement(paypal_billing_agreement, client_id):
             num_cycles_completed = None,
             num_cycles_remaining = None,
             failed_payment_count = None,
-            json = json.dumps(utilities.object2dict(paypal_billing_agreement, False)),
+            json = utilities.toJson(paypal_billing_agreement),
             start_date=paypal_billing_agreement['start_date']
         )
         agreement.save()
@@ -1168,6 +1774,7 @@ def insertBillingAgreement(paypal_billing_agreement, client_id):
         log.error("Error in billing agreement insertion: %s" % str(ex))
         return -1
 
+@metrics.timed("db")
 def updateBillingAgreement(pk, paypal_billing_agreement):
     """Update the billing agreement with the primary key pk
 
@@ -1215,261 +1822,112 @@ def updateBillingAgreement(pk, paypal_billing_agreement):
             num_cycles_completed = num_cycles_completed,
             num_cycles_remaining = num_cycles_remaining,
             failed_payment_count = failed_payment_count,
-            json = json.dumps(utilities.object2dict(paypal_billing_agreement, False))
+            json = utilities.toJson(paypal_billing_agreement)
         )
         return True
     except Exception as ex:
         log.error("Error in billing agreement modification (pk:=%d): %s" % (pk, str(ex)) )
         return False
 
-def insertSale(paypal_sale):
-    """Create a new sale. It is associated either with a billing agreement or a payment.
+def buildSale(paypal_sale):
+    """Build (without saving) a sale entry from its Paypal representation
 
     :param paypal_sale: Paypal payment as sale intent
     :type paypal_sale: object
-    :returns: the sale ID if it has created or -1 in any other case
-    :rtype: integer
-    """
-    try:
-        sale = Sale(
-            sale_id=paypal_sale['id'],
-            amount_value=paypal_sale.get('amount', {}).get('total', None),
-            amount_currency=paypal_sale.get('amount', {}).get('currency', None),
-            state=paypal_sale['state'],
-            transaction_value=paypal_sale.get('transaction_fee', {}).get('value', None),
-            transaction_currency=paypal_sale.get('transaction_fee', {}).get('currency', None),
-            billing_agreement_id=paypal_sale.get('billing_agreement_id', None),
-            payment_mode=paypal_sale['payment_mode'],
-            parent_payment=paypal_sale.get('parent_payment', None),
-            reason_code=paypal_sale.get('reason_code', None),
-            protection_eligibility=paypal_sale.get('protection_eligibility', None),
-            protection_eligibility_type=paypal_sale.get('protection_eligibility_type', None),
-            json=json.dumps(utilities.object2dict(paypal_sale, False)),
-            create_time=paypal_sale["create_time"],
-            update_time=paypal_sale["update_time"]
-        )
-        sale.save()
-        return sale.sale_id
-    except Exception as ex:
-        log.error("Error in sale insertion: %s" % str(ex))
-        return -1
-
-def updateSale(pk, paypal_sale):
-    """Update the sale with a specific primary key
-
-    :param pk: ID of the associated sale
-    :type pk: integer
-    :param paypal_sale: Paypal sale
-    :type paypal_sale: object
-    :returns: True for success update; False in any other case
-    :rtype: bool
+    :returns: the unsaved sale
+    :rtype: api.models.Sale
     """
-    try:
-        Sale.objects.filter(pk=pk).update(
-            amount_value=paypal_sale['amount']['total'],
-            amount_currency=paypal_sale['amount']['currency'],
-            state=paypal_sale['state'],
-            transaction_value=paypal_sale['transaction_fee']['value'] if 'transaction_fee' in paypal_sale else None,
-            transaction_currency=paypal_sale['transaction_fee']['currency'] if 'transaction_fee' in paypal_sale else None,
-            billing_agreement_id=paypal_sale['billing_agreement_id'] if 'billing_agreement_id' in paypal_sale else None,
-            payment_mode=paypal_sale['payment_mode'],
-            parent_payment=paypal_sale['parent_payment'] if 'parent_payment' in paypal_sale else None,
-            reason_code=paypal_sale['reason_code'] if 'reason_code' in paypal_sale else None,
-            protection_eligibility=paypal_sale['protection_eligibility'] if 'protection_eligibility' in paypal_sale else None,
-            protection_eligibility_type=paypal_sale['protection_eligibility_type'] if 'protection_eligibility_type' in paypal_sale else None,
-            json=json.dumps(utilities.object2dict(paypal_sale, False)),
-            create_time=paypal_sale["create_time"],
-            update_time=paypal_sale["update_time"]
-        )
-        return True
-    except Exception as ex:
-        log.error("An exception has been arisen in the modification of the sale_id=%s. %s" % (paypal_sale['id'], str(ex)))
-        return False
-
-def insertAuthorization(paypal_authorization):
-    """Create a new authorization. It is associated with a future payment.
+    return Sale(
+        sale_id=paypal_sale['id'],
+        amount_value=paypal_sale.get('amount', {}).get('total', None),
+        amount_currency=paypal_sale.get('amount', {}).get('currency', None),
+        state=paypal_sale['state'],
+        transaction_value=paypal_sale.get('transaction_fee', {}).get('value', None),
+        transaction_currency=paypal_sale.get('transaction_fee', {}).get('currency', None),
+        billing_agreement_id=paypal_sale.get('billing_agreement_id', None),
+        payment_mode=paypal_sale['payment_mode'],
+        parent_payment=paypal_sale.get('parent_payment', None),
+        reason_code=paypal_sale.get('reason_code', None),
+        protection_eligibility=paypal_sale.get('protection_eligibility', None),
+        protection_eligibility_type=paypal_sale.get('protection_eligibility_type', None),
+        json=utilities.toJson(paypal_sale),
+        create_time=paypal_sale["create_time"],
+        update_time=paypal_sale["update_time"]
+    )
+
+def buildAuthorization(paypal_authorization):
+    """Build (without saving) a authorization entry from its Paypal representation
 
     :param paypal_authorization: Paypal payment as authorization intent
     :type paypal_authorization: dictionary
-    :returns: the authorization ID if it has created or -1 in any other case
-    :rtype: integer
+    :returns: the unsaved authorization
+    :rtype: api.models.Authorization
     """
-    try:
-        authorization = Authorization(
-            authorization_id=paypal_authorization['id'],
-            amount_value=paypal_authorization.get('amount', {}).get('total', None),
-            amount_currency=paypal_authorization.get('amount', {}).get('currency', None),
-            state=paypal_authorization['state'],
-            transaction_value=paypal_authorization.get('transaction_fee', {}).get('value', None),
-            transaction_currency=paypal_authorization.get('transaction_fee', {}).get('currency', None),
-            payment_mode=paypal_authorization['payment_mode'],
-            parent_payment=paypal_authorization.get('parent_payment', None),
-            reason_code=paypal_authorization.get('reason_code', None),
-            protection_eligibility=paypal_authorization.get('protection_eligibility', None),
-            protection_eligibility_type=paypal_authorization.get('protection_eligibility_type', None),
-            json=json.dumps(utilities.object2dict(paypal_authorization, False)),
-            valid_until=paypal_authorization["valid_until"],
-            create_time=paypal_authorization["create_time"],
-            update_time=paypal_authorization["update_time"]
-        )
-        authorization.save()
-        return authorization.authorization_id
-    except Exception as ex:
-        log.error("Error in authorization insertion: %s" % str(ex))
-        return -1
-
-def updateAuthorization(pk, paypal_authorization):
-    """Update the authorization with a specific primary key
+    return Authorization(
+        authorization_id=paypal_authorization['id'],
+        amount_value=paypal_authorization.get('amount', {}).get('total', None),
+        amount_currency=paypal_authorization.get('amount', {}).get('currency', None),
+        state=paypal_authorization['state'],
+        transaction_value=paypal_authorization.get('transaction_fee', {}).get('value', None),
+        transaction_currency=paypal_authorization.get('transaction_fee', {}).get('currency', None),
+        payment_mode=paypal_authorization['payment_mode'],
+        parent_payment=paypal_authorization.get('parent_payment', None),
+        reason_code=paypal_authorization.get('reason_code', None),
+        protection_eligibility=paypal_authorization.get('protection_eligibility', None),
+        protection_eligibility_type=paypal_authorization.get('protection_eligibility_type', None),
+        json=utilities.toJson(paypal_authorization),
+        valid_until=paypal_authorization["valid_until"],
+        create_time=paypal_authorization["create_time"],
+        update_time=paypal_authorization["update_time"]
+    )
+
+def buildCapture(paypal_capture):
+    """Build (without saving) a capture entry from its Paypal representation
 
-    :param pk: ID of the associated authorization
-    :type pk: integer
-    :param paypal_authorization: Paypal authorization
-    :type paypal_authorization: object
-    :returns: True for success update; False in any other case
-    :rtype: bool
-    """
-    try:
-        Authorization.objects.filter(pk=pk).update(
-            amount_value=paypal_authorization['amount']['total'],
-            amount_currency=paypal_authorization['amount']['currency'],
-            state=paypal_authorization['state'],
-            transaction_value=paypal_authorization['transaction_fee']['value'] if 'transaction_fee' in paypal_authorization else None,
-            transaction_currency=paypal_authorization['transaction_fee']['currency'] if 'transaction_fee' in paypal_authorization else None,
-            payment_mode=paypal_authorization['payment_mode'],
-            parent_payment=paypal_authorization['parent_payment'] if 'parent_payment' in paypal_authorization else None,
-            reason_code=paypal_authorization['reason_code'] if 'reason_code' in paypal_authorization else None,
-            protection_eligibility=paypal_authorization['protection_eligibility'] if 'protection_eligibility' in paypal_authorization else None,
-            protection_eligibility_type=paypal_authorization['protection_eligibility_type'] if 'protection_eligibility_type' in paypal_authorization else None,
-            json=json.dumps(utilities.object2dict(paypal_authorization, False)),
-            valid_until=paypal_authorization["valid_until"],
-            create_time=paypal_authorization["create_time"],
-            update_time=paypal_authorization["update_time"]
-        )
-        return True
-    except Exception as ex:
-        log.error("Error in authorization modification (pk:=%d): %s" % (pk, str(ex)) )
-        return False
-
-
-def insertCapture(paypal_capture):
-    """Insert a capture for an authorization
-
-    :param paypal_capture: Paypal capture
-    :type paypal_capture: dictionary
-    :returns: The capture id on success; Otherwise, -1 
-    :rtype: integer
-    """
-    try:
-        capture = Capture(
-            capture_id=paypal_capture.get('id', None),
-            amount_value=paypal_capture.get('amount', {}).get('total', None),
-            amount_currency=paypal_capture.get('amount', {}).get('currency', None),
-            state=paypal_capture['state'],
-            transaction_fee_value=paypal_capture.get('transaction_fee', {}).get('value', None),
-            transaction_fee_currency=paypal_capture.get('transaction_fee', {}).get('currency', None),
-            is_final_capture=paypal_capture.get('is_final_capture', False),
-            reason_code=paypal_capture.get('reasonCode', None),
-            parent_payment=paypal_capture.get('parent_payment', None),
-            json=json.dumps(utilities.object2dict(paypal_capture, False)),
-            create_time=paypal_capture['create_time'],
-            update_time=paypal_capture.get('update_time', paypal_capture['create_time'])
-        )
-        capture.save()
-        return capture.id
-    except Exception as ex:
-        log.error("Error in capture insertion: %s" % str(ex))
-        return -1
-
-def updateCapture(pk, paypal_capture):
-    """Update an existing capture (associated with an authorization payment)
-
-    :param pk: The capture id
-    :type pk: integer
     :param paypal_capture: Paypal capture
     :type paypal_capture: dictionary
-    :returns: True for success update; False in any other case
-    :rtype: bool
-    """
-    try:
-        capture = Capture.objects.filter(pk=pk).update(
-            amount_value=paypal_capture.get('amount', {}).get('total', None),
-            amount_currency=paypal_capture.get('amount', {}).get('currency', None),
-            state=paypal_capture['state'],
-            transaction_fee_value=paypal_capture.get('transaction_fee', {}).get('value', None),
-            transaction_fee_currency=paypal_capture.get('transaction_fee', {}).get('currency', None),
-            is_final_capture=paypal_capture.get('is_final_capture', False),
-            reason_code=paypal_capture.get('reasonCode', None),
-            parent_payment=paypal_capture.get('parent_payment', None),
-            json=json.dumps(utilities.object2dict(paypal_capture, False)),
-            create_time=paypal_capture['create_time'],
-            update_time=paypal_capture.get('update_time', paypal_capture['create_time'])
-        )
-        return True
-    except Exception as ex:
-        log.error("Error in capture modification: %s" % str(ex))
-        return False
-
-def insertRefund(paypal_refund):
-    """Store a refund action. It is associated either with a billing agreement or a payment transaction.
-
-    :param paypal_refund: Paypal refund
-    :type paypal_refund: dictionary
-    :returns: the refund ID if it has created or -1 in any other case
-    :rtype: integer
+    :returns: the unsaved capture
+    :rtype: api.models.Capture
     """
-    try:
-        refund = Refund(
-            sale_id=paypal_refund.get('sale_id', None),
-            capture_id=paypal_refund.get('capture_id', None),
-            description=paypal_refund.get('description', None),
-            amount_value=paypal_refund.get('amount', {}).get('total', None),
-            amount_currency=paypal_refund.get('amount', {}).get('currency', None),
-            state=paypal_refund['state'],
-            reason=paypal_refund.get('reason', None),
-            parent_payment=paypal_refund.get('parent_payment', None),
-            invoice_number=paypal_refund.get('invoice_number', None),
-            custom=paypal_refund.get('custom', None),
-            json=json.dumps(utilities.object2dict(paypal_refund, False)),
-            create_time=paypal_refund['create_time'],
-            update_time=paypal_refund.get('update_time', paypal_refund['create_time'])
-        )
-        refund.save()
-        return refund.id
-    except Exception as ex:
-        log.error("Error in refund insertion: %s" % str(ex))
-        return -1
-
-def updateRefund(pk, paypal_refund):
-    """Update the a refund
+    return Capture(
+        capture_id=paypal_capture.get('id', None),
+        amount_value=paypal_capture.get('amount', {}).get('total', None),
+        amount_currency=paypal_capture.get('amount', {}).get('currency', None),
+        state=paypal_capture['state'],
+        transaction_fee_value=paypal_capture.get('transaction_fee', {}).get('value', None),
+        transaction_fee_currency=paypal_capture.get('transaction_fee', {}).get('currency', None),
+        is_final_capture=paypal_capture.get('is_final_capture', False),
+        reason_code=paypal_capture.get('reasonCode', None),
+        parent_payment=paypal_capture.get('parent_payment', None),
+        json=utilities.toJson(paypal_capture),
+        create_time=paypal_capture['create_time'],
+        update_time=paypal_capture.get('update_time', paypal_capture['create_time'])
+    )
+
+def buildRefund(paypal_refund):
+    """Build (without saving) a refund entry from its Paypal representation
 
-    :param pk: ID of refund entry
-    :type pk: integer    
     :param paypal_refund: Paypal refund
     :type paypal_refund: dictionary
-    :returns: True for update or False in any other case
-    :rtype: bool
+    :returns: the unsaved refund
+    :rtype: api.models.Refund
     """
-
-    try:
-        refund = Refund.objects.filter(pk=pk).update(
-            description=paypal_refund.get('description', None),
-            amount_value=paypal_refund.get('amount', {}).get('total', None),
-            amount_currency=paypal_refund.get('amount', {}).get('currency', None),
-            state=paypal_refund['state'],
-            reason=paypal_refund.get('reason', None),
-            parent_payment=paypal_refund.get('parent_payment', None),
-            invoice_number=paypal_refund.get('invoice_number', None),
-            custom=paypal_refund.get('custom', None),
-            json=json.dumps(utilities.object2dict(paypal_refund, False)),
-            create_time=paypal_refund['create_time'],
-            update_time=paypal_refund.get('update_time', paypal_refund['create_time'])
-        )
-        refund.save()
-        return True
-    except Exception as ex:
-        log.error("Error in refund modification: %s" % str(ex))
-        return False
-
+    return Refund(
+        refund_id=paypal_refund['id'],
+        sale_id=paypal_refund.get('sale_id', None),
+        capture_id=paypal_refund.get('capture_id', None),
+        description=paypal_refund.get('description', None),
+        amount_value=paypal_refund.get('amount', {}).get('total', None),
+        amount_currency=paypal_refund.get('amount', {}).get('currency', None),
+        state=paypal_refund['state'],
+        reason=paypal_refund.get('reason', None),
+        parent_payment=paypal_refund.get('parent_payment', None),
+        invoice_number=paypal_refund.get('invoice_number', None),
+        custom=paypal_refund.get('custom', None),
+        json=utilities.toJson(paypal_refund),
+        create_time=paypal_refund['create_time'],
+        update_time=paypal_refund.get('update_time', paypal_refund['create_time'])
+    )
 
 class PaymentShowDetailsApiView(APIView):
     """
@@ -1519,18 +1977,28 @@ class PaymentShowDetailsApiView(APIView):
         Show payment details via the Paypal Payments API 
 
         Use the endpoint: GET /v1/payments/payment
+
+        Every lookup is written to the transaction log, also when it is served from the
+        cache or the local copy (see the X-Payment-Source header).
         """
         try:
             if 'HTTP_AUTHORIZATION' in request.META:
                 auth = request.META['HTTP_AUTHORIZATION'].split()
                 if len(auth) == 2:
                     if auth[0].lower() == "bearer":
-                        headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer '+ auth[1]}
-                        id = insertPaymentTransactionLog(payment_token, "info", None)
-                        paypal_response = requests.get('https://api.sandbox.paypal.com/v1/payments/payment/' + payment_token, headers=headers)
-                        paypal_data = paypal_response.json()
-                        updatePaymentTransactionLog(id, json.dumps(paypal_data))
-                        return Response(paypal_data, status = paypal_response.status_code)
+                        payment = paypal.Payment(auth[1])
+                        local = details.getLocalDetails if details.getConfig()['ENABLED'] else None
+                        (http_status, paypal_data, etag, source) = payment.cachedDetails(payment_token, local)
+                        auditlog.record(payment_token, "info", None, utilities.toJson(paypal_data))
+                        if source == "paypal" and etag is not None:
+                            refreshPayment(paypal_data)
+                        headers = {"X-Payment-Source": source}
+                        if etag is None:
+                            return Response(paypal_data, status = http_status, headers=headers)
+                        headers["ETag"] = quote_etag(etag)
+                        if isNotModified(request, etag):
+                            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+                        return Response(paypal_data, status = http_status, headers=headers)
             return Response(data={"error": auth}, status = status.HTTP_400_BAD_REQUEST)
         except Exception as ex:
             log.error("PaymentShowDetailsApiView: Error: %s" % str(ex))
@@ -1538,6 +2006,22 @@ class PaymentShowDetailsApiView(APIView):
             return Response(data={}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def isNotModified(request, etag):
+    """Check if the If-None-Match header of a request matches an entity tag
+
+    :param etag: the unquoted entity tag of the current response
+    :type etag: string
+    :rtype: bool
+    """
+    header = request.META.get("HTTP_IF_NONE_MATCH")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # weak comparison (RFC 7232): parse_etags drops the W/ prefix
+    return etag in parse_etags(header)
+
+
 class PaymentExecuteApiView(APIView):
     """
         Execute Payment
@@ -1621,14 +2105,14 @@ class PaymentExecuteApiView(APIView):
                 return Response(data=headers_message, status=headers_status)
 
             # Load the payment payload
-            payload = json.loads(json.dumps(request.data))
-            log.debug(payload)
-
-            if type(payload) is not dict:
+            serializer = serializers.PaymentExecutePayloadSerializer(data=request.data)
+            if not serializer.is_valid():
                 log.warn( "OpenAM client %s has sent invalid payment payload" % self.request.META.get('HTTP_OPENAM_CLIENT'))
-                return Response(data={"error": "Invalid json format", "status": status.HTTP_400_BAD_REQUEST}, 
+                return Response(data={"error": "Invalid json format", "status": status.HTTP_400_BAD_REQUEST, "details": serializer.errors}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            payload = serializer.validated_data
+            log.debug(payload)
 
             # Create the payment in paypal
             payment = paypal.Payment(self.request.META.get('HTTP_PAYPAL_ACCESS_TOKEN', None))
@@ -1638,6 +2122,11 @@ class PaymentExecuteApiView(APIView):
                     (self.request.META.get('HTTP_OPENAM_CLIENT'), http_status, json.dumps(paypal_payment)))
                 return Response(data=paypal_payment, status=http_status)
 
+            # Keep the executed payment as the local copy of its details
+            paypal.Payment.invalidate(payment_token)
+            paypal.Payment.authorize(payment_token, self.request.META.get('HTTP_PAYPAL_ACCESS_TOKEN', None))
+            refreshPayment(paypal_payment)
+
             return Response(
                 data=utilities.object2dict(paypal_payment, False), 
                 status=status.HTTP_200_OK
@@ -1648,34 +2137,3 @@ class PaymentExecuteApiView(APIView):
                  (self.request.META.get('HTTP_OPENAM_CLIENT'), self.request.META.get('HTTP_OPENAM_CLIENT_TOKEN')[0:14]))
             log.error(str(ex))
             return Response(data={}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-
-def insertPaymentTransactionLog(_payment_id, _transaction_type, request):
-    try:
-        logEntry = PaymentTransactionLog(
-            payment_id=_payment_id,
-            transaction_type=_transaction_type,
-            request_json=request,
-            create_time=datetime.datetime.utcnow(),
-            update_time=datetime.datetime.utcnow()
-        )
-        logEntry.save()
-        return logEntry.id
-    except Exception as ex:
-        log.error("Error in insertPaymentTransactionLog: %s" % str(ex))
-        raise ex
-        return -1
-
-
-def updatePaymentTransactionLog(pk, response):
-
-    try:
-        PaymentTransactionLog.objects.filter(pk=pk).update(
-            response_json=response,
-            update_time=datetime.datetime.utcnow()
-        )
-        return True
-    except Exception as ex:
-        log.error("Error in updatePaymentTransactionLog: %s" % str(ex))
-        raise ex
-        return False
@@ -2,7 +2,7 @@
 Django settings for Payment project.
 """
 
-from os import path
+from os import path, environ
 from django.utils.translation import ugettext_lazy as _
 
 PROJECT_ROOT = path.dirname(path.abspath(path.dirname(__file__)))
@@ -25,7 +25,7 @@ MANAGERS = ADMINS
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        'ENGINE': 'api.backends.mysql',    # django.db.backends.mysql with DATABASE_CONNECTIONS
         'NAME': 'payment',
         'USER': 'root',
         'PASSWORD': '',
@@ -34,6 +34,22 @@ DATABASES = {
     }
 }
 
+# Open connections per process (see api.backends.limited); a request keeps its connection
+# until it finishes, so in the gevent mode the greenlets beyond LIMIT wait for one. Keep
+# LIMIT times the worker processes of all the hosts below the max_connections of MySQL
+DATABASE_CONNECTIONS = {
+    'LIMIT': 100,
+    'WAIT': 10,                 # seconds to wait for a connection; then OperationalError
+}
+
+# Compression of the stored Paypal JSON documents (see api.fields.CompressedJSONField);
+# convert the existing rows with "python manage.py compress_json_columns"
+JSON_COMPRESSION = {
+    'ENABLED': True,
+    'LEVEL': 6,                 # zlib level 1-9
+    'MIN_SIZE': 128,            # characters; shorter documents are stored as they are
+}
+
 LOGIN_URL = '/login'
 
 # Local time zone for this installation. Choices can be found here:
@@ -107,6 +123,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'api.middleware.TimingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -214,12 +231,12 @@ TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 
 REST_FRAMEWORK = {
     'DEFAULT_PARSER_CLASSES': (
-        'rest_framework.parsers.JSONParser',
+        'api.parsers.TimedJSONParser',
         #'rest_framework_xml.parsers.XMLParser',
         #'rest_framework_yaml.parsers.YAMLParser',
     ),
     'DEFAULT_RENDERER_CLASSES': (
-        'rest_framework.renderers.JSONRenderer',
+        'api.renderers.TimedJSONRenderer',
         #'rest_framework_xml.renderers.XMLRenderer',
         #'rest_framework_yaml.renderers.YAMLRenderer',
     ),
@@ -271,4 +288,146 @@ SWAGGER_SETTINGS = {
 #=================================
 #   INTEGRATION with IAM      
 #=================================
-OAUTH_SERVER = "192.168.1.2:80" # replace it with the real public IPv4
\ No newline at end of file
+OAUTH_SERVER = "192.168.1.2:80" # replace it with the real public IPv4
+OAUTH_TIMEOUT = 10 # seconds per OpenAM call (connect and read)
+
+# Cache of the OpenAM tokeninfo responses (see api.openam)
+OPENAM_TOKEN_CACHE = {
+    'ENABLED': True,
+    'MAX_ENTRIES': 10000,       # in-process LRU bound
+    'MAX_TTL': 300,             # seconds; upper bound of the tokeninfo expires_in
+    'NEGATIVE_TTL': 30,         # seconds to remember a rejected (HTTP 401) token
+    'BACKEND': None,            # alias in CACHES to share the entries among workers, i.e. 'default'
+}
+
+
+#=================================
+#   INTEGRATION with PAYPAL
+#=================================
+# Shared keep-alive connection pool towards the Paypal API (see api.paypal.session)
+# Serving mode of the process (see wsgi.py): "threads", or "gevent" with up to
+# PAYMENT_GREENLETS concurrent requests per process. The per-process limits of the
+# upstream calls (PAYPAL_HTTP['POOL_MAXSIZE'] and the bulkheads of UPSTREAM_RESILIENCE)
+# are sized for THREADED_REQUESTS concurrent requests; in the gevent mode they are
+# scaled by PAYMENT_GREENLETS / THREADED_REQUESTS (see api.resilience.getServingScale)
+PAYMENT_SERVING = environ.get("PAYMENT_SERVING", "threads")
+PAYMENT_GREENLETS = int(environ.get("PAYMENT_GREENLETS", 1000))
+THREADED_REQUESTS = 50
+
+PAYPAL_HTTP = {
+    'POOL_CONNECTIONS': 4,      # number of host pools to cache
+    'POOL_MAXSIZE': 40,         # keep-alive connections per host; the paypal:* bulkheads together
+    'CONNECT_TIMEOUT': 3.05,    # seconds
+    'READ_TIMEOUT': 30,         # seconds
+    'MAX_RETRIES': 2,           # connection errors; the 429/5xx retries are in PAYPAL_RATE_LIMIT
+    'BACKOFF_FACTOR': 0.3,
+}
+
+# Token bucket shared by the workers of the host and retries of the 429/5xx Paypal
+# responses (see api.paypal.ratelimit); a retried POST keeps its PayPal-Request-Id
+PAYPAL_RATE_LIMIT = {
+    'ENABLED': True,
+    'RATE': 30,                 # calls per second of the host
+    'BURST': 30,                # capacity of the bucket
+    'PATH': path.join(PROJECT_ROOT, 'queue', 'paypal_rate_limit'),
+    'WAIT': 5,                  # seconds to wait for a token; then HTTP 429
+    'RETRIES': 3,
+    'RETRY_STATUSES': (429, 500, 502, 503, 504),
+    'BACKOFF_BASE': 0.5,        # seconds; doubled per retry, with full jitter
+    'BACKOFF_MAX': 8,           # seconds; also caps the Retry-After of Paypal
+    'RETRY_BUDGET': 20,         # seconds of backoff per call
+}
+
+# Circuit breakers (per upstream) and bulkheads (per upstream endpoint class) of the
+# OpenAM and Paypal calls (see api.resilience); a rejected call gets an HTTP 503 at once
+UPSTREAM_RESILIENCE = {
+    'ENABLED': True,
+    'WINDOW': 30,               # seconds of the failure rate
+    'MIN_CALLS': 20,            # calls in the window before the breaker may open
+    'FAILURE_RATE': 0.5,        # failed share (HTTP 5xx, timeouts) that opens the breaker
+    'OPEN_TIMEOUT': 30,         # seconds before the half-open probes
+    'HALF_OPEN_CALLS': 3,       # successful probes that close the breaker
+    'BULKHEADS': {              # concurrent calls per process (scaled in the gevent mode);
+                                # a Paypal call holds its slot only during its HTTP attempts,
+                                # not while it waits on PAYPAL_RATE_LIMIT or a backoff
+        'openam:tokeninfo': 20,
+        'paypal:oauth2': 10,
+        'paypal:payments': 20,
+        'paypal:billing': 10,
+    },
+    'BULKHEAD_LIMIT': 20,       # endpoint classes missing from BULKHEADS
+    'BULKHEAD_WAIT': 0.5,       # seconds to wait for a free slot (per attempt of a Paypal call)
+}
+
+# Cache of the Paypal access token validations (see api.paypal.paypal.Token)
+PAYPAL_TOKEN_CACHE = {
+    'ENABLED': True,
+    'MAX_ENTRIES': 10000,       # in-process LRU bound
+    'MAX_TTL': 3600,            # seconds; upper bound of the Paypal expires_in
+    'NEGATIVE_TTL': 30,         # seconds to remember a rejected (HTTP 401) token
+    'BACKEND': None,            # alias in CACHES to share the entries among workers, i.e. 'default'
+}
+
+# Cache of the Paypal payment details (see api.paypal.paypal.Payment.cachedDetails)
+PAYMENT_DETAILS_CACHE = {
+    'ENABLED': True,
+    'MAX_ENTRIES': 10000,       # in-process LRU bound
+    'TTL': 5,                   # seconds; payments that may still change (i.e. created)
+    'TERMINAL_TTL': 3600,       # seconds; payments in one of the TERMINAL_STATES
+    'TERMINAL_STATES': ['approved', 'failed', 'canceled', 'expired'],
+    'BACKEND': None,            # alias in CACHES; required for the webhook invalidations to reach all the workers
+}
+
+# Local reads of the payment details (see api.details)
+PAYMENT_LOCAL_READS = {
+    'ENABLED': True,            # serve the details from the database when the local copy is fresh
+    'MAX_AGE': 30,              # seconds since the last copy from Paypal
+    'TERMINAL_MAX_AGE': 86400,  # seconds, for the payments in a terminal state (kept current by the webhooks)
+}
+
+# Validation of the OpenAM/Paypal headers (see api.views.validateRequest)
+HEADERS_VALIDATION = {
+    'MODE': 'sequential',       # 'sequential' or 'concurrent' (a thread pool per process)
+    'POOL_SIZE': 8,             # threads per process for the concurrent validation
+    'TIMEOUT': 35,              # seconds to wait for the validation outcomes
+}
+
+# Ingestion of the Paypal webhook events (see api.views.WebHook)
+WEBHOOK_INGEST = {
+    'MODE': 'sync',             # 'sync' or 'queue'; in queue mode run "python manage.py process_webhook_events"
+    'QUEUE_PATH': path.join(PROJECT_ROOT, 'queue', 'webhooks.sqlite3'),
+    'WORKERS': 4,               # worker threads of process_webhook_events
+    'MAX_ATTEMPTS': 8,          # attempts before an event is moved to the dead letters
+    'RETRY_DELAY': 5,           # seconds; doubled on every attempt
+    'LEASE': 300,               # seconds a worker holds an event before it is considered lost
+    'BATCH_SIZE': 1000,         # events per transaction in the batch endpoint
+}
+
+# Transaction log of the Paypal calls (see api.auditlog)
+TRANSACTION_LOG = {
+    'MODE': 'sync',             # 'sync' or 'buffered'; buffered entries are inserted in batches by a background thread
+    'SPOOL_DIR': path.join(PROJECT_ROOT, 'queue', 'transaction_log'),
+    'DURABILITY': 'flush',      # 'memory', 'flush' (survives a crash of the process) or 'fsync' (survives a crash of the host)
+    'BATCH_SIZE': 500,          # entries per insert; a full batch is flushed at once
+    'FLUSH_INTERVAL': 1.0,      # seconds between the flushes
+    'MAX_BUFFER': 100000,       # pending entries per process
+    'RECOVERY_AGE': 60,         # seconds after which a spool segment is considered orphaned
+}
+
+# Stored responses of the create requests with an Idempotency-Key header (see api.idempotency);
+# remove the expired ones with "python manage.py purge_idempotency_keys"
+IDEMPOTENCY = {
+    'ENABLED': True,
+    'TTL': 86400,               # seconds a response is replayed
+    'LEASE': 120,               # seconds after which an unfinished request is considered lost
+    'RETRY_AFTER': 1,           # seconds (Retry-After) of the HTTP 409 to a duplicate of a request in flight
+    'MAX_KEY_LENGTH': 255,
+}
+
+# Request duration histograms per endpoint and component (OpenAM, Paypal, database,
+# serialization) of every process, served at GET /metrics (see api.metrics)
+METRICS = {
+    'ENABLED': True,
+    'BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),    # seconds
+    'ALLOWED_ADDRESSES': ('127.0.0.1', '::1'),                              # clients of /metrics
+}
@@ -47,6 +47,7 @@ urlpatterns = patterns('',
     url(r'^docs/',          include('rest_framework_swagger.urls')),
     url(r'^api-auth/',      include('rest_framework.urls',  namespace='rest_framework')),
     url(r'^api/v1/',        include(rurls.endpoints, namespace='private_api')),
+    url(r'^metrics$',       rviews.exposeMetrics, name='metrics'),
 
 )
 
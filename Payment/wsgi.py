@@ -15,6 +15,15 @@ framework.
 """
 import os
 
+# Cooperative serving mode (PAYMENT_SERVING=gevent): the blocking socket calls of the
+# process (OpenAM tokeninfo, Paypal oauth2 and resource calls) are patched to yield to the
+# other requests, so a single worker keeps many Paypal calls in flight. The patching must
+# precede any other import. It requires gevent (pip install gevent==1.2.2). The settings
+# scale the per-process limits of the upstream calls to PAYMENT_GREENLETS.
+if os.environ.get("PAYMENT_SERVING") == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Payment.settings")
 
 # This application object is used by any WSGI server configured to use this
@@ -26,3 +35,27 @@ application = get_wsgi_application()
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
+
+
+def serve(address):
+    """Serve the application with the gevent WSGI server, one greenlet per request
+
+    The maximum number of the concurrent requests is the PAYMENT_GREENLETS setting,
+    which the limits of the upstream calls are scaled to.
+
+    Usage::
+        $ PAYMENT_SERVING=gevent PAYMENT_GREENLETS=1000 python Payment/wsgi.py 0.0.0.0:8000
+
+    :param address: the (host, port) to listen on
+    :type address: tuple
+    """
+    from django.conf import settings
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(address, application, spawn=Pool(settings.PAYMENT_GREENLETS)).serve_forever()
+
+
+if __name__ == "__main__":
+    import sys
+    (host, port) = sys.argv[1].rsplit(":", 1) if len(sys.argv) > 1 else ("0.0.0.0", "8000")
+    serve((host, int(port)))
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Lookup time of the hot webhook/execute/reporting queries before and after the indexes
+declared in api.models (db_index / index_together).
+
+The tables are reduced to the columns that take part in the lookups and they are
+populated in a scratch SQLite file, so the script never touches the service database.
+One payment and one billing agreement in 10000 belong to a small client, whose export
+(api.export) is timed too.
+
+Usage::
+    $ python benchmarks/lookup_indexes.py --rows 10000000
+"""
+
+import os
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+
+
+TABLES = [
+    "CREATE TABLE payment (id INTEGER PRIMARY KEY, client_id VARCHAR(128), pay_id VARCHAR(128), create_time DATETIME)",
+    "CREATE TABLE billing_agreement (id INTEGER PRIMARY KEY, client_id VARCHAR(128), agreement_id VARCHAR(128),"
+    " payment_token VARCHAR(128), start_date DATETIME)",
+    "CREATE TABLE sale (id INTEGER PRIMARY KEY, parent_payment VARCHAR(128), billing_agreement_id VARCHAR(128))",
+    "CREATE TABLE authorization (id INTEGER PRIMARY KEY, parent_payment VARCHAR(128))",
+    "CREATE TABLE capture (id INTEGER PRIMARY KEY, parent_payment VARCHAR(128))",
+    "CREATE TABLE refund (id INTEGER PRIMARY KEY, sale_id VARCHAR(96), capture_id VARCHAR(96), parent_payment VARCHAR(128))",
+    "CREATE TABLE payment_transaction_log (id INTEGER PRIMARY KEY, payment_id VARCHAR(96))",
+]
+
+INDEXES = [
+    "CREATE INDEX payment_pay_id ON payment (pay_id)",
+    "CREATE INDEX payment_client_id_create_time ON payment (client_id, create_time)",
+    "CREATE INDEX billing_agreement_payment_token ON billing_agreement (payment_token)",
+    "CREATE INDEX refund_sale_id ON refund (sale_id)",
+    "CREATE INDEX sale_parent_payment ON sale (parent_payment)",
+    "CREATE INDEX sale_billing_agreement_id ON sale (billing_agreement_id)",
+    "CREATE INDEX authorization_parent_payment ON authorization (parent_payment)",
+    "CREATE INDEX capture_parent_payment ON capture (parent_payment)",
+    "CREATE INDEX refund_parent_payment ON refund (parent_payment)",
+    "CREATE INDEX payment_transaction_log_payment_id ON payment_transaction_log (payment_id)",
+]
+
+QUERIES = [
+    ("Payment.pay_id", "SELECT id FROM payment WHERE pay_id = ?", lambda rows: ("PAY-%d" % random.randrange(rows),)),
+    ("Payment(client_id, create_time)",
+     "SELECT id FROM payment WHERE client_id = ? AND create_time >= ? ORDER BY create_time DESC, id DESC LIMIT 50",
+     lambda rows: ("client-%d" % random.randrange(10), "2017-06-01")),
+    ("BillingAgreement.payment_token",
+     "SELECT id FROM billing_agreement WHERE payment_token = ? AND agreement_id IS NULL",
+     lambda rows: ("EC-%d" % random.randrange(rows),)),
+    ("Refund.sale_id", "SELECT id FROM refund WHERE sale_id = ?", lambda rows: ("S-%d" % random.randrange(rows),)),
+    ("PaymentTransactionLog.payment_id", "SELECT id FROM payment_transaction_log WHERE payment_id = ?",
+     lambda rows: ("PAY-%d" % random.randrange(rows),)),
+    # the related resources of the payment details (api.details.getLocalRows)
+    ("parent_payment (details)",
+     " UNION ALL ".join("SELECT id FROM %s WHERE parent_payment = ?" % table
+                        for table in ("sale", "authorization", "capture", "refund")),
+     lambda rows: ("PAY-%d" % random.randrange(rows),) * 4),
+    # the first chunk of the sales export of a client (api.export.filterSales)
+    ("Sale parent_payment/agreement (export)",
+     "SELECT id FROM sale WHERE parent_payment IN (SELECT pay_id FROM payment WHERE client_id = ?)"
+     " OR billing_agreement_id IN (SELECT agreement_id FROM billing_agreement WHERE client_id = ?)"
+     " ORDER BY id LIMIT 2000",
+     lambda rows: ("client-small", "client-small")),
+    ("Capture.parent_payment (export)",
+     "SELECT id FROM capture WHERE parent_payment IN (SELECT pay_id FROM payment WHERE client_id = ?)"
+     " ORDER BY id LIMIT 2000",
+     lambda rows: ("client-small",)),
+]
+
+
+def getClient(i):
+    return "client-small" if i % 10000 == 0 else "client-%d" % (i % 10)
+
+
+def populate(connection, rows):
+    """Fill the tables with rows entries each"""
+    for statement in TABLES:
+        connection.execute(statement)
+    day = 24 * 3600
+    start = time.mktime((2017, 1, 1, 0, 0, 0, 0, 0, 0))
+    chunk = 100000
+    for offset in range(0, rows, chunk):
+        ids = range(offset, min(offset + chunk, rows))
+        connection.executemany("INSERT INTO payment VALUES (?, ?, ?, ?)", (
+            (i, getClient(i), "PAY-%d" % i,
+             time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start + (i * 365.0 * day / rows)))) for i in ids))
+        connection.executemany("INSERT INTO billing_agreement VALUES (?, ?, ?, ?, ?)", (
+            (i, getClient(i), "I-%d" % i if i % 2 else None, "EC-%d" % i, "2017-01-01") for i in ids))
+        # the sales of even ids belong to payments, the others to billing agreements
+        connection.executemany("INSERT INTO sale VALUES (?, ?, ?)", (
+            (i, None if i % 2 else "PAY-%d" % i, "I-%d" % i if i % 2 else None) for i in ids))
+        connection.executemany("INSERT INTO authorization VALUES (?, ?)", ((i, "PAY-%d" % i) for i in ids))
+        connection.executemany("INSERT INTO capture VALUES (?, ?)", ((i, "PAY-%d" % i) for i in ids))
+        connection.executemany("INSERT INTO refund VALUES (?, ?, ?, ?)", ((i, "S-%d" % i, None, "PAY-%d" % i) for i in ids))
+        connection.executemany("INSERT INTO payment_transaction_log VALUES (?, ?)", ((i, "PAY-%d" % i) for i in ids))
+    connection.commit()
+
+
+def measure(connection, rows, repeat):
+    """Get the average time per query in milliseconds"""
+    timings = []
+    for (name, query, parameters) in QUERIES:
+        started = time.time()
+        for i in range(repeat):
+            connection.execute(query, parameters(rows)).fetchall()
+        timings.append((name, (time.time() - started) * 1000.0 / repeat))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000, help="rows per table")
+    parser.add_argument("--repeat", type=int, default=5, help="queries per measurement without indexes")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "lookup_indexes.sqlite3")
+    connection = sqlite3.connect(path)
+    try:
+        populate(connection, args.rows)
+        before = measure(connection, args.rows, args.repeat)
+        for statement in INDEXES:
+            connection.execute(statement)
+        connection.execute("ANALYZE")
+        after = measure(connection, args.rows, args.repeat * 200)
+    finally:
+        connection.close()
+        os.remove(path)
+
+    print("%d rows per table" % args.rows)
+    print("%-40s %14s %14s" % ("lookup", "before (ms)", "after (ms)"))
+    for ((name, slow), (_, fast)) in zip(before, after):
+        print("%-40s %14.3f %14.3f" % (name, slow, fast))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Serialization time of a Paypal payment with the former object2dict (str + ast.literal_eval
+and then json.dumps) and with api.utilities.toJson.
+
+Usage::
+    $ python benchmarks/object2dict.py --items 50 --repeat 2000
+"""
+
+import os
+import sys
+import ast
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Payment"))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Payment.settings")
+
+from api import utilities
+
+
+def legacyObject2dict(object, filter_data=True):
+    """object2dict before the single pass conversion"""
+    if filter_data == True:
+        return ast.literal_eval(str(object.__data__))
+    return ast.literal_eval(str(object))
+
+
+def createPayment(items):
+    """Build a Paypal payment (as returned by api.paypal) with the given number of items"""
+    return {
+        u"id": u"PAY-1B56960729604235TKQQIYVY",
+        u"intent": u"sale",
+        u"state": u"created",
+        u"create_time": u"2017-09-22T20:53:43Z",
+        u"payer": {u"payment_method": u"paypal"},
+        u"transactions": [{
+            u"amount": {u"total": u"%d.00" % items, u"currency": u"EUR", u"details": {u"subtotal": u"%d.00" % items}},
+            u"description": u"The payment transaction description.",
+            u"item_list": {u"items": [
+                {u"name": u"item %d" % i, u"sku": u"sku-%d" % i, u"price": u"1.00", u"currency": u"EUR",
+                 u"quantity": 1, u"description": u"Café au lait"} for i in range(items)
+            ]},
+            u"related_resources": []
+        }],
+        u"links": [
+            {u"href": u"https://api.sandbox.paypal.com/v1/payments/payment/PAY-1B56960729604235TKQQIYVY",
+             u"rel": u"self", u"method": u"GET"},
+            {u"href": u"https://www.sandbox.paypal.com/cgi-bin/webscr?cmd=_express-checkout&token=EC-60385559L1062554J",
+             u"rel": u"approval_url", u"method": u"REDIRECT"},
+        ]
+    }
+
+
+def measure(function, payload, repeat):
+    """Get the average time per call in microseconds"""
+    started = time.time()
+    for i in range(repeat):
+        function(payload)
+    return (time.time() - started) * 1000000.0 / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=50, help="items of the payment transaction")
+    parser.add_argument("--repeat", type=int, default=2000, help="conversions per measurement")
+    args = parser.parse_args()
+
+    payload = createPayment(args.items)
+    legacy = lambda data: json.dumps(legacyObject2dict(data, False))
+    assert json.loads(legacy(payload)) == json.loads(utilities.toJson(payload))
+
+    print("payload: %d bytes, encoder: %s" % (len(utilities.toJson(payload)), utilities.encoder.__name__))
+    print("%-40s %10.1f us" % ("json.dumps(object2dict(...)) (before)", measure(legacy, payload, args.repeat)))
+    print("%-40s %10.1f us" % ("toJson(...)", measure(utilities.toJson, payload, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
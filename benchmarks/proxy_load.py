@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Requests/sec per core of a Paypal proxy endpoint served by a sync worker (a fixed number
+of threads, like a mod_wsgi daemon process) and by the cooperative gevent worker
+(PAYMENT_SERVING=gevent, see Payment/wsgi.py).
+
+Every request executes a payment (POST /api/v1/payments/payment/<id>/execute), so the
+worker calls the OpenAM tokeninfo, the Paypal oauth2 and the Paypal execute endpoints
+(the token caches are disabled). A local stub answers them after --latency seconds and
+the service runs on a scratch SQLite database, so the script never reaches the real
+OpenAM/Paypal or the service database.
+
+Usage::
+    $ pip install gevent==1.2.2
+    $ python benchmarks/proxy_load.py --latency 0.2 --concurrency 500 --duration 20
+"""
+
+import os
+import sys
+import json
+import time
+import Queue
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SETTINGS = """
+from Payment.settings import *
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': %(database)r}}
+MIGRATION_MODULES = {'api': 'api.migrations_not_used', 'app': 'app.migrations_not_used'}
+LOGGING = {'version': 1, 'disable_existing_loggers': True}
+DEBUG = False
+ALLOWED_HOSTS = ['*']
+OAUTH_SERVER = %(upstream)r
+OPENAM_TOKEN_CACHE = {'ENABLED': False}
+PAYPAL_TOKEN_CACHE = {'ENABLED': False}
+HEADERS_VALIDATION = {'MODE': 'sequential'}
+"""
+
+HEADERS = {
+    "Content-Type": "application/json",
+    "Openam-Client": "client-1",
+    "Openam-Client-Token": "8d5f2e6b-5b6a-4f1e-9c1e-0a1b2c3d4e5f",
+    "Paypal-Access-Token": "A101",
+}
+
+
+def upstream(latency):
+    """WSGI application that plays OpenAM and Paypal"""
+    import gevent
+
+    def application(environ, start_response):
+        gevent.sleep(latency)
+        path = environ["PATH_INFO"]
+        if path.startswith("/openam/"):
+            body = {"expires_in": 3600, "scope": ["cn", "mail"], "access_token": "openam"}
+        elif path.endswith("/oauth2/token"):
+            body = {"expires_in": 32400, "access_token": "A101", "token_type": "Bearer"}
+        else:
+            body = {"id": path.split("/")[4], "intent": "sale", "state": "approved", "transactions": [],
+                    "create_time": "2017-09-06T10:00:00Z", "update_time": "2017-09-06T10:05:00Z"}
+        start_response("200 OK", [("Content-Type", "application/json")])
+        return [json.dumps(body)]
+    return application
+
+
+def runUpstream(args):
+    from gevent import monkey
+    monkey.patch_all()
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(("127.0.0.1", args.upstream_port), upstream(args.latency), log=None).serve_forever()
+
+
+def runServer(args):
+    """Serve the service in the sync (threads) or the gevent (greenlets) mode"""
+    if args.mode == "gevent":
+        os.environ["PAYMENT_SERVING"] = "gevent"
+        os.environ["PAYMENT_GREENLETS"] = str(args.greenlets)
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, "Payment"))
+    from Payment import wsgi
+    from api.paypal import config
+    config.__base_map__["sandbox"] = "http://127.0.0.1:%d" % args.upstream_port
+
+    if args.mode == "gevent":
+        wsgi.serve(("127.0.0.1", args.port))
+        return
+
+    from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    class PooledWSGIServer(WSGIServer):
+        """WSGI server that handles the requests with a fixed number of threads"""
+        request_queue_size = 1024
+
+        def __init__(self, address, threads):
+            WSGIServer.__init__(self, address, QuietHandler)
+            self.requests = Queue.Queue()
+            for i in range(threads):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+
+        def process_request(self, request, client_address):
+            self.requests.put((request, client_address))
+
+        def work(self):
+            while True:
+                (request, client_address) = self.requests.get()
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+
+    server = PooledWSGIServer(("127.0.0.1", args.port), args.threads)
+    server.set_app(wsgi.application)
+    server.serve_forever()
+
+
+def waitForPort(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.2)
+    raise RuntimeError("Nothing listens on port %d" % port)
+
+
+def getCpuTime(pid):
+    """Get the user and system CPU seconds of a process (Linux)"""
+    with open("/proc/%d/stat" % pid) as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+
+def load(port, concurrency, duration):
+    """Execute payments from concurrency clients for duration seconds
+
+    :returns: the successful and the failed requests
+    :rtype: tuple(integer, integer)
+    """
+    import httplib
+    from gevent.pool import Pool
+    counters = {"ok": 0, "failed": 0, "sequence": 0}
+    deadline = time.time() + duration
+
+    def client():
+        while time.time() < deadline:
+            counters["sequence"] += 1
+            try:
+                connection = httplib.HTTPConnection("127.0.0.1", port, timeout=60)
+                connection.request("POST", "/api/v1/payments/payment/PAY-%010d/execute" % counters["sequence"],
+                                   json.dumps({"payer_id": "QYR5Z8XDVJNXQ"}), HEADERS)
+                response = connection.getresponse()
+                response.read()
+                connection.close()
+                counters["ok" if response.status == 200 else "failed"] += 1
+            except Exception:
+                counters["failed"] += 1
+
+    pool = Pool(concurrency)
+    for i in range(concurrency):
+        pool.spawn(client)
+    pool.join()
+    return counters["ok"], counters["failed"]
+
+
+def measure(args, mode, environment):
+    """Run the load against a server of the given mode"""
+    devnull = open(os.devnull, "w")
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--role", "server", "--mode", mode,
+                               "--port", str(args.port), "--upstream-port", str(args.upstream_port),
+                               "--threads", str(args.threads), "--greenlets", str(args.greenlets)],
+                              env=environment, stdout=devnull, stderr=devnull)
+    try:
+        waitForPort(args.port)
+        load(args.port, min(args.concurrency, 20), 2)
+        (started, cpu) = (time.time(), getCpuTime(server.pid))
+        (ok, failed) = load(args.port, args.concurrency, args.duration)
+        (elapsed, cpu) = (time.time() - started, getCpuTime(server.pid) - cpu)
+    finally:
+        server.kill()
+        server.wait()
+        devnull.close()
+    return ok / elapsed, ok / max(cpu, 0.001), cpu / elapsed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--role", choices=["main", "upstream", "server"], default="main", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", choices=["sync", "gevent"], default="sync", help=argparse.SUPPRESS)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per OpenAM/Paypal call")
+    parser.add_argument("--concurrency", type=int, default=500, help="concurrent clients")
+    parser.add_argument("--duration", type=int, default=20, help="seconds per measurement")
+    parser.add_argument("--threads", type=int, default=15, help="threads of the sync worker")
+    parser.add_argument("--greenlets", type=int, default=1000, help="concurrent requests of the gevent worker")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--upstream-port", type=int, default=18001)
+    args = parser.parse_args()
+
+    if args.role == "upstream":
+        return runUpstream(args)
+    if args.role == "server":
+        return runServer(args)
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "proxy_load_settings.py"), "w") as settings:
+        settings.write(SETTINGS % {"database": os.path.join(directory, "payment.sqlite3"),
+                                   "upstream": "127.0.0.1:%d" % args.upstream_port})
+    environment = dict(os.environ, DJANGO_SETTINGS_MODULE="proxy_load_settings",
+                       PYTHONPATH=os.pathsep.join([directory, ROOT, os.environ.get("PYTHONPATH", "")]))
+    stub = None
+    try:
+        subprocess.check_call([sys.executable, os.path.join(ROOT, "Payment", "manage.py"), "migrate", "--noinput", "-v", "0"],
+                              env=environment)
+        stub = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--role", "upstream",
+                                 "--upstream-port", str(args.upstream_port), "--latency", str(args.latency)], env=environment)
+        waitForPort(args.upstream_port)
+        results = [(mode, measure(args, mode, environment)) for mode in ["sync", "gevent"]]
+    finally:
+        if stub is not None:
+            stub.kill()
+        shutil.rmtree(directory)
+
+    print("%d clients, %.3f s per OpenAM/Paypal call (3 calls per request), %d s per mode" % (
+        args.concurrency, args.latency, args.duration))
+    print("%-8s %12s %16s %12s %8s" % ("worker", "requests/s", "requests/s/core", "cores used", "failed"))
+    for (mode, (throughput, per_core, cores, failed)) in results:
+        print("%-8s %12.1f %16.1f %12.2f %8d" % (mode, throughput, per_core, cores, failed))
+
+
+if __name__ == "__main__":
+    main()